@@ -5,11 +5,18 @@
 
 import os
 from collections import Counter
+from itertools import repeat
 
 from fairseq.tokenizer import tokenize_line
+import numpy as np
 import torch
 from fairseq.file_io import PathManager
 
+
+# number of bytes read at once by Binarizer.binarize_blocks
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
 def safe_readline(f):
     pos = f.tell()
     while True:
@@ -75,6 +82,179 @@ class Binarizer:
             "replaced": replaced,
         }
 
+    @staticmethod
+    def binarize_blocks(
+        filename,
+        dict,
+        consumer,
+        tokenize=tokenize_line,
+        append_eos=True,
+        reverse_order=False,
+        offset=0,
+        end=-1,
+        block_size=BLOCK_SIZE,
+    ):
+        """Same as :func:`binarize`, but processes the file in large blocks.
+
+        The byte range is read *block_size* bytes at a time and all lines of
+        a block are mapped to ids with a single lookup pass over the
+        dictionary's symbol table. Instead of one tensor per line, *consumer*
+        is called once per block with a flat array holding the ids of all
+        lines and an array holding the number of ids of each line (see
+        :func:`MMapIndexedDatasetBuilder.add_items`).
+        """
+        nseq, ntok = 0, 0
+        replaced = Counter()
+
+        indices = dict.indices
+        unk_index, unk_word, eos_word = dict.unk_index, dict.unk_word, dict.eos_word
+        # str.split() splits on exactly the same characters as tokenize_line
+        split = str.split if tokenize is tokenize_line else tokenize
+
+        def binarize_lines(lines):
+            words = []
+            sizes = np.empty(len(lines), dtype=np.int64)
+            for i, line in enumerate(lines):
+                toks = list(split(line))
+                if reverse_order:
+                    toks.reverse()
+                if append_eos:
+                    toks.append(eos_word)
+                words.extend(toks)
+                sizes[i] = len(toks)
+            ids = np.fromiter(
+                map(indices.get, words, repeat(unk_index)), dtype=np.int64, count=len(words)
+            )
+            replaced.update(
+                words[i] for i in np.flatnonzero(ids == unk_index) if words[i] != unk_word
+            )
+            consumer(ids, sizes)
+            return len(lines), len(words)
+
+        for lines in Binarizer._read_line_blocks(filename, offset, end, block_size):
+            n, t = binarize_lines(lines)
+            nseq += n
+            ntok += t
+        return {
+            "nseq": nseq,
+            "nunk": sum(replaced.values()),
+            "ntok": ntok,
+            "replaced": replaced,
+        }
+
+    @staticmethod
+    def _read_line_blocks(filename, offset=0, end=-1, block_size=BLOCK_SIZE):
+        """Yield the lines starting in the byte range [*offset*, *end*) of
+        *filename*, decoded and without line endings, in lists of about
+        *block_size* bytes."""
+
+        def split_lines(data, final):
+            # mimic universal newlines mode used by Binarizer.binarize
+            text = data.decode("utf-8")
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            lines = text.split("\n")
+            if not final or lines[-1] == "":
+                lines.pop()
+            return lines
+
+        with open(PathManager.get_local_path(filename), "rb") as f:
+            f.seek(offset)
+            remaining = end - offset if end > 0 else -1
+            pending = b""
+            while True:
+                if remaining == 0:
+                    # a partial line crossing *end* belongs to the next chunk
+                    if pending and not pending.endswith(b"\r") and f.read(1):
+                        pending = b""
+                    block = b""
+                else:
+                    block = f.read(block_size if remaining < 0 else min(block_size, remaining))
+                    if remaining > 0:
+                        remaining -= len(block)
+                if not block:
+                    if pending:
+                        yield split_lines(pending, final=True)
+                    break
+                data = pending + block
+                cut = data.rfind(b"\n") + 1
+                pending = data[cut:]
+                if cut > 0:
+                    yield split_lines(data[:cut], final=False)
+
+    @staticmethod
+    def hash_tokens(filename, output_prefix, eos_word, offset=0, end=-1, block_size=BLOCK_SIZE):
+        """Tokenize the lines of a byte range once, for building the
+        dictionary and binarizing in a single pass.
+
+        Each distinct word gets a local id in order of first occurrence. The
+        local ids of all lines, each followed by *eos_word*, are written to
+        ``output_prefix + ".ids"`` and the number of ids of each line to
+        ``output_prefix + ".sizes"``. Use :func:`remap_tokens` to convert them
+        to dictionary ids.
+
+        Returns:
+            dict: the words in local id order (``"words"``), their number of
+            occurrences (``"counts"``), ``"nseq"`` and ``"ntok"``
+        """
+        vocab = {eos_word: 0}
+        counts = np.zeros(1, dtype=np.int64)
+        nseq, ntok = 0, 0
+        with open(output_prefix + ".ids", "wb") as ids_file, \
+                open(output_prefix + ".sizes", "wb") as sizes_file:
+            for lines in Binarizer._read_line_blocks(filename, offset, end, block_size):
+                words = []
+                sizes = np.empty(len(lines), dtype=np.int64)
+                for i, line in enumerate(lines):
+                    toks = line.split()
+                    toks.append(eos_word)
+                    words.extend(toks)
+                    sizes[i] = len(toks)
+                new_words = [w for w in dict.fromkeys(words) if w not in vocab]
+                vocab.update(zip(new_words, range(len(vocab), len(vocab) + len(new_words))))
+                ids = np.fromiter(map(vocab.__getitem__, words), dtype=np.int32, count=len(words))
+                counts = np.pad(counts, (0, len(vocab) - len(counts)))
+                counts += np.bincount(ids, minlength=len(vocab))
+                ids.tofile(ids_file)
+                sizes.tofile(sizes_file)
+                nseq += len(lines)
+                ntok += len(words)
+        return {"words": list(vocab), "counts": counts, "nseq": nseq, "ntok": ntok}
+
+    @staticmethod
+    def remap_tokens(output_prefix, words, counts, dict, consumer, block_size=BLOCK_SIZE):
+        """Convert the local ids written by :func:`hash_tokens` to ids of
+        *dict*, calling *consumer* like :func:`binarize_blocks`. The temporary
+        files are removed afterwards."""
+        lookup = np.fromiter(
+            map(dict.indices.get, words, repeat(dict.unk_index)), dtype=np.int64, count=len(words)
+        )
+        replaced = Counter({
+            words[i]: int(counts[i])
+            for i in np.flatnonzero(lookup == dict.unk_index) if words[i] != dict.unk_word
+        })
+        ids_path, sizes_path = output_prefix + ".ids", output_prefix + ".sizes"
+        sizes = np.fromfile(sizes_path, dtype=np.int64)
+        if len(sizes) > 0:
+            ids = np.memmap(ids_path, dtype=np.int32, mode="r")
+            ends = np.cumsum(sizes)
+            start = 0
+            while start < len(sizes):
+                first = ends[start] - sizes[start]
+                # about *block_size* bytes of local ids at once
+                stop = max(np.searchsorted(ends, first + block_size // 4, side="right"), start + 1)
+                consumer(lookup[ids[first : ends[stop - 1]]], sizes[start:stop])
+                start = stop
+            del ids
+        os.remove(ids_path)
+        os.remove(sizes_path)
+        return {
+            "nseq": len(sizes),
+            "nunk": sum(replaced.values()),
+            "ntok": int(sizes.sum()),
+            "replaced": replaced,
+        }
+
     @staticmethod
     def binarize_alignments(filename, alignment_parser, consumer, offset=0, end=-1):
         nseq = 0
@@ -93,12 +273,14 @@ class Binarizer:
 
     @staticmethod
     def find_offsets(filename, num_chunks):
-        with open(PathManager.get_local_path(filename), "r", encoding="utf-8") as f:
+        # work on bytes so that offsets are plain byte positions (text mode
+        # tell() returns opaque cookies, e.g. after a "\r" line ending)
+        with open(PathManager.get_local_path(filename), "rb") as f:
             size = os.fstat(f.fileno()).st_size
             chunk_size = size // num_chunks
             offsets = [0 for _ in range(num_chunks + 1)]
             for i in range(1, num_chunks):
                 f.seek(chunk_size * i)
-                safe_readline(f)
+                f.readline()
                 offsets[i] = f.tell()
             return offsets
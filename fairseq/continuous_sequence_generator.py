@@ -0,0 +1,480 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import torch
+from fairseq.data import data_utils
+from fairseq.incremental_decoding_utils import left_pad_positions, share_encoder_kv
+from fairseq.models.transformer import TransformerDecoder
+from fairseq.sequence_generator import EnsembleModel
+from torch import Tensor
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+
+    def __init__(self, src_tokens: Tensor, future: Future):
+        self.src_tokens = src_tokens
+        self.future = future
+        self.finalized: List[Dict[str, Tensor]] = []
+
+
+class ContinuousSequenceGenerator(object):
+    """Beam search over a pool of sentences that changes at every step.
+
+    Unlike :class:`~fairseq.sequence_generator.SequenceGenerator`, which
+    decodes a fixed batch until all of its sentences are finished, new source
+    sentences are admitted into the pool as soon as others finish, so that
+    the batch stays full. Each admitted sentence gets its own encoder pass
+    and first decoder step, and its cached keys and values are then spliced
+    into those of the pool. The encoder-decoder attention keys and values are
+    shared by the beams of each sentence (see
+    :func:`fairseq.incremental_decoding_utils.share_encoder_kv`).
+
+    Sentences are submitted with :func:`submit`, which returns a
+    :class:`concurrent.futures.Future` of the hypotheses of the sentence, in
+    the same format as the output of ``SequenceGenerator`` for one sentence
+    (without attention). The pool is advanced either by calling
+    :func:`step` or by a background thread started with :func:`start`.
+
+    Only beam search on transformer models is supported.
+
+    Args:
+        models (List[~fairseq.models.FairseqModel]): ensemble of models
+        beam_size (int, optional): beam width (default: 1)
+        max_len_a/b (int, optional): generate sequences of maximum length
+            ax + b, where x is the source length
+        min_len (int, optional): the minimum length of the generated output
+            (not including end-of-sentence)
+        normalize_scores (bool, optional): normalize scores by the length
+            of the output (default: True)
+        len_penalty (float, optional): length penalty, where <1.0 favors
+            shorter, >1.0 favors longer sentences (default: 1.0)
+        unk_penalty (float, optional): unknown word penalty, where <0
+            produces more unks, >0 produces fewer (default: 0.0)
+        temperature (float, optional): temperature, where values
+            >1.0 produce more uniform samples and values <1.0 produce
+            sharper samples (default: 1.0)
+        max_sentences (int, optional): maximum number of sentences in the
+            pool, each of which is decoded as *beam_size* hypotheses
+            (default: 64)
+        min_admit (int, optional): wait until this many sentences can be
+            admitted at once, unless fewer are queued or the pool is empty,
+            since admitted sentences take an extra decoder step
+            (default: max_sentences / 8)
+    """
+
+    def __init__(
+        self,
+        models,
+        tgt_dict,
+        beam_size=1,
+        max_len_a=0,
+        max_len_b=200,
+        min_len=1,
+        normalize_scores=True,
+        len_penalty=1.0,
+        unk_penalty=0.0,
+        temperature=1.0,
+        max_sentences=64,
+        min_admit=None,
+    ):
+        if isinstance(models, EnsembleModel):
+            self.model = models
+        else:
+            self.model = EnsembleModel(models)
+        assert self.model.has_encoder() and all(
+            isinstance(m.decoder, TransformerDecoder) and not m.decoder.cross_self_attention
+            for m in self.model.models
+        ), "continuous batching is only supported by transformer models"
+        self.pad = tgt_dict.pad()
+        self.unk = tgt_dict.unk()
+        self.eos = tgt_dict.eos()
+        self.vocab_size = len(tgt_dict)
+        # the max beam size is the dictionary size - 1, since we never select pad
+        self.beam_size = min(beam_size, self.vocab_size - 1)
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.min_len = min_len
+        self.normalize_scores = normalize_scores
+        self.len_penalty = len_penalty
+        self.unk_penalty = unk_penalty
+        self.temperature = temperature
+        self.max_sentences = max_sentences
+        self.min_admit = min_admit if min_admit is not None else max(1, max_sentences // 8)
+        assert temperature > 0, "--temperature must be greater than 0"
+        self.model.eval()
+
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._pending: "deque[_Request]" = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+        # the pool: hypotheses are left-padded, so that the last column of
+        # *tokens* holds the input of the next step of every hypothesis
+        self._requests: List[_Request] = []
+        self._tokens: Optional[Tensor] = None  # (num_hypos, width)
+        self._scores: Optional[Tensor] = None  # cumulative scores of tokens
+        self._steps: Optional[Tensor] = None  # tokens generated per sentence
+        self._max_lens: Optional[Tensor] = None  # per sentence
+        self._incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]] = []
+
+    def cuda(self):
+        self.model.cuda()
+        return self
+
+    def submit(self, src_tokens: Tensor) -> Future:
+        """Queue a source sentence (a 1-D LongTensor ending with eos) for
+        translation and return a future of its list of hypotheses."""
+        future: Future = Future()
+        self._queue.put(_Request(src_tokens, future))
+        return future
+
+    def num_active(self) -> int:
+        """Number of sentences in the pool."""
+        return len(self._requests)
+
+    def generate(self, src_tokens: List[Tensor]) -> List[List[Dict[str, Tensor]]]:
+        """Translate a list of source sentences, by stepping the pool in the
+        calling thread until they are all finished."""
+        assert self._thread is None, "generate() cannot be used with start()"
+        futures = [self.submit(tokens) for tokens in src_tokens]
+        while not all(future.done() for future in futures):
+            self.step()
+        return [future.result() for future in futures]
+
+    def start(self):
+        """Start a background thread which advances the pool whenever there
+        is work to do."""
+        assert self._thread is None, "already started"
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread. Sentences that have not been finished
+        are failed with an exception."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        self._fail_all(RuntimeError("the generator was stopped"))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self._requests and not self._pending:
+                try:
+                    # wait for work without spinning
+                    self._pending.append(self._queue.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+            try:
+                self.step()
+            except Exception:
+                logger.exception("generation step failed")
+
+    def _fail_all(self, exception: Exception):
+        requests = list(self._pending)
+        self._pending.clear()
+        while True:
+            try:
+                requests.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._fail(requests, exception)
+
+    def _fail(self, requests: List[_Request], exception: Exception):
+        """Fail *requests* and the sentences of the pool."""
+        requests = self._requests + requests
+        self._reset_pool()
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(exception)
+
+    def _reset_pool(self):
+        self._requests = []
+        self._tokens = self._scores = self._steps = self._max_lens = None
+        self._incremental_states = []
+
+    def _admit(self) -> List[_Request]:
+        while True:
+            try:
+                self._pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        admitted: List[_Request] = []
+        num_free = self.max_sentences - len(self._requests)
+        if self._requests and num_free < min(self.min_admit, len(self._pending)):
+            return admitted
+        while self._pending and len(admitted) < num_free:
+            request = self._pending.popleft()
+            if request.future.set_running_or_notify_cancel():
+                admitted.append(request)
+        return admitted
+
+    @torch.no_grad()
+    def step(self) -> bool:
+        """Admit queued sentences into the pool and run one decoding step.
+        Returns ``True`` if sentences are still being decoded."""
+        admitted = self._admit()
+        if not self._requests and not admitted:
+            return False
+        try:
+            self._step(admitted)
+        except Exception as e:
+            self._fail(admitted, e)
+            raise
+        return len(self._requests) > 0
+
+    def _step(self, admitted: List[_Request]):
+        lprobs: List[Tensor] = []
+        if self._requests:
+            assert self._tokens is not None
+            pool_lprobs, _ = self.model.forward_decoder(
+                self._tokens,
+                [None for _ in self.model.models],
+                self._incremental_states,
+                self.temperature,
+            )
+            lprobs.append(pool_lprobs)
+        if admitted:
+            lprobs.append(self._start(admitted))
+
+        self._beam_step(torch.cat(lprobs, dim=0))
+
+    def _start(self, requests: List[_Request]) -> Tensor:
+        """Run the encoder and the first decoder step of *requests*, add them
+        to the pool and return their log-probabilities."""
+        device = next(self.model.parameters()).device
+        src_tokens = data_utils.collate_tokens(
+            [request.src_tokens for request in requests], self.pad, left_pad=True,
+        ).to(device)
+        src_lengths = src_tokens.ne(self.pad).long().sum(dim=1)
+        encoder_outs = self.model.forward_encoder(
+            {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        )
+        tokens = torch.full(
+            (len(requests) * self.beam_size, 1), self.eos, dtype=torch.long, device=device
+        )
+        incremental_states = [
+            torch.jit.annotate(Dict[str, Dict[str, Optional[Tensor]]], {})
+            for _ in self.model.models
+        ]
+        for incremental_state in incremental_states:
+            share_encoder_kv(incremental_state, self.beam_size)
+            left_pad_positions(incremental_state)
+        lprobs, _ = self.model.forward_decoder(
+            tokens, encoder_outs, incremental_states, self.temperature
+        )
+
+        max_lens = torch.tensor([
+            min(
+                int(self.max_len_a * request.src_tokens.numel() + self.max_len_b),
+                # exclude the EOS marker
+                self.model.max_decoder_positions() - 1,
+            )
+            for request in requests
+        ], device=device)
+        assert (max_lens >= self.min_len).all(), \
+            "min_len cannot be larger than max_len, please adjust these!"
+        steps = max_lens.new_zeros(len(requests))
+        scores = torch.zeros(tokens.size(), device=device)
+
+        if not self._requests:
+            self._tokens, self._scores = tokens, scores
+            self._steps, self._max_lens = steps, max_lens
+            self._incremental_states = incremental_states
+        else:
+            assert self._tokens is not None and self._scores is not None
+            assert self._steps is not None and self._max_lens is not None
+            width = self._tokens.size(1)
+            self._tokens = torch.cat([self._tokens, _left_pad(tokens, width, self.pad)])
+            self._scores = torch.cat([self._scores, _left_pad(scores, width, 0)])
+            self._steps = torch.cat([self._steps, steps])
+            self._max_lens = torch.cat([self._max_lens, max_lens])
+            for model, pool_state, new_state in zip(
+                self.model.models, self._incremental_states, incremental_states
+            ):
+                for attn in _attention_modules(model):
+                    attn._set_input_buffer(pool_state, _cat_attn_states(
+                        attn._get_input_buffer(pool_state), attn._get_input_buffer(new_state),
+                    ))
+        self._requests.extend(requests)
+        return lprobs
+
+    def _beam_step(self, lprobs: Tensor):
+        assert self._tokens is not None and self._scores is not None
+        assert self._steps is not None and self._max_lens is not None
+        bsz, beam_size = len(self._requests), self.beam_size
+        steps = self._steps
+        hypo_steps = steps.repeat_interleave(beam_size).unsqueeze(1)
+        hypo_max_lens = self._max_lens.repeat_interleave(beam_size).unsqueeze(1)
+
+        lprobs[lprobs != lprobs] = -math.inf
+        lprobs[:, self.pad] = -math.inf  # never select pad
+        lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+        # handle max length constraint
+        vocab = torch.arange(self.vocab_size, device=lprobs.device)
+        lprobs.masked_fill_(hypo_steps.ge(hypo_max_lens) & vocab.ne(self.eos), -math.inf)
+        # minimum length constraint
+        lprobs.masked_fill_(hypo_steps.lt(self.min_len) & vocab.eq(self.eos), -math.inf)
+
+        # make probs contain cumulative scores for each hypothesis; at their
+        # first step all hypotheses of a sentence are equally likely, so only
+        # the first beam is used
+        lprobs = lprobs.view(bsz, beam_size, -1) + self._scores[:, -1].view(bsz, beam_size, 1)
+        lprobs[:, 1:].masked_fill_(steps.eq(0).view(bsz, 1, 1), -math.inf)
+        cand_size = 2 * beam_size
+        cand_scores, cand_indices = torch.topk(
+            lprobs.view(bsz, -1), k=min(cand_size, lprobs[0].numel() - 1)
+        )
+        cand_bbsz_idx = cand_indices // self.vocab_size + (
+            torch.arange(bsz, device=lprobs.device) * beam_size
+        ).unsqueeze(1)
+        cand_indices = cand_indices.fmod(self.vocab_size)
+
+        # finalize hypotheses that end in eos, when among the top beam_size
+        eos_mask = cand_indices.eq(self.eos) & cand_scores.ne(-math.inf)
+        finished = self._finalize(
+            eos_mask[:, :beam_size], cand_bbsz_idx[:, :beam_size], cand_scores[:, :beam_size]
+        )
+
+        # continue with the top beam_size candidates that don't end in eos
+        active_mask = eos_mask.long() * cand_size + torch.arange(
+            cand_indices.size(1), device=lprobs.device
+        )
+        _, active_hypos = torch.topk(active_mask, k=beam_size, dim=1, largest=False)
+        keep = ~finished
+        new_order = torch.gather(cand_bbsz_idx, 1, active_hypos)[keep].view(-1)
+        new_tokens = torch.gather(cand_indices, 1, active_hypos)[keep].view(-1, 1)
+        new_scores = torch.gather(cand_scores, 1, active_hypos)[keep].view(-1, 1)
+
+        self._requests = [r for r, f in zip(self._requests, finished.tolist()) if not f]
+        if not self._requests:
+            self._reset_pool()
+            return
+        self._tokens = torch.cat([self._tokens.index_select(0, new_order), new_tokens], dim=1)
+        self._scores = torch.cat(
+            [self._scores.index_select(0, new_order), new_scores.type_as(self._scores)], dim=1
+        )
+        self._steps = steps[keep] + 1
+        self._max_lens = self._max_lens[keep]
+        self.model.reorder_incremental_state(self._incremental_states, new_order)
+
+        # drop the columns which are padding in every hypothesis
+        num_pad = self._tokens.size(1) - 1 - int(self._steps.max())
+        if num_pad > 0:
+            self._tokens = self._tokens[:, num_pad:]
+            self._scores = self._scores[:, num_pad:]
+            for model, state in zip(self.model.models, self._incremental_states):
+                for layer in model.decoder.layers:
+                    buffer = layer.self_attn._get_input_buffer(state)
+                    layer.self_attn._set_input_buffer(state, _trim_attn_state(buffer, num_pad))
+
+    def _finalize(self, eos_mask: Tensor, eos_bbsz_idx: Tensor, eos_scores: Tensor) -> Tensor:
+        """Store the hypotheses ending in eos and return the mask of the
+        sentences which are finished."""
+        assert self._tokens is not None and self._scores is not None
+        assert self._steps is not None and self._max_lens is not None
+        finished = self._steps.ge(self._max_lens)
+        if eos_mask.any():
+            width = self._tokens.size(1)
+            steps = self._steps.tolist()
+            for sent, idx in eos_mask.nonzero().tolist():
+                request = self._requests[sent]
+                if len(request.finalized) >= self.beam_size:
+                    continue
+                step = steps[sent]
+                bbsz_idx = eos_bbsz_idx[sent, idx]
+                score = eos_scores[sent, idx]
+                # skip the first index, which is EOS
+                hypo_tokens = self._tokens[bbsz_idx, width - step:]
+                pos_scores = torch.cat([self._scores[bbsz_idx, width - step:], score.view(1)])
+                # convert from cumulative to per-position scores
+                pos_scores[1:] = pos_scores[1:] - pos_scores[:-1]
+                if self.normalize_scores:
+                    score = score / (step + 1) ** self.len_penalty
+                request.finalized.append({
+                    "tokens": torch.cat([hypo_tokens, hypo_tokens.new([self.eos])]),
+                    "score": score,
+                    "attention": torch.empty(0),
+                    "alignment": torch.empty(0),
+                    "positional_scores": pos_scores,
+                })
+            for sent, request in enumerate(self._requests):
+                if len(request.finalized) == self.beam_size:
+                    finished[sent] = True
+        for sent in finished.nonzero().view(-1).tolist():
+            request = self._requests[sent]
+            request.future.set_result(
+                sorted(request.finalized, key=lambda hypo: hypo["score"].item(), reverse=True)
+            )
+        return finished
+
+
+def _attention_modules(model):
+    for layer in model.decoder.layers:
+        yield layer.self_attn
+        if layer.encoder_attn is not None:
+            yield layer.encoder_attn
+
+
+def _left_pad(x: Tensor, width: int, value) -> Tensor:
+    return torch.cat([x.new_full((x.size(0), width - x.size(1)), value), x], dim=1)
+
+
+def _padding_mask(state: Dict[str, Optional[Tensor]], length: int) -> Tensor:
+    key = state["prev_key"]
+    assert key is not None
+    mask = state.get("prev_key_padding_mask")
+    if mask is None:
+        mask = torch.zeros(key.size(0), key.size(2), dtype=torch.bool, device=key.device)
+    return _left_pad(mask.bool(), length, True)
+
+
+def _cat_attn_states(
+    a: Dict[str, Optional[Tensor]], b: Dict[str, Optional[Tensor]]
+) -> Dict[str, Optional[Tensor]]:
+    """Concatenate the cached keys and values of two batches of hypotheses
+    (see :class:`fairseq.modules.MultiheadAttention`). The shorter ones are
+    left-padded, and the padding is masked."""
+    assert set(a.keys()) <= {"prev_key", "prev_value", "prev_key_padding_mask"}
+    assert set(b.keys()) <= {"prev_key", "prev_value", "prev_key_padding_mask"}
+    key_a, key_b = a["prev_key"], b["prev_key"]
+    assert key_a is not None and key_b is not None
+    length = max(key_a.size(2), key_b.size(2))
+    state: Dict[str, Optional[Tensor]] = {}
+    for name in ["prev_key", "prev_value"]:
+        parts = []
+        for x in [a[name], b[name]]:
+            assert x is not None
+            pad = x.new_zeros(x.size(0), x.size(1), length - x.size(2), x.size(3))
+            parts.append(torch.cat([pad, x], dim=2))
+        state[name] = torch.cat(parts, dim=0)
+    state["prev_key_padding_mask"] = torch.cat(
+        [_padding_mask(a, length), _padding_mask(b, length)], dim=0
+    )
+    return state
+
+
+def _trim_attn_state(state: Dict[str, Optional[Tensor]], num_steps: int):
+    """Drop the first *num_steps* cached keys and values."""
+    for name in ["prev_key", "prev_value"]:
+        x = state[name]
+        assert x is not None
+        state[name] = x[:, :, num_steps:]
+    mask = state.get("prev_key_padding_mask")
+    if mask is not None:
+        state["prev_key_padding_mask"] = mask[:, num_steps:]
+    return state
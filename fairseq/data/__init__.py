@@ -19,7 +19,13 @@ from .concat_dataset import ConcatDataset
 from .concat_sentences_dataset import ConcatSentencesDataset
 from .denoising_dataset import DenoisingDataset
 from .id_dataset import IdDataset
-from .indexed_dataset import IndexedCachedDataset, IndexedDataset, IndexedRawTextDataset, MMapIndexedDataset
+from .indexed_dataset import (
+    IndexedCachedDataset,
+    IndexedDataset,
+    IndexedRawTextDataset,
+    MMapIndexedDataset,
+    ShardedMMapIndexedDataset,
+)
 from .language_pair_dataset import LanguagePairDataset
 from .list_dataset import ListDataset
 from .lm_context_window_dataset import LMContextWindowDataset
@@ -103,6 +109,7 @@ __all__ = [
     'SampledMultiDataset',
     'SampledMultiEpochDataset',
     'ShardedIterator',
+    'ShardedMMapIndexedDataset',
     'SortDataset',
     'StripTokenDataset',
     'SubsampleDataset',
@@ -32,6 +32,10 @@ class AddTargetDataset(BaseWrapperDataset):
         own_sz = len(self.get_label(index))
         return (sz, own_sz)
 
+    def sizes_array(self):
+        # the label sizes are only known once the labels are loaded
+        return None
+
     def collater(self, samples):
         collated = self.dataset.collater(samples)
         if len(collated) == 0:
@@ -40,3 +40,9 @@ class AppendTokenDataset(BaseWrapperDataset):
         if self.token is not None:
             n += 1
         return n
+
+    def sizes_array(self):
+        sizes = super().sizes_array()
+        if sizes is not None and self.token is not None:
+            sizes = sizes + 1
+        return sizes
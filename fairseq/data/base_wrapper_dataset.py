@@ -36,6 +36,11 @@ class BaseWrapperDataset(FairseqDataset):
     def size(self, index):
         return self.dataset.size(index)
 
+    def sizes_array(self):
+        if hasattr(self.dataset, 'sizes_array'):
+            return self.dataset.sizes_array()
+        return None
+
     def ordered_indices(self):
         return self.dataset.ordered_indices()
 
@@ -55,12 +60,14 @@ class BaseWrapperDataset(FairseqDataset):
         max_tokens=None,
         max_sentences=None,
         required_batch_size_multiple=1,
+        **kwargs
     ):
         return self.dataset.batch_by_size(
             indices,
             max_tokens=max_tokens,
             max_sentences=max_sentences,
             required_batch_size_multiple=required_batch_size_multiple,
+            **kwargs
         )
 
     def set_epoch(self, epoch):
@@ -0,0 +1,125 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Persistent cache for batch plans, i.e. the output of
+:func:`~fairseq.data.data_utils.filter_by_size` followed by
+:func:`~fairseq.data.FairseqDataset.batch_by_size`.
+
+Plans are keyed by a hash of the dataset's size arrays and of all arguments
+that affect batching, so a cached plan is invalidated automatically when
+the data or the batching configuration changes.
+"""
+
+import hashlib
+import itertools
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# bump when the on-disk format or the batching logic changes
+VERSION = 1
+
+_HASH_CHUNK = 1 << 24
+
+
+def _size_arrays(dataset):
+    """Returns the size arrays that determine the batches of *dataset*, or
+    ``None`` if they are not available as numpy arrays."""
+    if hasattr(dataset, 'src_sizes'):
+        sizes = [dataset.src_sizes, getattr(dataset, 'tgt_sizes', None)]
+    else:
+        sizes = getattr(dataset, 'sizes', None)
+        if not isinstance(sizes, (list, tuple)):
+            sizes = [sizes]
+    sizes = [s for s in sizes if s is not None]
+    if len(sizes) == 0 or not all(isinstance(s, np.ndarray) for s in sizes):
+        return None
+    return sizes
+
+
+def _update_hash(h, array):
+    array = np.ascontiguousarray(array)
+    h.update('{}:{};'.format(array.dtype.str, array.shape).encode())
+    flat = array.reshape(-1).view(np.uint8)
+    for i in range(0, len(flat), _HASH_CHUNK):
+        h.update(memoryview(flat[i:i + _HASH_CHUNK]))
+
+
+def batch_plan_key(dataset, **kwargs):
+    """Computes the cache key for batching *dataset* with the batching
+    arguments given in *kwargs*. Returns ``None`` if *dataset* cannot be
+    cached, e.g. because its sizes are not exposed as numpy arrays."""
+    sizes = _size_arrays(dataset)
+    if sizes is None:
+        return None
+    h = hashlib.blake2b(digest_size=20)
+    h.update('v{};{};{};'.format(VERSION, type(dataset).__name__, len(dataset)).encode())
+    for key in sorted(kwargs):
+        h.update('{}={!r};'.format(key, kwargs[key]).encode())
+    for s in sizes:
+        _update_hash(h, s)
+    return h.hexdigest()
+
+
+def _paths(cache_dir, key):
+    prefix = os.path.join(cache_dir, key)
+    return prefix + '.indices.npy', prefix + '.offsets.npy'
+
+
+def load_batch_plan(cache_dir, key):
+    """Loads a cached batch plan as a list of index arrays backed by a
+    memory-mapped file, or returns ``None`` if there is no plan for *key*."""
+    indices_path, offsets_path = _paths(cache_dir, key)
+    # the offsets are written last, so they mark a complete plan
+    if not os.path.exists(offsets_path):
+        return None
+    try:
+        offsets = np.load(offsets_path)
+        indices = np.load(indices_path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        logger.warning('ignoring corrupted batch plan cache entry {}: {}'.format(key, e))
+        return None
+    if len(offsets) == 0 or offsets[-1] != len(indices):
+        logger.warning('ignoring corrupted batch plan cache entry {}'.format(key))
+        return None
+    return [indices[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def _save_atomic(path, array):
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_batch_plan(cache_dir, key, batches):
+    """Writes *batches* (a list of lists or arrays of indices) to the cache.
+    Returns ``False`` if the batches cannot be stored as flat index arrays."""
+    if not all(
+        isinstance(b, list) or (isinstance(b, np.ndarray) and b.ndim == 1)
+        for b in batches
+    ):
+        return False
+    os.makedirs(cache_dir, exist_ok=True)
+    offsets = np.zeros(len(batches) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in batches], out=offsets[1:])
+    indices = np.fromiter(
+        itertools.chain.from_iterable(batches), dtype=np.int64, count=offsets[-1],
+    )
+    indices_path, offsets_path = _paths(cache_dir, key)
+    _save_atomic(indices_path, indices)
+    _save_atomic(offsets_path, offsets)
+    return True
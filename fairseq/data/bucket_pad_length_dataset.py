@@ -75,3 +75,6 @@ class BucketPadLengthDataset(BaseWrapperDataset):
 
     def size(self, index):
         return self._bucketed_sizes[index]
+
+    def sizes_array(self):
+        return self._bucketed_sizes.reshape(-1, 1)
@@ -64,6 +64,17 @@ class ConcatDataset(FairseqDataset):
     def num_tokens(self, index: int):
         return np.max(self.size(index))
 
+    def sizes_array(self):
+        sizes = [getattr(ds, 'sizes_array', lambda: None)() for ds in self.datasets]
+        if any(s is None for s in sizes) or len(set(s.shape[1] for s in sizes)) != 1:
+            return None
+        _dataset_sizes = []
+        start = 0
+        for s, end, real_size in zip(sizes, self.cumulative_sizes, self.real_sizes):
+            _dataset_sizes.append(s[np.arange(end - start) % real_size])
+            start = end
+        return np.concatenate(_dataset_sizes)
+
     def attr(self, attr: str, index: int):
         dataset_idx = bisect.bisect_right(self.cumulative_sizes, index)
         return getattr(self.datasets[dataset_idx], attr, None)
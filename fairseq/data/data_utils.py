@@ -18,6 +18,12 @@ import numpy as np
 import torch
 
 
+try:
+    from fairseq.data.data_utils_fast import collate_tokens_fast
+except ImportError:
+    collate_tokens_fast = None
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,11 +37,44 @@ def infer_language_pair(path):
     return src, dst
 
 
-def collate_tokens(values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_beginning=False, pad_to_length=None):
-    """Convert a list of 1d tensors into a padded 2d tensor."""
-    size = max(v.size(0) for v in values)
+def collate_tokens(
+    values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_beginning=False,
+    pad_to_length=None, out=None, pin_memory=False,
+):
+    """Convert a list of 1d tensors into a padded 2d tensor.
+
+    CPU int64 tensors (or numpy arrays) are collated by a compiled kernel in a
+    single pass. *out* may be given to reuse a preallocated (e.g., pinned)
+    buffer, which is resized as needed; it must not still be used by a
+    previous batch. Otherwise a new tensor is allocated, in pinned memory if
+    *pin_memory* is set and CUDA is available.
+    """
+    size = max(v.shape[0] for v in values)
     size = size if pad_to_length is None else max(size, pad_to_length)
-    res = values[0].new(len(values), size).fill_(pad_idx)
+
+    arrays = _as_int64_arrays(values) if collate_tokens_fast is not None else None
+    if arrays is not None:
+        if out is None:
+            out = torch.empty(
+                len(values), size, dtype=torch.int64,
+                pin_memory=pin_memory and torch.cuda.is_available(),
+            )
+        out.resize_(len(values), size)
+        if out.dtype == torch.int64 and out.device.type == 'cpu':
+            collate_tokens_fast(
+                arrays, out.numpy(), pad_idx, -1 if eos_idx is None else eos_idx,
+                left_pad, move_eos_to_beginning,
+            )
+            return out
+
+    values = [torch.from_numpy(v) if isinstance(v, np.ndarray) else v for v in values]
+    if out is None:
+        res = values[0].new(len(values), size)
+        if pin_memory and res.device.type == 'cpu' and torch.cuda.is_available():
+            res = res.pin_memory()
+    else:
+        res = out.resize_(len(values), size)
+    res.fill_(pad_idx)
 
     def copy_tensor(src, dst):
         assert dst.numel() == src.numel()
@@ -54,6 +93,83 @@ def collate_tokens(values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_be
     return res
 
 
+def _as_int64_arrays(values):
+    """Return numpy views of *values* if they are all CPU int64 tensors or
+    arrays, else ``None``."""
+    arrays = []
+    for v in values:
+        if isinstance(v, torch.Tensor):
+            if v.dtype != torch.int64 or v.device.type != 'cpu' or v.requires_grad:
+                return None
+            v = v.numpy()
+        elif not isinstance(v, np.ndarray) or v.dtype != np.int64:
+            return None
+        if v.ndim != 1:
+            return None
+        arrays.append(v)
+    return arrays
+
+
+def pack_sequences(lengths, capacity=None):
+    """Assign sequences to as few rows as possible by first-fit decreasing
+    bin packing, for collating packed batches.
+
+    Args:
+        lengths (array-like): lengths of the sequences of shape ``(N,)``, or
+            ``(N, k)`` for examples made of *k* sequences (e.g., source and
+            target) that must share the same row
+        capacity (array-like, optional): length of the rows, for each of the
+            *k* sequences (default: the longest sequence)
+
+    Returns:
+        List[List[int]]: positions in *lengths* of the examples of each row
+    """
+    lengths = np.asarray(lengths, dtype=np.int64).reshape(len(lengths), -1)
+    if capacity is None:
+        capacity = lengths.max(axis=0)
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=np.int64), lengths.shape[1:])
+
+    rows, free = [], np.empty((0, lengths.shape[1]), dtype=np.int64)
+    for i in np.argsort(-lengths.sum(axis=1), kind='stable'):
+        fits = np.flatnonzero((free >= lengths[i]).all(axis=1))
+        if len(fits) > 0:
+            r = fits[0]
+        else:
+            r = len(rows)
+            rows.append([])
+            free = np.concatenate([free, capacity[None, :]])
+        rows[r].append(int(i))
+        free[r] -= lengths[i]
+    return rows
+
+
+def collate_packed_tokens(
+    values, rows, pad_idx, eos_idx=None, move_eos_to_beginning=False, pad_to_length=None,
+):
+    """Concatenate the 1d tensors of each row of *rows* (see
+    :func:`pack_sequences`) into a right-padded 2d tensor. Returns the
+    tokens and their segment ids, which number the sequences of a row from
+    ``1`` and are ``0`` for padding."""
+    size = max(sum(len(values[i]) for i in row) for row in rows)
+    size = size if pad_to_length is None else max(size, pad_to_length)
+    res = values[0].new(len(rows), size).fill_(pad_idx)
+    segments = torch.zeros(len(rows), size, dtype=torch.long)
+
+    for r, row in enumerate(rows):
+        offset = 0
+        for segment, i in enumerate(row, start=1):
+            v = values[i]
+            dst = res[r, offset:offset + len(v)]
+            if move_eos_to_beginning:
+                dst[0] = v[-1] if eos_idx is None else eos_idx
+                dst[1:] = v[:-1]
+            else:
+                dst.copy_(v)
+            segments[r, offset:offset + len(v)] = segment
+            offset += len(v)
+    return res, segments
+
+
 def load_indexed_dataset(path, dictionary, dataset_impl=None, combine=False, default='cached'):
     """A helper function for loading indexed datasets.
 
@@ -169,6 +285,30 @@ def _filter_by_size_dynamic(indices, size_fn, max_positions, raise_exception=Fal
     return indices, ignored
 
 
+def _filter_by_size_mask(sizes, max_positions):
+    """Vectorized size check of :func:`_filter_by_size_dynamic` for an array
+    of sizes of shape ``(N, k)``. Returns ``None`` if *max_positions* cannot
+    be compared in bulk (e.g., it is a dict)."""
+    numeric = (int, float, np.integer, np.floating)
+    if isinstance(max_positions, numeric):
+        return (sizes <= max_positions).all(axis=1)
+    if not isinstance(max_positions, (tuple, list)) or not all(
+        b is None or isinstance(b, numeric) for b in max_positions
+    ):
+        return None
+    mask = np.ones(len(sizes), dtype=bool)
+    if sizes.shape[1] == 1:
+        # a single size is compared to every component of max_positions
+        for b in max_positions:
+            if b is not None:
+                mask &= sizes[:, 0] <= b
+    else:
+        for a, b in zip(sizes.T, max_positions):
+            if b is not None:
+                mask &= a <= b
+    return mask
+
+
 def filter_by_size(indices, dataset, max_positions, raise_exception=False):
     """
     Filter indices based on their size.
@@ -181,7 +321,14 @@ def filter_by_size(indices, dataset, max_positions, raise_exception=False):
         raise_exception (bool, optional): if ``True``, raise an exception if
             any elements are filtered (default: False).
     """
-    if isinstance(max_positions, float) or isinstance(max_positions, int):
+    mask = None
+    sizes = dataset.sizes_array() if hasattr(dataset, 'sizes_array') else None
+    if sizes is not None:
+        mask = _filter_by_size_mask(sizes[indices], max_positions)
+    if mask is not None:
+        ignored = indices[~mask].tolist()
+        indices = indices[mask]
+    elif isinstance(max_positions, float) or isinstance(max_positions, int):
         if hasattr(dataset, 'sizes') and isinstance(dataset.sizes, np.ndarray):
             ignored = indices[dataset.sizes[indices] > max_positions].tolist()
             indices = indices[dataset.sizes[indices] <= max_positions]
@@ -259,6 +406,127 @@ def batch_by_size(
         return batch_fixed_shapes_fast(indices, num_tokens_fn, fixed_shapes_sorted)
 
 
+def _num_feasible(sizes, max_tokens, max_sentences, max_attention_tokens, memory_fn, max_memory):
+    """Returns the length of the longest prefix of *sizes* (of shape
+    ``(W, k)``) that fits into a single batch."""
+    bsz = np.arange(1, len(sizes) + 1, dtype=np.int64)
+    max_sizes = np.maximum.accumulate(sizes, axis=0)
+    feasible = np.ones(len(sizes), dtype=bool)
+    if max_sentences is not None:
+        feasible &= bsz <= max_sentences
+    if max_tokens is not None:
+        feasible &= (bsz[:, None] * max_sizes <= max_tokens).all(axis=1)
+    if max_attention_tokens is not None:
+        feasible &= (bsz[:, None] * max_sizes ** 2 <= max_attention_tokens).all(axis=1)
+    if memory_fn is not None:
+        feasible &= np.asarray(memory_fn(bsz, max_sizes)) <= max_memory
+    return len(sizes) if feasible.all() else int(np.argmin(feasible))
+
+
+def batch_by_padded_cost(
+    indices, sizes, max_tokens=None, max_sentences=None,
+    required_batch_size_multiple=1, max_attention_tokens=None,
+    memory_fn=None, max_memory=None,
+):
+    """
+    Pack *indices* into as few batches as possible, bounding the padded cost
+    of every batch rather than the size of its longest example.
+
+    Each column of *sizes* (e.g., source and target lengths) is accounted
+    for separately: a batch of ``bsz`` examples whose longest entry in
+    column *j* has length ``L_j`` fits if ``bsz * L_j <= max_tokens`` and
+    ``bsz * L_j ** 2 <= max_attention_tokens`` for every *j*, and if
+    ``memory_fn(bsz, L) <= max_memory``.
+
+    Examples are sorted by length over the whole dataset (ties keep the
+    order of *indices*) and batches are filled greedily, which minimizes the
+    number of batches among all partitions into runs of sorted examples.
+
+    Args:
+        indices (np.ndarray): dataset indices to batch
+        sizes (np.ndarray): sizes of all examples of the dataset, of shape
+            ``(len(dataset), k)``, see
+            :func:`~fairseq.data.FairseqDataset.sizes_array`
+        max_tokens (int, optional): max number of padded tokens in each
+            column of a batch (default: None).
+        max_sentences (int, optional): max number of sentences in each
+            batch (default: None).
+        required_batch_size_multiple (int, optional): require batch size to
+            be less than N or a multiple of N (default: 1).
+        max_attention_tokens (int, optional): max value of ``bsz * L ** 2``
+            in each column of a batch, i.e. of the attention weights per head
+            (default: None).
+        memory_fn (callable, optional): vectorized estimate of the memory
+            used by a batch, called with an array of batch sizes of shape
+            ``(W,)`` and the corresponding max sizes of shape ``(W, k)``
+            (default: None).
+        max_memory (float, optional): max value of *memory_fn* for a batch.
+
+    Returns:
+        List[np.ndarray]: batches of indices
+    """
+    assert (memory_fn is None) == (max_memory is None), \
+        'memory_fn and max_memory must be given together'
+    indices = np.asarray(indices, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if sizes.ndim == 1:
+        sizes = sizes.reshape(-1, 1)
+    if len(indices) == 0:
+        return []
+
+    # longest examples first, ties sorted by the other columns
+    batch_sizes = sizes[indices]
+    sort_order = np.lexsort(
+        [-batch_sizes[:, j] for j in reversed(range(batch_sizes.shape[1]))]
+        + [-batch_sizes.max(axis=1)]
+    )
+    indices, batch_sizes = indices[sort_order], batch_sizes[sort_order]
+
+    bsz_mult = required_batch_size_multiple
+    limits = (max_tokens, max_sentences, max_attention_tokens, memory_fn, max_memory)
+    batches, offsets = [], [0]
+    start, n = 0, len(indices)
+    while start < n:
+        # the first example is in the batch, which bounds the batch size
+        window = n - start
+        if max_sentences is not None:
+            window = min(window, max_sentences)
+        if max_tokens is not None:
+            window = min(window, max_tokens // max(1, batch_sizes[start].max()))
+        window = max(window, 1)
+        step = min(window, 1024)
+        while True:
+            num = _num_feasible(batch_sizes[start:start + step], *limits)
+            if num < step or step == window:
+                break
+            step = min(2 * step, window)
+        if num == 0:
+            raise ValueError(
+                'sentence at index {} of size {} exceeds the batch limits '
+                '(max_tokens={}, max_attention_tokens={}, max_memory={})'.format(
+                    indices[start], batch_sizes[start].tolist(), max_tokens,
+                    max_attention_tokens, max_memory,
+                )
+            )
+        if start + num < n:
+            num = max(bsz_mult * (num // bsz_mult), num % bsz_mult)
+        batches.append(indices[start:start + num])
+        start += num
+        offsets.append(start)
+
+    # log how much of the padded batches is actual data
+    offsets = np.array(offsets[:-1])
+    padded = (
+        np.diff(np.append(offsets, n))[:, None]
+        * np.maximum.reduceat(batch_sizes, offsets, axis=0)
+    ).sum(axis=0)
+    efficiency = batch_sizes.sum(axis=0) / np.maximum(padded, 1)
+    logger.info('packed {} examples into {} batches, padding efficiency: {}'.format(
+        n, len(batches), ', '.join('{:.1%}'.format(e) for e in efficiency),
+    ))
+    return batches
+
+
 def post_process(sentence: str, symbol: str):
     if symbol == "sentencepiece":
         sentence = sentence.replace(" ", "").replace("\u2581", " ").strip()
@@ -120,3 +120,40 @@ cpdef list batch_fixed_shapes_fast(
         batches.append(batch)
 
     return batches
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void collate_tokens_fast(
+    list values,
+    DTYPE_t[:, :] out,
+    DTYPE_t pad_idx,
+    DTYPE_t eos_idx,
+    bint left_pad,
+    bint move_eos_to_beginning,
+):
+    """Fill each row of *out* with the matching sequence of *values* and pad
+    the rest of the row, in a single pass. If *move_eos_to_beginning* and
+    *eos_idx* is negative, the last token of each sequence is moved."""
+    cdef const DTYPE_t[:] v
+    cdef long i, j, n, start
+    cdef long size = out.shape[1]
+
+    for i in range(len(values)):
+        v = values[i]
+        n = v.shape[0]
+        start = size - n if left_pad else 0
+        with nogil:
+            for j in range(start):
+                out[i, j] = pad_idx
+            for j in range(start + n, size):
+                out[i, j] = pad_idx
+            if n == 0:
+                continue
+            if move_eos_to_beginning:
+                out[i, start] = eos_idx if eos_idx >= 0 else v[n - 1]
+                for j in range(n - 1):
+                    out[i, start + j + 1] = v[j]
+            else:
+                for j in range(n):
+                    out[i, start + j] = v[j]
@@ -3,10 +3,16 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
+import json
+import operator
 import os
+import struct
+import zlib
 from collections import Counter
 from multiprocessing import Pool
 
+import numpy as np
 import torch
 from fairseq import utils
 from fairseq.binarizer import safe_readline
@@ -58,9 +64,7 @@ class Dictionary(object):
     def index(self, sym):
         """Returns the index of the specified symbol"""
         assert isinstance(sym, str)
-        if sym in self.indices:
-            return self.indices[sym]
-        return self.unk_index
+        return self.indices.get(sym, self.unk_index)
 
     def string(
         self,
@@ -76,8 +80,7 @@ class Dictionary(object):
         """
         if torch.is_tensor(tensor) and tensor.dim() == 2:
             return "\n".join(
-                self.string(t, bpe_symbol, escape_unk, extra_symbols_to_ignore)
-                for t in tensor
+                self.string_batch(tensor, bpe_symbol, escape_unk, extra_symbols_to_ignore)
             )
 
         extra_symbols_to_ignore = set(extra_symbols_to_ignore or [])
@@ -103,6 +106,46 @@ class Dictionary(object):
 
         return data_utils.post_process(sent, bpe_symbol)
 
+    def string_batch(
+        self,
+        tensors,
+        bpe_symbol=None,
+        escape_unk=False,
+        extra_symbols_to_ignore=None,
+        unk_string=None,
+    ):
+        """Converts a batch of token index sequences (a 2-D tensor or a list
+        of 1-D tensors) to a list of strings, like calling :func:`string` on
+        each sequence. Each distinct symbol is only looked up once."""
+        rows = [
+            t.cpu().numpy().reshape(-1) if torch.is_tensor(t) else np.asarray(t).reshape(-1)
+            for t in tensors
+        ]
+        if len(rows) == 0:
+            return []
+        lengths = [len(row) for row in rows]
+        flat = np.concatenate(rows).astype(np.int64, copy=False)
+
+        ignore = set(extra_symbols_to_ignore or [])
+        ignore.add(self.eos())
+        if hasattr(self, "bos_index"):
+            ignore.add(self.bos())
+        keep = ~np.isin(flat, list(ignore))
+
+        uniq, inverse = np.unique(flat, return_inverse=True)
+        if unk_string is None:
+            unk_string = self.unk_string(escape_unk)
+        words = [unk_string if i == self.unk() else self[i] for i in uniq.tolist()]
+        words = np.array(words, dtype=object)[inverse]
+
+        sents = []
+        start = 0
+        for n in lengths:
+            sent = " ".join(words[start:start + n][keep[start:start + n]])
+            sents.append(data_utils.post_process(sent, bpe_symbol))
+            start += n
+        return sents
+
     def unk_string(self, escape=False):
         """Return unknown string, optionally escaped as: <<unk>>"""
         if escape:
@@ -136,6 +179,17 @@ class Dictionary(object):
                 self.symbols.append(word)
                 self.count.append(new_dict.count[idx2])
 
+    def add_counts(self, counter):
+        """Add the counts of a mapping from symbols to counts, appending new
+        symbols in alphabetical order."""
+        counter = dict(counter)
+        for w in sorted(counter.keys() & self.indices.keys()):
+            self.count[self.indices[w]] += counter.pop(w)
+        words = sorted(counter)
+        self.indices.update(zip(words, range(len(self.symbols), len(self.symbols) + len(words))))
+        self.symbols.extend(words)
+        self.count.extend(map(counter.__getitem__, words))
+
     def finalize(self, threshold=-1, nwords=-1, padding_factor=8):
         """Sort symbols by frequency in descending order, ignoring special ones.
 
@@ -154,18 +208,24 @@ class Dictionary(object):
         new_symbols = self.symbols[: self.nspecial]
         new_count = self.count[: self.nspecial]
 
-        c = Counter(
-            dict(
-                sorted(zip(self.symbols[self.nspecial :], self.count[self.nspecial :]))
-            )
-        )
-        for symbol, count in c.most_common(nwords - self.nspecial):
-            if count >= threshold:
-                new_indices[symbol] = len(new_symbols)
-                new_symbols.append(symbol)
-                new_count.append(count)
-            else:
-                break
+        symbols = self.symbols[self.nspecial :]
+        count = self.count[self.nspecial :]
+        if len(self.indices) < len(self.symbols):
+            # merge the symbols added several times (e.g., with
+            # #fairseq:overwrite), keeping their largest count
+            merged = dict(sorted(zip(symbols, count)))
+            symbols, count = list(merged.keys()), list(merged.values())
+
+        # most frequent first, ties broken alphabetically
+        count = np.array(count, dtype=np.int64)
+        order = np.array(sorted(range(len(symbols)), key=symbols.__getitem__), dtype=np.int64)
+        order = order[np.argsort(-count[order], kind="stable")]
+        order = order[: max(nwords - self.nspecial, 0)]
+        order = order[count[order] >= threshold]
+        for i in order.tolist():
+            new_indices[symbols[i]] = len(new_symbols)
+            new_symbols.append(symbols[i])
+            new_count.append(int(count[i]))
 
         assert len(new_symbols) == len(new_indices)
 
@@ -210,10 +270,38 @@ class Dictionary(object):
         ...
         ```
         """
+        if isinstance(f, str) and is_compiled_dictionary(f):
+            return cls.load_compiled(f)
         d = cls()
         d.add_from_file(f)
         return d
 
+    @classmethod
+    def load_compiled(cls, path):
+        """Loads a dictionary written by :func:`save_compiled`.
+
+        The symbols, counts and a hash index of the symbols are memory-mapped
+        from *path*, so loading takes constant time and the data is shared
+        between processes. The dictionary can still be modified, changes are
+        kept in memory.
+        """
+        table = _CompiledSymbolTable(PathManager.get_local_path(path))
+        d = cls()
+        d.__dict__.update(table.meta)
+        d.symbols = _CompiledSymbols(table)
+        d.count = _CompiledCounts(table)
+        d.indices = _CompiledIndices(table)
+        return d
+
+    def save_compiled(self, path):
+        """Stores the dictionary in a binary format that can be memory-mapped
+        by :func:`load_compiled`. Special symbols are included."""
+        meta = {
+            k: v for k, v in self.__dict__.items()
+            if k == "nspecial" or k.endswith(("_word", "_index"))
+        }
+        _CompiledSymbolTable.write(path, self.symbols, self.count, self.indices, meta)
+
     def add_from_file(self, f):
         """
         Loads a pre-existing dictionary from a text file and adds its symbols
@@ -317,6 +405,41 @@ class Dictionary(object):
             ids[nwords] = self.eos_index
         return ids
 
+    def encode_lines(
+        self,
+        lines,
+        line_tokenizer=tokenize_line,
+        add_if_not_exist=True,
+        consumer=None,
+        append_eos=True,
+        reverse_order=False,
+    ):
+        """Encodes a batch of lines, like calling :func:`encode_line` on each
+        line. Each distinct word is only looked up once."""
+        if add_if_not_exist or consumer is not None:
+            return [
+                self.encode_line(
+                    line, line_tokenizer, add_if_not_exist, consumer, append_eos, reverse_order,
+                )
+                for line in lines
+            ]
+        if len(lines) == 0:
+            return []
+        words = [line_tokenizer(line) for line in lines]
+        if reverse_order:
+            words = [list(reversed(w)) for w in words]
+        vocab = {w: self.index(w) for w in set(itertools.chain.from_iterable(words))}
+        lengths = np.array([len(w) + int(append_eos) for w in words], dtype=np.int64)
+
+        def ids():
+            for w in words:
+                yield from map(vocab.__getitem__, w)
+                if append_eos:
+                    yield self.eos_index
+
+        flat = np.fromiter(ids(), dtype=np.int32, count=lengths.sum())
+        return [torch.from_numpy(a) for a in np.split(flat, np.cumsum(lengths)[:-1])]
+
     @staticmethod
     def _add_file_to_dictionary_single_worker(
         filename, tokenize, eos_word, worker_id=0, num_workers=1
@@ -330,22 +453,20 @@ class Dictionary(object):
             f.seek(offset)
             if offset > 0:
                 safe_readline(f)  # drop first incomplete line
+            num_lines = 0
             line = f.readline()
             while line:
-                for word in tokenize(line):
-                    counter.update([word])
-                counter.update([eos_word])
+                counter.update(tokenize(line))
+                num_lines += 1
                 if f.tell() > end:
                     break
                 line = f.readline()
+        if num_lines > 0:
+            counter[eos_word] += num_lines
         return counter
 
     @staticmethod
     def add_file_to_dictionary(filename, dict, tokenize, num_workers):
-        def merge_result(counter):
-            for w, c in sorted(counter.items()):
-                dict.add_symbol(w, c)
-
         if num_workers > 1:
             pool = Pool(processes=num_workers)
             results = []
@@ -358,10 +479,12 @@ class Dictionary(object):
                 )
             pool.close()
             pool.join()
+            counter = Counter()
             for r in results:
-                merge_result(r.get())
+                counter.update(r.get())
+            dict.add_counts(counter)
         else:
-            merge_result(
+            dict.add_counts(
                 Dictionary._add_file_to_dictionary_single_worker(
                     filename, tokenize, dict.eos_word
                 )
@@ -386,3 +509,223 @@ class TruncatedDictionary(object):
         if i < self.length:
             return self.wrapped_dict[i]
         return self.wrapped_dict.unk()
+
+
+def is_compiled_dictionary(path):
+    """Whether *path* is a dictionary written by
+    :func:`Dictionary.save_compiled`."""
+    try:
+        with PathManager.open(path, "rb") as f:
+            return f.read(len(_CompiledSymbolTable._HDR_MAGIC)) == _CompiledSymbolTable._HDR_MAGIC
+    except (OSError, UnicodeError):
+        return False
+
+
+class _CompiledSymbolTable(object):
+    """Read-only symbols, counts and an open-addressing hash index of the
+    symbols, memory-mapped from a file.
+
+    Layout: header, JSON metadata, symbol offsets (int64), counts (int64),
+    hash table of symbol indices (int32, -1 for empty slots) and the UTF-8
+    encoded symbols.
+    """
+
+    _HDR_MAGIC = b"FSDICT\x00\x00\x00"
+    _HDR = struct.Struct("<QQQQQ")  # version, #symbols, #slots, #blob bytes, #meta bytes
+
+    @staticmethod
+    def _hash(b):
+        return zlib.crc32(b)
+
+    @classmethod
+    def write(cls, path, symbols, counts, indices, meta):
+        encoded = [sym.encode("utf-8") for sym in symbols]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        num_slots = 1
+        while num_slots < 2 * len(indices):
+            num_slots *= 2
+        table = np.full(num_slots, -1, dtype=np.int32)
+        for sym, idx in indices.items():
+            h = cls._hash(sym.encode("utf-8")) & (num_slots - 1)
+            while table[h] != -1:
+                h = (h + 1) & (num_slots - 1)
+            table[h] = idx
+        meta = json.dumps(meta).encode("utf-8")
+        meta += b" " * (-len(meta) % 8)
+
+        with PathManager.open(path, "wb") as f:
+            f.write(cls._HDR_MAGIC)
+            f.write(cls._HDR.pack(1, len(encoded), num_slots, offsets[-1], len(meta)))
+            f.write(meta)
+            f.write(offsets.tobytes())
+            f.write(np.array(counts, dtype=np.int64).tobytes())
+            f.write(table.tobytes())
+            f.write(b"".join(encoded))
+
+    def __init__(self, path):
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic = f.read(len(self._HDR_MAGIC))
+            assert magic == self._HDR_MAGIC, "{} is not a compiled dictionary".format(path)
+            version, n, num_slots, blob_len, meta_len = self._HDR.unpack(f.read(self._HDR.size))
+            assert version == 1
+            self.meta = json.loads(f.read(meta_len).decode("utf-8"))
+            offset = f.tell()
+
+        self._mmap = np.memmap(path, mode="r", order="C")
+        buffer = memoryview(self._mmap)
+
+        def view(fmt, nbytes):
+            nonlocal offset
+            v = buffer[offset:offset + nbytes]
+            offset += nbytes
+            return v.cast(fmt) if fmt != "B" else v
+
+        self._len = n
+        self._mask = num_slots - 1
+        self._offsets = view("q", 8 * (n + 1))
+        self.counts = np.frombuffer(view("q", 8 * n), dtype=np.int64)
+        self._table = view("i", 4 * num_slots)
+        self._blob = view("B", blob_len)
+
+    def __len__(self):
+        return self._len
+
+    def symbol(self, i):
+        return str(self._blob[self._offsets[i]:self._offsets[i + 1]], "utf-8")
+
+    def find(self, sym):
+        """Returns the index of *sym*, or -1 if it is not in the table."""
+        b = sym.encode("utf-8")
+        h = self._hash(b) & self._mask
+        while True:
+            idx = self._table[h]
+            if idx < 0 or self._blob[self._offsets[idx]:self._offsets[idx + 1]] == b:
+                return idx
+            h = (h + 1) & self._mask
+
+
+class _CompiledList(object):
+    """List-like view of a compiled dictionary column. Appended and
+    overwritten entries are kept in memory."""
+
+    def __init__(self, table):
+        self._table = table
+        self._changed = {}
+        self._extra = []
+
+    def _get(self, i):
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self._table) + len(self._extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if i < 0:
+            raise IndexError("list index out of range")
+        if i >= len(self._table):
+            return self._extra[i - len(self._table)]
+        if i in self._changed:
+            return self._changed[i]
+        return self._get(i)
+
+    def __setitem__(self, i, value):
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if i < 0:
+            raise IndexError("list assignment index out of range")
+        if i >= len(self._table):
+            self._extra[i - len(self._table)] = value
+        else:
+            self._changed[i] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def append(self, value):
+        self._extra.append(value)
+
+
+class _CompiledSymbols(_CompiledList):
+
+    def _get(self, i):
+        return self._table.symbol(i)
+
+    def __contains__(self, sym):
+        return self._table.find(sym) >= 0 or sym in self._extra or sym in self._changed.values()
+
+
+class _CompiledCounts(_CompiledList):
+
+    def _get(self, i):
+        return int(self._table.counts[i])
+
+
+class _CompiledIndices(object):
+    """Dict-like view of the symbol to index mapping of a compiled
+    dictionary. Added symbols are kept in memory."""
+
+    def __init__(self, table):
+        self._table = table
+        self._extra = {}
+
+    def get(self, sym, default=None):
+        idx = self._extra.get(sym)
+        if idx is not None:
+            return idx
+        idx = self._table.find(sym)
+        return idx if idx >= 0 else default
+
+    def __getitem__(self, sym):
+        idx = self.get(sym)
+        if idx is None:
+            raise KeyError(sym)
+        return idx
+
+    def __setitem__(self, sym, idx):
+        self._extra[sym] = idx
+
+    def __contains__(self, sym):
+        return self.get(sym) is not None
+
+    def __len__(self):
+        return len(self._table) + sum(1 for sym in self._extra if self._table.find(sym) < 0)
+
+    def items(self):
+        for i in range(len(self._table)):
+            sym = self._table.symbol(i)
+            if sym not in self._extra and self._table.find(sym) == i:
+                yield sym, i
+        yield from self._extra.items()
+
+    def keys(self):
+        return (sym for sym, _ in self.items())
+
+    def values(self):
+        return (idx for _, idx in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
@@ -6,7 +6,9 @@ Original license: MIT
 """
 
 from functools import lru_cache
+import heapq
 import json
+from multiprocessing import Pool
 
 
 @lru_cache()
@@ -44,14 +46,23 @@ def get_pairs(word):
 
 class Encoder:
 
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=2 ** 17):
         self.encoder = encoder
         self.decoder = {v:k for k,v in self.encoder.items()}
         self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache_size = cache_size
+
+        # symbols are represented by integer ids, merges by a table from
+        # pairs of ids to (rank, id of the merged symbol)
+        self.symbols = list(self.byte_encoder.values())
+        self.symbol_ids = {sym: i for i, sym in enumerate(self.symbols)}
+        self.merges = {}
+        for rank, (first, second) in enumerate(bpe_merges):
+            pair = (self._symbol_id(first), self._symbol_id(second))
+            self.merges[pair] = (rank, self._symbol_id(first + second))
 
         try:
             import regex as re
@@ -61,61 +72,124 @@ class Encoder:
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = self.re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        self._init_cache()
+
+    def _symbol_id(self, symbol):
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self.symbol_ids[symbol]
+
+    def _init_cache(self):
+        # bounded cache from pre-tokens to token ids
+        self._encode_token = lru_cache(maxsize=self.cache_size)(self._encode_token_uncached)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_encode_token'], state['re'], state['pat']
+        return state
+
+    def __setstate__(self, state):
+        import regex as re
+        self.__dict__.update(state)
+        self.re = re
+        self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        self._init_cache()
+
+    def cache_info(self):
+        """Hits, misses, maximum and current size of the token cache."""
+        return self._encode_token.cache_info()
+
+    def _merge(self, ids):
+        """Apply the merges to a list of symbol ids.
+
+        Candidate pairs are kept in a heap ordered by rank and position. As
+        in the reference implementation, all occurrences of the best pair are
+        merged from left to right before the pairs they create are considered.
+        """
+        n = len(ids)
+        if n < 2:
+            return ids
+        merges = self.merges
+        nxt = list(range(1, n + 1))
+        prv = list(range(-1, n - 1))
+        heap = []
+        for i in range(n - 1):
+            m = merges.get((ids[i], ids[i + 1]))
+            if m is not None:
+                heap.append((m[0], i, ids[i], ids[i + 1], m[1]))
+        heapq.heapify(heap)
+        created = []
+        while heap:
+            rank = heap[0][0]
+            while heap and heap[0][0] == rank:
+                _, i, first, second, merged = heapq.heappop(heap)
+                j = nxt[i]
+                if ids[i] != first or j >= n or ids[j] != second:
+                    continue  # stale
+                ids[i] = merged
+                ids[j] = None
+                nxt[i] = nxt[j]
+                if nxt[i] < n:
+                    prv[nxt[i]] = i
+                created.append(i)
+            for i in created:
+                if ids[i] is None:
+                    continue
+                if prv[i] >= 0:
+                    m = merges.get((ids[prv[i]], ids[i]))
+                    if m is not None:
+                        heapq.heappush(heap, (m[0], prv[i], ids[prv[i]], ids[i], m[1]))
+                if nxt[i] < n:
+                    m = merges.get((ids[i], ids[nxt[i]]))
+                    if m is not None:
+                        heapq.heappush(heap, (m[0], i, ids[i], ids[nxt[i]], m[1]))
+            created.clear()
+        return [i for i in ids if i is not None]
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
+        word = [self._symbol_id(c) for c in token]
+        if len(word) < 2:
             return token
+        return ' '.join(self.symbols[i] for i in self._merge(word))
 
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        return word
+    def _encode_token_uncached(self, token):
+        word = [self.symbol_ids[self.byte_encoder[b]] for b in token.encode('utf-8')]
+        return tuple(self.encoder[self.symbols[i]] for i in self._merge(word))
 
     def encode(self, text):
         bpe_tokens = []
         for token in self.re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+            bpe_tokens.extend(self._encode_token(token))
         return bpe_tokens
 
+    def encode_batch(self, texts, num_workers=1, chunksize=64):
+        """Encode a list of texts, in *num_workers* processes if greater
+        than 1."""
+        if num_workers <= 1:
+            return [self.encode(text) for text in texts]
+        with Pool(num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            return pool.map(_encode_in_worker, texts, chunksize=chunksize)
+
     def decode(self, tokens):
         text = ''.join([self.decoder.get(token, token) for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
         return text
 
-def get_encoder(encoder_json_path, vocab_bpe_path):
+
+_worker_encoder = None
+
+
+def _init_worker(encoder):
+    global _worker_encoder
+    _worker_encoder = encoder
+
+
+def _encode_in_worker(text):
+    return _worker_encoder.encode(text)
+
+
+def get_encoder(encoder_json_path, vocab_bpe_path, cache_size=2 ** 17):
     with open(encoder_json_path, 'r') as f:
         encoder = json.load(f)
     with open(vocab_bpe_path, 'r', encoding="utf-8") as f:
@@ -124,4 +198,5 @@ def get_encoder(encoder_json_path, vocab_bpe_path):
     return Encoder(
         encoder=encoder,
         bpe_merges=bpe_merges,
+        cache_size=cache_size,
     )
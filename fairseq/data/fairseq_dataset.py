@@ -45,6 +45,14 @@ class FairseqDataset(torch.utils.data.Dataset, EpochListening):
         filtering a dataset with ``--max-positions``."""
         raise NotImplementedError
 
+    def sizes_array(self):
+        """Return the sizes of all examples as an array of shape
+        ``(len(self), k)``, where row *i* holds the value of :func:`size` for
+        example *i*. This is used to filter a dataset with ``--max-positions``
+        without calling :func:`size` once per example. Returns ``None`` if the
+        sizes cannot be computed in bulk."""
+        return None
+
     def ordered_indices(self):
         """Return an ordered list of indices. Batches will be constructed based
         on this order."""
@@ -85,14 +93,36 @@ class FairseqDataset(torch.utils.data.Dataset, EpochListening):
         max_tokens=None,
         max_sentences=None,
         required_batch_size_multiple=1,
+        batch_planner='greedy',
+        max_attention_tokens=None,
     ):
         """
         Given an ordered set of indices, return batches according to
         *max_tokens*, *max_sentences* and *required_batch_size_multiple*.
+
+        With ``batch_planner='padded_cost'``, batches are packed by
+        :func:`~fairseq.data.data_utils.batch_by_padded_cost` over
+        :func:`sizes_array`, which also bounds *max_attention_tokens*.
         """
         from fairseq.data import data_utils
 
         fixed_shapes = self.get_batch_shapes()
+        if batch_planner == 'padded_cost' and fixed_shapes is None:
+            sizes = self.sizes_array()
+            if sizes is None:
+                sizes = np.zeros(len(self), dtype=np.int64)
+                sizes[indices] = [self.num_tokens(i) for i in indices]
+            return data_utils.batch_by_padded_cost(
+                indices,
+                sizes,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+                max_attention_tokens=max_attention_tokens,
+            )
+        elif batch_planner not in ('greedy', 'padded_cost'):
+            raise ValueError('unknown batch planner: {}'.format(batch_planner))
+
         if fixed_shapes is not None:
 
             def adjust_bsz(bsz, num_tokens):
@@ -3,10 +3,14 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+import logging
 import os
 import shutil
 import struct
+import zlib
 
 import numpy as np
 import torch
@@ -14,6 +18,9 @@ import torch
 from . import FairseqDataset
 
 
+logger = logging.getLogger(__name__)
+
+
 def __best_fitting_dtype(vocab_size=None):
     if vocab_size is not None and vocab_size < 65500:
         return np.uint16
@@ -22,7 +29,7 @@ def __best_fitting_dtype(vocab_size=None):
 
 
 def get_available_dataset_impl():
-    return ['raw', 'lazy', 'cached', 'mmap']
+    return ['raw', 'lazy', 'cached', 'mmap', 'compressed']
 
 
 def infer_dataset_impl(path):
@@ -35,8 +42,12 @@ def infer_dataset_impl(path):
                 return 'cached'
             elif magic == MMapIndexedDataset.Index._HDR_MAGIC[:8]:
                 return 'mmap'
+            elif magic == CompressedIndexedDataset.Index._HDR_MAGIC[:8]:
+                return 'compressed'
             else:
                 return None
+    elif ShardedMMapIndexedDataset.exists(path):
+        return 'mmap'
     else:
         return None
 
@@ -44,6 +55,8 @@ def infer_dataset_impl(path):
 def make_builder(out_file, impl, vocab_size=None):
     if impl == 'mmap':
         return MMapIndexedDatasetBuilder(out_file, dtype=__best_fitting_dtype(vocab_size))
+    elif impl == 'compressed':
+        return CompressedIndexedDatasetBuilder(out_file, dtype=__best_fitting_dtype(vocab_size))
     else:
         return IndexedDatasetBuilder(out_file)
 
@@ -58,6 +71,10 @@ def make_dataset(path, impl, fix_lua_indexing=False, dictionary=None):
         return IndexedCachedDataset(path, fix_lua_indexing=fix_lua_indexing)
     elif impl == 'mmap' and MMapIndexedDataset.exists(path):
         return MMapIndexedDataset(path)
+    elif impl == 'mmap' and ShardedMMapIndexedDataset.exists(path):
+        return ShardedMMapIndexedDataset(path)
+    elif impl == 'compressed' and CompressedIndexedDataset.exists(path):
+        return CompressedIndexedDataset(path)
     return None
 
 
@@ -65,7 +82,9 @@ def dataset_exists(path, impl):
     if impl == 'raw':
         return IndexedRawTextDataset.exists(path)
     elif impl == 'mmap':
-        return MMapIndexedDataset.exists(path)
+        return MMapIndexedDataset.exists(path) or ShardedMMapIndexedDataset.exists(path)
+    elif impl == 'compressed':
+        return CompressedIndexedDataset.exists(path)
     else:
         return IndexedDataset.exists(path)
 
@@ -107,6 +126,10 @@ def data_file_path(prefix_path):
     return prefix_path + '.bin'
 
 
+def manifest_file_path(prefix_path):
+    return prefix_path + '.manifest'
+
+
 class IndexedDataset(FairseqDataset):
     """Loader for TorchNet IndexedDataset"""
     _HDR_MAGIC = b'TNTIDX\x00\x00'
@@ -168,6 +191,9 @@ class IndexedDataset(FairseqDataset):
     def size(self, index):
         return self.sizes[index]
 
+    def sizes_array(self):
+        return self.sizes[:len(self)].reshape(-1, 1)
+
     @staticmethod
     def exists(path):
         return (
@@ -227,49 +253,143 @@ class IndexedCachedDataset(IndexedDataset):
         return item
 
 
+def _find_line_starts(data, chunk_size=1 << 26):
+    """Returns the byte offsets of all lines in *data*, followed by its
+    length. Lines are terminated by ``\\n``, ``\\r\\n`` or ``\\r``."""
+    n = len(data)
+    starts = [np.zeros(1, dtype=np.int64)]
+    for pos in range(0, n, chunk_size):
+        chunk = data[pos:pos + chunk_size]
+        breaks = np.flatnonzero(chunk == ord('\n'))
+        cr = np.flatnonzero(chunk == ord('\r'))
+        if len(cr) > 0:
+            # a \r only ends a line if it is not followed by \n
+            nxt = cr + pos + 1
+            lone = (nxt >= n) | (data[np.minimum(nxt, n - 1)] != ord('\n'))
+            breaks = np.union1d(breaks, cr[lone])
+        starts.append(breaks.astype(np.int64) + pos + 1)
+    starts = np.concatenate(starts)
+    if starts[-1] != n:
+        # last line without trailing newline
+        starts = np.append(starts, n)
+    return starts
+
+
+def raw_index_file_path(path):
+    return path + '.rawidx'
+
+
 class IndexedRawTextDataset(FairseqDataset):
-    """Takes a text file as input and binarizes it in memory at instantiation.
-    Original lines are also kept in memory"""
+    """Takes a text file as input and binarizes lines on demand.
+
+    At instantiation, only the byte offsets and the number of tokens of each
+    line are computed, using a vectorized scan for newlines. They are cached
+    next to the text file (see :func:`raw_index_file_path`) and reused as
+    long as the text file does not change.
+    """
+
+    _HDR_MAGIC = b'RAWIDX\x00\x00\x00'
 
     def __init__(self, path, dictionary, append_eos=True, reverse_order=False):
-        self.tokens_list = []
-        self.lines = []
-        self.sizes = []
+        self.dictionary = dictionary
         self.append_eos = append_eos
         self.reverse_order = reverse_order
-        self.read_data(path, dictionary)
-        self.size = len(self.tokens_list)
-
-    def read_data(self, path, dictionary):
-        with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                self.lines.append(line.strip('\n'))
-                tokens = dictionary.encode_line(
-                    line, add_if_not_exist=False,
-                    append_eos=self.append_eos, reverse_order=self.reverse_order,
-                ).long()
-                self.tokens_list.append(tokens)
-                self.sizes.append(len(tokens))
-        self.sizes = np.array(self.sizes)
+        self._do_init(path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_data', '_index_mmap', '_offsets', '_token_counts', 'sizes']:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._do_init(self.path)
+
+    def _do_init(self, path):
+        self.path = path
+        if os.path.getsize(path) > 0:
+            self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self._data = np.empty(0, dtype=np.uint8)
+        self._index_mmap = None
+        if not self._load_index():
+            self._build_index()
+        self.sizes = self._token_counts.astype(np.int64) + int(self.append_eos)
+        self._len = len(self.sizes)
+
+    def _file_stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load_index(self):
+        index_path = raw_index_file_path(self.path)
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path, 'rb') as stream:
+            header = stream.read(len(self._HDR_MAGIC) + 32)
+        if len(header) < len(self._HDR_MAGIC) + 32 or not header.startswith(self._HDR_MAGIC):
+            return False
+        version, file_size, mtime_ns, count = struct.unpack(
+            '<QQQQ', header[len(self._HDR_MAGIC):]
+        )
+        if version != 1 or (file_size, mtime_ns) != self._file_stamp():
+            return False
+        self._index_mmap = np.memmap(index_path, mode='r', order='C')
+        buffer = memoryview(self._index_mmap)
+        self._offsets = np.frombuffer(buffer, dtype=np.int64, count=count + 1, offset=len(header))
+        self._token_counts = np.frombuffer(
+            buffer, dtype=np.int32, count=count, offset=len(header) + self._offsets.nbytes
+        )
+        return True
+
+    def _build_index(self):
+        stamp = self._file_stamp()
+        self._offsets = _find_line_starts(self._data)
+        self._token_counts = np.fromiter(
+            (len(self._read_line(i).split()) for i in range(len(self._offsets) - 1)),
+            dtype=np.int32, count=len(self._offsets) - 1,
+        )
+        index_path = raw_index_file_path(self.path)
+        tmp_path = index_path + '.tmp{}'.format(os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._HDR_MAGIC)
+                f.write(struct.pack('<QQQQ', 1, *stamp, len(self._token_counts)))
+                f.write(self._offsets.tobytes(order='C'))
+                f.write(self._token_counts.tobytes(order='C'))
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            logger.warning('could not cache line index for {}: {}'.format(self.path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read_line(self, i):
+        line = self._data[self._offsets[i]:self._offsets[i + 1]].tobytes()
+        if line.endswith(b'\r\n'):
+            line = line[:-2]
+        elif line.endswith((b'\n', b'\r')):
+            line = line[:-1]
+        return line.decode('utf-8')
 
     def check_index(self, i):
-        if i < 0 or i >= self.size:
+        if i < 0 or i >= self._len:
             raise IndexError('index out of range')
 
     @lru_cache(maxsize=8)
     def __getitem__(self, i):
         self.check_index(i)
-        return self.tokens_list[i]
+        return self.dictionary.encode_line(
+            self._read_line(i), add_if_not_exist=False,
+            append_eos=self.append_eos, reverse_order=self.reverse_order,
+        ).long()
 
     def get_original_text(self, i):
         self.check_index(i)
-        return self.lines[i]
-
-    def __del__(self):
-        pass
+        return self._read_line(i)
 
     def __len__(self):
-        return self.size
+        return self._len
 
     def num_tokens(self, index):
         return self.sizes[index]
@@ -277,6 +397,9 @@ class IndexedRawTextDataset(FairseqDataset):
     def size(self, index):
         return self.sizes[index]
 
+    def sizes_array(self):
+        return self.sizes.reshape(-1, 1)
+
     @staticmethod
     def exists(path):
         return os.path.exists(path)
@@ -309,6 +432,16 @@ class IndexedDatasetBuilder(object):
             self.sizes.append(s)
         self.dim_offsets.append(self.dim_offsets[-1] + len(tensor.size()))
 
+    def add_items(self, np_array, sizes):
+        """Adds len(sizes) 1-D items stored back to back in *np_array*."""
+        # +1 for Lua compatibility
+        self.out_file.write(np.array(np_array + 1, dtype=self.dtype))
+        begin = self.data_offsets[-1]
+        self.data_offsets.extend((begin + np.cumsum(sizes)).tolist())
+        self.sizes.extend(sizes.tolist())
+        begin = self.dim_offsets[-1]
+        self.dim_offsets.extend(range(begin + 1, begin + len(sizes) + 1))
+
     def merge_file_(self, another_file):
         index = IndexedDataset(another_file)
         assert index.dtype == self.dtype
@@ -342,6 +475,25 @@ class IndexedDatasetBuilder(object):
         index.close()
 
 
+def _copy_file_into(path, fd, offset, chunk_size=64 * 1024 * 1024):
+    """Copies the file at *path* into the open file *fd* starting at *offset*."""
+    with open(path, 'rb') as f:
+        src = f.fileno()
+        pos, remaining = 0, os.fstat(src).st_size
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        while remaining > 0:
+            n = 0
+            if use_copy_file_range:
+                try:
+                    n = os.copy_file_range(src, fd, remaining, pos, offset + pos)
+                except OSError:
+                    use_copy_file_range = False
+            if n == 0:
+                n = os.pwrite(fd, os.pread(src, min(chunk_size, remaining), pos), offset + pos)
+            pos += n
+            remaining -= n
+
+
 def _warmup_mmap_file(path):
     with open(path, 'rb') as stream:
         while stream.read(100 * 1024 * 1024):
@@ -367,12 +519,9 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    np.cumsum(np.array(sizes[:-1], dtype=np.int64), out=pointers[1:])
+                    pointers *= dtype_size
 
                     return pointers
 
@@ -478,6 +627,18 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
         return torch.from_numpy(np_array)
 
+    def get_range(self, start_idx, start_offset, length):
+        """Returns *length* tokens starting at position *start_offset* of item
+        *start_idx* and continuing into the following items, as a read-only
+        numpy view of the memory-mapped data (no tokens are copied)."""
+        ptr, _ = self._index[start_idx]
+        offset = ptr + start_offset * self._index.dtype().itemsize
+        return np.frombuffer(self._bin_buffer, dtype=self._index.dtype, count=length, offset=offset)
+
+    def _tokens_from(self, start_idx, start_offset):
+        ptr, _ = self._index[start_idx]
+        return (self._bin_buffer.nbytes - ptr) // self._index.dtype().itemsize - start_offset
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -499,11 +660,35 @@ class MMapIndexedDatasetBuilder(object):
         self._dtype = dtype
         self._sizes = []
 
+    @classmethod
+    def append_to(cls, path):
+        """Opens the existing dataset at *path* to add more items to it.
+
+        New items are written at the end of the data file and
+        :func:`finalize` rewrites the index. Bytes past the end of the
+        indexed items (e.g., left by an interrupted append) are discarded.
+        """
+        index = MMapIndexedDataset.Index(index_file_path(path))
+        builder = cls.__new__(cls)
+        builder._dtype = index.dtype
+        builder._sizes = index.sizes.tolist()
+        end = int(index.sizes.sum(dtype=np.int64)) * index.dtype().itemsize
+        del index
+        builder._data_file = open(data_file_path(path), 'r+b')
+        builder._data_file.truncate(end)
+        builder._data_file.seek(end)
+        return builder
+
     def add_item(self, tensor):
         np_array = np.array(tensor.numpy(), dtype=self._dtype)
         self._data_file.write(np_array.tobytes(order='C'))
         self._sizes.append(np_array.size)
 
+    def add_items(self, np_array, sizes):
+        """Adds len(sizes) items stored back to back in the flat *np_array*."""
+        self._data_file.write(np.asarray(np_array, dtype=self._dtype).tobytes(order='C'))
+        self._sizes.extend(sizes.tolist())
+
     def merge_file_(self, another_file):
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
@@ -516,8 +701,470 @@ class MMapIndexedDatasetBuilder(object):
         with open(data_file_path(another_file), 'rb') as f:
             shutil.copyfileobj(f, self._data_file)
 
+    def merge_files_(self, other_files, num_threads=None):
+        """Appends several datasets at once.
+
+        The byte offset of every dataset in the output file is computed from
+        the indices up front, so the data files can be copied concurrently
+        into their preallocated regions. Copies go through
+        ``os.copy_file_range`` where available, which avoids moving the data
+        through user space (and shares blocks on filesystems with reflinks).
+        """
+        indices = [MMapIndexedDataset.Index(index_file_path(f)) for f in other_files]
+        for index in indices:
+            assert index.dtype == self._dtype
+
+        self._data_file.flush()
+        dtype_size = self._dtype().itemsize
+        offsets = [self._data_file.tell()]
+        for index in indices:
+            offsets.append(offsets[-1] + int(index.sizes.sum(dtype=np.int64)) * dtype_size)
+        fd = self._data_file.fileno()
+        os.ftruncate(fd, offsets[-1])
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [
+                executor.submit(_copy_file_into, data_file_path(f), fd, offset)
+                for f, offset in zip(other_files, offsets[:-1])
+            ]
+            for future in futures:
+                future.result()
+
+        for index in indices:
+            self._sizes.extend(index.sizes.tolist())
+        self._data_file.seek(offsets[-1])
+
     def finalize(self, index_file):
         self._data_file.close()
 
-        with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
+        # replace the index atomically, which matters when appending
+        tmp_file = index_file + '.tmp'
+        with MMapIndexedDataset.Index.writer(tmp_file, self._dtype) as index:
             index.write(self._sizes)
+        os.replace(tmp_file, index_file)
+
+
+class ShardedMMapIndexedDataset(torch.utils.data.Dataset):
+    """A :class:`MMapIndexedDataset` split over many ``.bin/.idx`` shards.
+
+    The shards are listed in a manifest file (see :func:`write_manifest`)
+    that also stores the cumulative item counts and the sizes of all items,
+    so opening the dataset only memory-maps the manifest. Shards are opened
+    on first access and at most *max_open_shards* of them are kept open.
+    """
+
+    class Manifest(object):
+        _HDR_MAGIC = b'MMIDMAN\x00\x00'
+
+        @classmethod
+        def write(cls, path, shard_paths):
+            """Writes a manifest for the datasets at *shard_paths*.
+
+            Shard paths are stored relative to the directory of *path*.
+            """
+            base_dir = os.path.dirname(os.path.abspath(path))
+            indices = [MMapIndexedDataset.Index(index_file_path(p)) for p in shard_paths]
+            dtypes_ = {index.dtype for index in indices}
+            assert len(dtypes_) == 1, 'all shards must have the same dtype'
+            offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum([len(index) for index in indices], out=offsets[1:])
+            names = '\n'.join(
+                os.path.relpath(os.path.abspath(p), base_dir) for p in shard_paths
+            ).encode('utf-8')
+
+            with open(path, 'wb') as f:
+                f.write(cls._HDR_MAGIC)
+                f.write(struct.pack('<Q', 1))
+                f.write(struct.pack('<B', code(dtypes_.pop())))
+                f.write(struct.pack('<QQ', len(indices), len(names)))
+                f.write(names)
+                f.write(offsets.tobytes(order='C'))
+                for index in indices:
+                    f.write(np.array(index.sizes, dtype=np.int32).tobytes(order='C'))
+
+        def __init__(self, path):
+            with open(path, 'rb') as stream:
+                magic_test = stream.read(9)
+                assert self._HDR_MAGIC == magic_test, (
+                    'Manifest file doesn\'t match expected format.'
+                )
+                version = struct.unpack('<Q', stream.read(8))
+                assert (1,) == version
+
+                dtype_code, = struct.unpack('<B', stream.read(1))
+                self._dtype = dtypes[dtype_code]
+                num_shards, names_len = struct.unpack('<QQ', stream.read(16))
+                base_dir = os.path.dirname(os.path.abspath(path))
+                self._shard_paths = [
+                    os.path.join(base_dir, name)
+                    for name in stream.read(names_len).decode('utf-8').split('\n')
+                ] if num_shards > 0 else []
+                self._offsets = read_longs(stream, num_shards + 1)
+                offset = stream.tell()
+
+            self._len = int(self._offsets[-1])
+            self._bin_buffer_mmap = np.memmap(path, mode='r', order='C')
+            self._bin_buffer = memoryview(self._bin_buffer_mmap)
+            self._sizes = np.frombuffer(
+                self._bin_buffer, dtype=np.int32, count=self._len, offset=offset
+            )
+
+        def __del__(self):
+            self._bin_buffer_mmap._mmap.close()
+            del self._bin_buffer_mmap
+
+        @property
+        def dtype(self):
+            return self._dtype
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        @property
+        def offsets(self):
+            return self._offsets
+
+        @property
+        def shard_paths(self):
+            return self._shard_paths
+
+        def locate(self, i):
+            """Maps global index *i* to a (shard, local index) pair."""
+            shard = int(np.searchsorted(self._offsets, i, side='right')) - 1
+            return shard, i - int(self._offsets[shard])
+
+        def __len__(self):
+            return self._len
+
+    def __init__(self, path, max_open_shards=64):
+        super().__init__()
+        self._do_init(path, max_open_shards)
+
+    def __getstate__(self):
+        return self._path, self._max_open_shards
+
+    def __setstate__(self, state):
+        self._do_init(*state)
+
+    def _do_init(self, path, max_open_shards):
+        self._path = path
+        self._max_open_shards = max_open_shards
+        self._manifest = self.Manifest(manifest_file_path(path))
+        self._shards = OrderedDict()
+
+    def _get_shard(self, shard):
+        ds = self._shards.get(shard)
+        if ds is not None:
+            self._shards.move_to_end(shard)
+            return ds
+        ds = MMapIndexedDataset(self._manifest.shard_paths[shard])
+        self._shards[shard] = ds
+        if len(self._shards) > self._max_open_shards:
+            self._shards.popitem(last=False)
+        return ds
+
+    def __len__(self):
+        return len(self._manifest)
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError('index out of range')
+        shard, local_i = self._manifest.locate(i)
+        return self._get_shard(shard)[local_i]
+
+    def get_range(self, start_idx, start_offset, length):
+        """Like :func:`MMapIndexedDataset.get_range`. Ranges that cross shard
+        boundaries are copied into a new array."""
+        shard, local_i = self._manifest.locate(start_idx)
+        pieces = []
+        while True:
+            ds = self._get_shard(shard)
+            n = min(length, ds._tokens_from(local_i, start_offset))
+            pieces.append(ds.get_range(local_i, start_offset, n))
+            length -= n
+            if length <= 0:
+                break
+            shard, local_i, start_offset = shard + 1, 0, 0
+            offsets = self._manifest.offsets
+            while offsets[shard + 1] == offsets[shard]:
+                shard += 1  # skip empty shards
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    @property
+    def sizes(self):
+        return self._manifest.sizes
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(manifest_file_path(path))
+
+
+def write_manifest(prefix_path, shard_paths):
+    """Writes a manifest so that the ``.bin/.idx`` datasets at *shard_paths*
+    can be loaded as a single :class:`ShardedMMapIndexedDataset` from
+    *prefix_path*."""
+    ShardedMMapIndexedDataset.Manifest.write(manifest_file_path(prefix_path), shard_paths)
+
+
+def _get_codec(name):
+    """Returns the (compress, decompress) functions of a block codec."""
+    if name == 'zlib':
+        return zlib.compress, zlib.decompress
+    elif name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Please install zstandard with: pip install zstandard')
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(name)
+
+
+def _default_codec():
+    try:
+        import zstandard  # noqa
+        return 'zstd'
+    except ImportError:
+        return 'zlib'
+
+
+codecs = {
+    1: 'zlib',
+    2: 'zstd',
+}
+
+
+class CompressedIndexedDataset(torch.utils.data.Dataset):
+    """Like :class:`MMapIndexedDataset`, but the data file is a sequence of
+    independently compressed blocks holding a fixed number of consecutive
+    items each. The last few decompressed blocks are cached, so neighbouring
+    reads (e.g. within a sorted batch) only decompress a block once.
+    """
+
+    class Index(object):
+        _HDR_MAGIC = b'CMPIDX\x00\x00\x00'
+
+        @classmethod
+        def writer(cls, path, dtype, codec):
+            class _Writer(object):
+                def __enter__(self):
+                    self._file = open(path, 'wb')
+
+                    self._file.write(cls._HDR_MAGIC)
+                    self._file.write(struct.pack('<Q', 1))
+                    self._file.write(struct.pack('<B', code(dtype)))
+                    codec_code, = [k for k, v in codecs.items() if v == codec]
+                    self._file.write(struct.pack('<B', codec_code))
+
+                    return self
+
+                def write(self, sizes, block_items, block_bytes):
+                    self._file.write(struct.pack('<QQ', len(sizes), len(block_items) - 1))
+                    self._file.write(np.array(sizes, dtype=np.int32).tobytes(order='C'))
+                    self._file.write(np.array(block_items, dtype=np.int64).tobytes(order='C'))
+                    self._file.write(np.array(block_bytes, dtype=np.int64).tobytes(order='C'))
+
+                def __exit__(self, exc_type, exc_val, exc_tb):
+                    self._file.close()
+
+            return _Writer()
+
+        def __init__(self, path):
+            with open(path, 'rb') as stream:
+                magic_test = stream.read(9)
+                assert self._HDR_MAGIC == magic_test, (
+                    'Index file doesn\'t match expected format. '
+                    'Make sure that --dataset-impl is configured properly.'
+                )
+                version = struct.unpack('<Q', stream.read(8))
+                assert (1,) == version
+
+                dtype_code, codec_code = struct.unpack('<BB', stream.read(2))
+                self._dtype = dtypes[dtype_code]
+                self._codec = codecs[codec_code]
+
+                self._len, num_blocks = struct.unpack('<QQ', stream.read(16))
+                offset = stream.tell()
+
+            self._bin_buffer_mmap = np.memmap(path, mode='r', order='C')
+            self._bin_buffer = memoryview(self._bin_buffer_mmap)
+            self._sizes = np.frombuffer(self._bin_buffer, dtype=np.int32, count=self._len, offset=offset)
+            offset += self._sizes.nbytes
+            # index of the first item and byte offset of every block
+            self._block_items = np.frombuffer(
+                self._bin_buffer, dtype=np.int64, count=num_blocks + 1, offset=offset
+            )
+            offset += self._block_items.nbytes
+            self._block_bytes = np.frombuffer(
+                self._bin_buffer, dtype=np.int64, count=num_blocks + 1, offset=offset
+            )
+            # element offset of every item within the concatenated data
+            self._item_offsets = np.zeros(self._len + 1, dtype=np.int64)
+            np.cumsum(self._sizes, out=self._item_offsets[1:])
+
+        def __del__(self):
+            self._bin_buffer_mmap._mmap.close()
+            del self._bin_buffer_mmap
+
+        @property
+        def dtype(self):
+            return self._dtype
+
+        @property
+        def codec(self):
+            return self._codec
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        @property
+        def block_items(self):
+            return self._block_items
+
+        @property
+        def block_bytes(self):
+            return self._block_bytes
+
+        def __getitem__(self, i):
+            """Returns the block holding item *i* and the item's element
+            offset and size within the block."""
+            block = int(np.searchsorted(self._block_items, i, side='right')) - 1
+            first = self._block_items[block]
+            start = self._item_offsets[i] - self._item_offsets[first]
+            return block, start, self._sizes[i]
+
+        def __len__(self):
+            return self._len
+
+    def __init__(self, path, cache_blocks=8):
+        super().__init__()
+        self._do_init(path, cache_blocks)
+
+    def __getstate__(self):
+        return self._path, self._cache_blocks
+
+    def __setstate__(self, state):
+        self._do_init(*state)
+
+    def _do_init(self, path, cache_blocks):
+        self._path = path
+        self._cache_blocks = cache_blocks
+        self._index = self.Index(index_file_path(self._path))
+        self._decompress = _get_codec(self._index.codec)[1]
+        self._cache = OrderedDict()
+
+        self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='r', order='C')
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+
+    def __del__(self):
+        self._bin_buffer_mmap._mmap.close()
+        del self._bin_buffer_mmap
+        del self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def _read_block(self, block):
+        data = self._cache.get(block)
+        if data is not None:
+            self._cache.move_to_end(block)
+            return data
+        start, end = self._index.block_bytes[block], self._index.block_bytes[block + 1]
+        data = np.frombuffer(
+            self._decompress(self._bin_buffer[start:end]), dtype=self._index.dtype
+        )
+        self._cache[block] = data
+        if len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+        return data
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError('index out of range')
+        block, start, size = self._index[i]
+        np_array = self._read_block(block)[start:start + size].astype(np.int64)
+        return torch.from_numpy(np_array)
+
+    @property
+    def sizes(self):
+        return self._index.sizes
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+    @staticmethod
+    def exists(path):
+        return (
+            os.path.exists(index_file_path(path)) and os.path.exists(data_file_path(path))
+        )
+
+
+class CompressedIndexedDatasetBuilder(object):
+    def __init__(self, out_file, dtype=np.int64, block_size=256, codec=None):
+        self._data_file = open(out_file, 'wb')
+        self._dtype = dtype
+        self._block_size = block_size
+        self._codec = codec or _default_codec()
+        self._compress = _get_codec(self._codec)[0]
+        self._sizes = []
+        self._block_items = [0]
+        self._block_bytes = [0]
+        self._pending = []
+
+    def _write_block(self, np_array, num_items):
+        nbytes = self._data_file.write(self._compress(np_array.tobytes(order='C')))
+        self._block_items.append(self._block_items[-1] + num_items)
+        self._block_bytes.append(self._block_bytes[-1] + nbytes)
+
+    def _flush(self, final=False):
+        num_pending = len(self._sizes) - self._block_items[-1]
+        if num_pending < self._block_size and not (final and num_pending > 0):
+            return
+        data = np.concatenate(self._pending)
+        ends = np.cumsum(self._sizes[self._block_items[-1]:])
+        start, n = 0, 0
+        while num_pending - n >= self._block_size or (final and n < num_pending):
+            m = min(num_pending - n, self._block_size)
+            end = int(ends[n + m - 1])
+            self._write_block(data[start:end], m)
+            start, n = end, n + m
+        self._pending = [data[start:]]
+
+    def add_item(self, tensor):
+        np_array = np.array(tensor.numpy(), dtype=self._dtype)
+        self._pending.append(np_array)
+        self._sizes.append(np_array.size)
+        self._flush()
+
+    def add_items(self, np_array, sizes):
+        """Adds len(sizes) items stored back to back in the flat *np_array*."""
+        self._pending.append(np.asarray(np_array, dtype=self._dtype))
+        self._sizes.extend(sizes.tolist())
+        self._flush()
+
+    def merge_file_(self, another_file):
+        # compressed blocks are copied as is, only the index is rebased
+        index = CompressedIndexedDataset.Index(index_file_path(another_file))
+        assert index.dtype == self._dtype
+        assert index.codec == self._codec
+
+        self._flush(final=True)
+        item_begin, byte_begin = self._block_items[-1], self._block_bytes[-1]
+        self._sizes.extend(index.sizes.tolist())
+        self._block_items.extend((item_begin + index.block_items[1:]).tolist())
+        self._block_bytes.extend((byte_begin + index.block_bytes[1:]).tolist())
+        with open(data_file_path(another_file), 'rb') as f:
+            shutil.copyfileobj(f, self._data_file)
+
+    def finalize(self, index_file):
+        self._flush(final=True)
+        self._data_file.close()
+
+        with CompressedIndexedDataset.Index.writer(index_file, self._dtype, self._codec) as index:
+            index.write(self._sizes, self._block_items, self._block_bytes)
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import inspect
 import itertools
 import logging
 import math
@@ -15,6 +16,7 @@ from threading import Thread
 import numpy as np
 import torch
 
+from fairseq import utils
 from fairseq.data import data_utils
 
 
@@ -208,11 +210,21 @@ class EpochBatchIterator(EpochBatchIterating):
             default torch.utils.data.DataLoader preloading is used.
         timeout (int, optional): if positive, the timeout value for collecting a batch
             from workers. Should always be non-negative. (default: ``0``)
+        prefetch_device (torch.device, optional): if given, batches are pinned
+            and copied to this device ahead of time, see
+            :class:`DevicePrefetchIterator` (default: None).
+        prefetch_float_dtype (torch.dtype, optional): dtype to cast float32
+            tensors to while prefetching them (default: None).
+        persistent_workers (bool, optional): keep the data loading worker
+            processes alive across epochs. Workers keep the copy of
+            *dataset* they were started with, so this should not be used
+            with datasets that change in :func:`set_epoch` (default: False).
     """
 
     def __init__(
         self, dataset, collate_fn, batch_sampler, seed=1, num_shards=1, shard_id=0,
         num_workers=0, epoch=1, buffer_size=0, timeout=0,
+        prefetch_device=None, prefetch_float_dtype=None, persistent_workers=False,
     ):
         assert isinstance(dataset, torch.utils.data.Dataset)
         self.dataset = dataset
@@ -227,6 +239,14 @@ class EpochBatchIterator(EpochBatchIterating):
         # in a shared computing environment.
         self.buffer_size = min(buffer_size, 20)
         self.timeout = timeout
+        self.prefetch_device = prefetch_device
+        self.prefetch_float_dtype = prefetch_float_dtype
+        # persistent workers need worker processes
+        self.persistent_workers = persistent_workers and num_workers > 0
+        if self.persistent_workers and not _dataloader_supports_persistent_workers():
+            raise ValueError('persistent workers require PyTorch >= 1.7')
+        self._dataloader = None
+        self._batch_sampler = None
 
         self.epoch = max(epoch, 1)  # we use 1-based indexing for epochs
         self.shuffle = True
@@ -320,59 +340,104 @@ class EpochBatchIterator(EpochBatchIterating):
         else:
             self._next_epoch_itr = None
 
-    def _get_iterator_for_epoch(self, epoch, shuffle, fix_batches_to_gpus=False, offset=0):
+    def _batch_order(self, epoch, shuffle, fix_batches_to_gpus=False):
+        """Returns the positions in :attr:`frozen_batches` of the batches
+        this shard iterates over in *epoch*, with -1 marking the empty
+        batches that pad the shards to the same length."""
+        order = np.arange(len(self.frozen_batches), dtype=np.int64)
+        fix_shards = self._supports_prefetch and fix_batches_to_gpus
+        if shuffle and not fix_shards:
+            with data_utils.numpy_seed(self.seed + epoch):
+                np.random.shuffle(order)
+
+        # same layout as ShardedIterator(..., fill_value=[])
+        order = order[self.shard_id::self.num_shards]
+        sharded_len = len(self)
+        if len(order) < sharded_len:
+            order = np.concatenate([
+                order, np.full(sharded_len - len(order), -1, dtype=np.int64),
+            ])
+
+        if shuffle and fix_shards:
+            with data_utils.numpy_seed(self.seed + epoch + self.shard_id):
+                np.random.shuffle(order)
+        return order
 
-        def shuffle_batches(batches, seed):
-            with data_utils.numpy_seed(seed):
-                np.random.shuffle(batches)
-            return batches
+    def _get_iterator_for_epoch(self, epoch, shuffle, fix_batches_to_gpus=False, offset=0):
+        order = self._batch_order(epoch, shuffle, fix_batches_to_gpus)
+        if offset > 0 and offset >= len(order):
+            return None
+        # resuming only needs to skip the consumed part of the permutation
+        order = order[offset:]
 
         if self._supports_prefetch:
             batches = self.frozen_batches
-
-            if shuffle and not fix_batches_to_gpus:
-                batches = shuffle_batches(list(batches), self.seed + epoch)
-
-            batches = list(ShardedIterator(
-                batches, self.num_shards, self.shard_id, fill_value=[]
-            ))
-            self.dataset.prefetch([i for s in batches for i in s])
-
-            if shuffle and fix_batches_to_gpus:
-                batches = shuffle_batches(batches, self.seed + epoch + self.shard_id)
-        else:
-            if shuffle:
-                batches = shuffle_batches(list(self.frozen_batches), self.seed + epoch)
-            else:
-                batches = self.frozen_batches
-            batches = list(ShardedIterator(
-                batches, self.num_shards, self.shard_id, fill_value=[]
-            ))
-
-        if offset > 0 and offset >= len(batches):
-            return None
+            self.dataset.prefetch([i for b in order if b >= 0 for i in batches[b]])
 
         if self.num_workers > 0:
             os.environ['PYTHONWARNINGS'] = 'ignore:semaphore_tracker:UserWarning'
 
-        # Create data loader
-        itr = torch.utils.data.DataLoader(
-            self.dataset,
-            collate_fn=self.collate_fn,
-            batch_sampler=batches[offset:],
-            num_workers=self.num_workers,
-            timeout=self.timeout,
-        )
+        # Create data loader, or reuse the one (and its workers) from the
+        # previous epoch
+        if self._dataloader is None:
+            self._batch_sampler = _OrderedBatchSampler(self.frozen_batches, order)
+            kwargs = {}
+            if self.persistent_workers:
+                kwargs['persistent_workers'] = True
+            self._dataloader = torch.utils.data.DataLoader(
+                self.dataset,
+                collate_fn=self.collate_fn,
+                batch_sampler=self._batch_sampler,
+                num_workers=self.num_workers,
+                timeout=self.timeout,
+                pin_memory=DevicePrefetchIterator.is_available(self.prefetch_device),
+                **kwargs
+            )
+        else:
+            self._batch_sampler.batches = self.frozen_batches
+            self._batch_sampler.order = order
+        itr = self._dataloader
+        if not self.persistent_workers:
+            self._dataloader = None
 
         # Wrap with a BufferedIterator if needed
         if self.buffer_size > 0:
             itr = BufferedIterator(self.buffer_size, itr)
 
+        # Copy batches to the device ahead of time if needed
+        if self.prefetch_device is not None:
+            itr = DevicePrefetchIterator(
+                itr, self.prefetch_device, float_dtype=self.prefetch_float_dtype,
+            )
+
         # Wrap with CoutingIterator
         itr = CountingIterator(itr, start=offset)
         return itr
 
 
+class _OrderedBatchSampler(object):
+    """Batch sampler yielding ``batches[i]`` for each position *i* in
+    *order*, and an empty batch for negative positions. *order* can be
+    replaced between epochs, also when the DataLoader workers persist."""
+
+    def __init__(self, batches, order):
+        self.batches = batches
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        batches = self.batches
+        for i in self.order.tolist():
+            yield batches[i] if i >= 0 else []
+
+
+def _dataloader_supports_persistent_workers():
+    # added in PyTorch 1.7
+    return 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader).parameters
+
+
 class GroupedIterator(CountingIterator):
     """Wrapper around an iterable that returns groups (chunks) of items.
 
@@ -518,3 +583,94 @@ class BufferedIterator(object):
         if item is _sentinel:
             raise StopIteration()
         return item
+
+
+class DevicePrefetchIterator(object):
+    """Copies the batches of *iterable* to *device* one batch ahead.
+
+    The copy of batch N+1 (and the cast of its float32 tensors to
+    *float_dtype*) is issued on a side CUDA stream when batch N is returned,
+    so that it overlaps with the computation on batch N. Batches should come
+    from pinned memory (e.g., ``DataLoader(pin_memory=True)``), otherwise the
+    host-to-device copies are synchronous.
+
+    Batches are returned unchanged if *device* is not a CUDA device or CUDA
+    is not available.
+
+    Args:
+        iterable (iterable): iterable over (nested) batches of tensors
+        device (torch.device): device to copy the batches to
+        float_dtype (torch.dtype, optional): dtype to cast float32 tensors to
+            (default: None)
+    """
+
+    def __init__(self, iterable, device, float_dtype=None):
+        self._iterable = iterable
+        self.device = torch.device(device)
+        self.float_dtype = float_dtype
+        self._itr = None
+        self._next = None
+        if self.is_available(self.device):
+            self._stream = torch.cuda.Stream(device=self.device)
+        else:
+            self._stream = None
+
+    @staticmethod
+    def is_available(device):
+        """Whether batches can be prefetched to *device*."""
+        return (
+            device is not None
+            and torch.device(device).type == 'cuda'
+            and torch.cuda.is_available()
+        )
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self._iterable)
+
+    def take(self, n):
+        if hasattr(self._iterable, 'take'):
+            self._iterable.take(n)
+
+    def _copy(self, tensor):
+        tensor = tensor.to(self.device, non_blocking=True)
+        if self.float_dtype is not None and tensor.dtype is torch.float32:
+            tensor = tensor.to(dtype=self.float_dtype)
+        return tensor
+
+    def _preload(self):
+        try:
+            sample = next(self._itr)
+        except StopIteration:
+            self._next = _sentinel
+            return
+        with torch.cuda.stream(self._stream):
+            self._next = utils.apply_to_sample(self._copy, sample)
+
+    def __next__(self):
+        if self._itr is None:
+            self._itr = iter(self._iterable)
+            if self._stream is not None:
+                self._preload()
+        if self._stream is None:
+            return next(self._itr)
+
+        sample = self._next
+        if sample is _sentinel:
+            raise StopIteration()
+
+        # wait for the copy and tell the caching allocator that the tensors
+        # are now used on the current stream
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self._stream)
+
+        def record_stream(tensor):
+            tensor.record_stream(current_stream)
+            return tensor
+
+        utils.apply_to_sample(record_stream, sample)
+
+        self._preload()
+        return sample
@@ -136,6 +136,56 @@ def collate(
     return batch
 
 
+def collate_packed(samples, pad_idx, eos_idx, input_feeding=True, pad_to_length=None):
+    """Collate *samples* into a packed batch, where each row holds several
+    examples (see :func:`~fairseq.data.data_utils.pack_sequences`) and the
+    segment ids in ``src_segments`` and ``tgt_segments`` restrict attention
+    and positions to each example. Padding is always on the right."""
+    if len(samples) == 0:
+        return {}
+
+    has_target = samples[0].get('target', None) is not None
+    lengths = [
+        [len(s['source']), len(s['target'])] if has_target else [len(s['source'])]
+        for s in samples
+    ]
+    rows = data_utils.pack_sequences(lengths)
+
+    def merge(key, move_eos_to_beginning=False, pad_to_length=None):
+        return data_utils.collate_packed_tokens(
+            [s[key] for s in samples], rows, pad_idx, eos_idx,
+            move_eos_to_beginning=move_eos_to_beginning, pad_to_length=pad_to_length,
+        )
+
+    src_tokens, src_segments = merge(
+        'source', pad_to_length=pad_to_length['source'] if pad_to_length is not None else None,
+    )
+    batch = {
+        'id': torch.LongTensor([samples[i]['id'] for row in rows for i in row]),
+        'nsentences': len(samples),
+        'ntokens': sum(s['source'].ne(pad_idx).long().sum().item() for s in samples),
+        'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': src_segments.ne(0).long().sum(dim=1),
+            'src_segments': src_segments,
+        },
+        'target': None,
+    }
+    if has_target:
+        tgt_pad_to_length = pad_to_length['target'] if pad_to_length is not None else None
+        batch['target'], tgt_segments = merge('target', pad_to_length=tgt_pad_to_length)
+        batch['ntokens'] = sum(s['target'].ne(pad_idx).long().sum().item() for s in samples)
+        if samples[0].get('prev_output_tokens', None) is not None:
+            batch['net_input']['prev_output_tokens'], tgt_segments = merge('prev_output_tokens')
+        elif input_feeding:
+            batch['net_input']['prev_output_tokens'], _ = merge(
+                'target', move_eos_to_beginning=True, pad_to_length=tgt_pad_to_length,
+            )
+        if 'prev_output_tokens' in batch['net_input']:
+            batch['net_input']['tgt_segments'] = tgt_segments
+    return batch
+
+
 class LanguagePairDataset(FairseqDataset):
     """
     A pair of torch.utils.data.Datasets.
@@ -171,6 +221,8 @@ class LanguagePairDataset(FairseqDataset):
         tgt_lang_id (int, optional): target language ID, if set, the collated batch
             will contain a field 'tgt_lang_id' which indicates the target language
              of the samples.
+        packed (bool, optional): collate packed batches with several examples
+            per row, see :func:`collate_packed` (default: False).
     """
 
     def __init__(
@@ -184,6 +236,7 @@ class LanguagePairDataset(FairseqDataset):
         num_buckets=0,
         src_lang_id=None,
         tgt_lang_id=None,
+        packed=False,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -210,6 +263,9 @@ class LanguagePairDataset(FairseqDataset):
         self.eos = (eos if eos is not None else src_dict.eos())
         self.src_lang_id = src_lang_id
         self.tgt_lang_id = tgt_lang_id
+        self.packed = packed
+        if packed and (align_dataset is not None or num_buckets > 0):
+            raise ValueError('packed batches do not support alignments or bucketing')
         if num_buckets > 0:
             from fairseq.data import BucketPadLengthDataset
             self.src = BucketPadLengthDataset(
@@ -320,15 +376,24 @@ class LanguagePairDataset(FairseqDataset):
                 - `tgt_lang_id` (LongTensor): a long Tensor which contains target language
                    IDs of each sample in the batch
         """
-        res = collate(
-            samples,
-            pad_idx=self.src_dict.pad(),
-            eos_idx=self.eos,
-            left_pad_source=self.left_pad_source,
-            left_pad_target=self.left_pad_target,
-            input_feeding=self.input_feeding,
-            pad_to_length=pad_to_length,
-        )
+        if self.packed:
+            res = collate_packed(
+                samples,
+                pad_idx=self.src_dict.pad(),
+                eos_idx=self.eos,
+                input_feeding=self.input_feeding,
+                pad_to_length=pad_to_length,
+            )
+        else:
+            res = collate(
+                samples,
+                pad_idx=self.src_dict.pad(),
+                eos_idx=self.eos,
+                left_pad_source=self.left_pad_source,
+                left_pad_target=self.left_pad_target,
+                input_feeding=self.input_feeding,
+                pad_to_length=pad_to_length,
+            )
         if self.src_lang_id is not None or self.tgt_lang_id is not None:
             src_tokens = res['net_input']['src_tokens']
             bsz = src_tokens.size(0)
@@ -352,6 +417,12 @@ class LanguagePairDataset(FairseqDataset):
         filtering a dataset with ``--max-positions``."""
         return (self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
 
+    def sizes_array(self):
+        """Return the source and target sizes of all examples as an array of
+        shape ``(len(self), 2)``."""
+        tgt_sizes = self.tgt_sizes if self.tgt_sizes is not None else np.zeros_like(self.src_sizes)
+        return np.stack([self.src_sizes, tgt_sizes], axis=1)
+
     def ordered_indices(self):
         """Return an ordered list of indices. Batches will be constructed based
         on this order."""
@@ -3,6 +3,8 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import numpy as np
+
 from . import BaseWrapperDataset
 
 
@@ -29,5 +31,10 @@ class ListDataset(BaseWrapperDataset):
     def size(self, index):
         return self.sizes[index]
 
+    def sizes_array(self):
+        if self.sizes is None:
+            return None
+        return np.asarray(self.sizes).reshape(len(self.sizes), -1)
+
     def set_epoch(self, epoch):
         pass
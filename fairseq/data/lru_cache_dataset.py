@@ -3,20 +3,50 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from functools import lru_cache
-
 from . import BaseWrapperDataset
+from .sample_cache import InProcessSampleCache
 
 
 class LRUCacheDataset(BaseWrapperDataset):
+    """Caches the samples of *dataset*.
+
+    Args:
+        dataset (~torch.utils.data.Dataset): dataset to cache
+        max_items (int, optional): maximum number of cached samples
+            (default: 8)
+        max_bytes (int, optional): maximum total size of the cached samples
+        eviction (str, optional): eviction policy, 'lru' or 'lfu'
+            (default: 'lru')
+        cache (~fairseq.data.sample_cache.SampleCache, optional): use this
+            cache instead of creating one
+
+    The cache is cleared by :func:`set_epoch`, since the samples of the
+    wrapped dataset may depend on the epoch (e.g., random masks).
+    """
 
-    def __init__(self, dataset, token=None):
+    def __init__(
+        self,
+        dataset,
+        token=None,
+        max_items=8,
+        max_bytes=None,
+        eviction='lru',
+        cache=None,
+    ):
         super().__init__(dataset)
+        if cache is None:
+            cache = InProcessSampleCache(
+                max_items=max_items, max_bytes=max_bytes, eviction=eviction,
+            )
+        self.cache = cache
 
-    @lru_cache(maxsize=8)
     def __getitem__(self, index):
-        return self.dataset[index]
+        item = self.cache.get(index)
+        if item is None:
+            item = self.dataset[index]
+            self.cache.put(index, item)
+        return item
 
-    @lru_cache(maxsize=8)
-    def collater(self, samples):
-        return self.dataset.collater(samples)
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.cache.clear()
@@ -9,10 +9,13 @@ import torch
 from . import data_utils, FairseqDataset
 
 
-def collate(samples, pad_idx, eos_idx):
+def collate(samples, pad_idx, eos_idx, packed=False):
     if len(samples) == 0:
         return {}
 
+    if packed:
+        return collate_packed(samples, pad_idx, eos_idx)
+
     def merge(key, is_list=False):
         if is_list:
             res = []
@@ -47,6 +50,35 @@ def collate(samples, pad_idx, eos_idx):
     }
 
 
+def collate_packed(samples, pad_idx, eos_idx):
+    """Collate *samples* into a packed batch with several examples per row,
+    see :func:`fairseq.data.language_pair_dataset.collate_packed`."""
+    if samples[0]['target'] is not None and isinstance(samples[0]['target'], list):
+        raise ValueError('packed batches do not support multiple targets')
+    rows = data_utils.pack_sequences([len(s['source']) for s in samples])
+    src_tokens, segments = data_utils.collate_packed_tokens(
+        [s['source'] for s in samples], rows, pad_idx, eos_idx,
+    )
+    if samples[0]['target'] is not None:
+        target, _ = data_utils.collate_packed_tokens(
+            [s['target'] for s in samples], rows, pad_idx, eos_idx,
+        )
+    else:
+        target = src_tokens
+
+    return {
+        'id': torch.LongTensor([samples[i]['id'] for row in rows for i in row]),
+        'nsentences': len(samples),
+        'ntokens': sum(len(s['source']) for s in samples),
+        'net_input': {
+            'src_tokens': src_tokens,
+            'src_lengths': segments.ne(0).long().sum(dim=1),
+            'tgt_segments': segments,
+        },
+        'target': target,
+    }
+
+
 class MonolingualDataset(FairseqDataset):
     """
     A wrapper around torch.utils.data.Dataset for monolingual data.
@@ -57,10 +89,12 @@ class MonolingualDataset(FairseqDataset):
         vocab (~fairseq.data.Dictionary): vocabulary
         shuffle (bool, optional): shuffle the elements before batching
             (default: True).
+        packed (bool, optional): collate packed batches with several examples
+            per row, see :func:`collate_packed` (default: False).
     """
 
     def __init__(self, dataset, sizes, src_vocab, tgt_vocab, add_eos_for_other_targets, shuffle,
-                 targets=None, add_bos_token=False):
+                 targets=None, add_bos_token=False, packed=False):
         self.dataset = dataset
         self.sizes = np.array(sizes)
         self.vocab = src_vocab
@@ -68,6 +102,7 @@ class MonolingualDataset(FairseqDataset):
         self.add_eos_for_other_targets = add_eos_for_other_targets
         self.shuffle = shuffle
         self.add_bos_token = add_bos_token
+        self.packed = packed
 
         assert targets is None or all(t in {'self', 'future', 'past'} for t in targets), \
             "targets must be none or one of 'self', 'future', 'past'"
@@ -170,7 +205,7 @@ class MonolingualDataset(FairseqDataset):
                   target sentence of shape `(bsz, tgt_len)`. Padding will appear
                   on the right.
         """
-        return collate(samples, self.vocab.pad(), self.vocab.eos())
+        return collate(samples, self.vocab.pad(), self.vocab.eos(), packed=self.packed)
 
     def num_tokens(self, index):
         """Return the number of tokens in a sample. This value is used to
@@ -182,6 +217,9 @@ class MonolingualDataset(FairseqDataset):
         filtering a dataset with ``--max-positions``."""
         return self.sizes[index]
 
+    def sizes_array(self):
+        return self.sizes.reshape(-1, 1)
+
     def ordered_indices(self):
         """Return an ordered list of indices. Batches will be constructed based
         on this order."""
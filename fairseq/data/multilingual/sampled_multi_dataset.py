@@ -141,7 +141,7 @@ class SampledMultiDataset(FairseqDataset):
         else:
             if not isinstance(sample_ratios, np.ndarray):
                 sample_ratios = np.array(sample_ratios)
-            self.sample_ratios = plasma_utils.PlasmaArray(sample_ratios)
+            self.sample_ratios = plasma_utils.SharedArray(sample_ratios)
             virtual_size = default_virtual_size_func if virtual_size is None else virtual_size
             self.virtual_size = (
                 virtual_size(self.datasets, self.sample_ratios.array) if callable(virtual_size)
@@ -297,11 +297,34 @@ class SampledMultiDataset(FairseqDataset):
                 batch['tgt_lang_id'] = straight_order([b['tgt_lang_id'] for b in batches])
             return batch
 
+    def _global_sizes_array(self):
+        """Sizes of all (virtual) examples, computed from the sizes of the
+        underlying datasets."""
+        sizes = [getattr(d, 'sizes_array', lambda: None)() for d in self.datasets]
+        if any(s is None for s in sizes) or len(set(s.shape[1] for s in sizes)) != 1:
+            return None
+        ret = np.empty((self.virtual_size, sizes[0].shape[1]), dtype=np.int64)
+        start = 0
+        for s, end in zip(sizes, self.cumulated_sizes.array):
+            ret[start:end] = s[self._cur_indices.array[start:end]]
+            start = end
+        return ret
+
+    def sizes_array(self):
+        if self._sizes is not None:
+            return self._sizes.reshape(len(self), -1)
+        return self._global_sizes_array()
+
     @property
     def sizes(self):
         if self._sizes is not None:
             return self._sizes
         start_time = time.time()
+        sizes = self._global_sizes_array()
+        if sizes is not None:
+            self._sizes = sizes[:, 0] if sizes.shape[1] == 1 else sizes
+            logger.debug(f'sizes() calling time: {get_time_gap(start_time, time.time())}')
+            return self._sizes
         size_cache = self._size_cache
         ret = []
         for i in range(len(self)):
@@ -379,9 +402,9 @@ class SampledMultiDataset(FairseqDataset):
         self._clean_if_not_none([
             self.cumulated_sizes, self.virtual_size_per_dataset
         ])
-        self._cur_indices = plasma_utils.PlasmaArray(indices)
-        self.cumulated_sizes = plasma_utils.PlasmaArray(cumulated_sizes)
-        self.virtual_size_per_dataset = plasma_utils.PlasmaArray(virtual_size_per_dataset)
+        self._cur_indices = plasma_utils.SharedArray(indices)
+        self.cumulated_sizes = plasma_utils.SharedArray(cumulated_sizes)
+        self.virtual_size_per_dataset = plasma_utils.SharedArray(virtual_size_per_dataset)
 
         raw_sizes = [len(d) for d in self.datasets]
         sampled_sizes = self.virtual_size_per_dataset.array
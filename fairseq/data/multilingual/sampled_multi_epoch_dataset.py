@@ -120,12 +120,29 @@ class SampledMultiEpochDataset(SampledMultiDataset):
             else self.virtual_size - self._current_epoch_start_index
         )
 
+    def sizes_array(self):
+        if self._epoch_sizes is not None:
+            return self._epoch_sizes.array
+        sizes = self._global_sizes_array()
+        if sizes is None:
+            return None
+        start = self._current_epoch_start_index
+        return sizes[self._random_globa_indices.array[start:start + len(self)]]
+
     @property
     def sizes(self):
         if self._epoch_sizes is not None:
             return self._epoch_sizes.array
         start_time = time.time()
 
+        sizes = self.sizes_array()
+        if sizes is not None:
+            if sizes.shape[1] == 1:
+                sizes = np.concatenate([sizes, sizes], axis=1)
+            self._epoch_sizes = plasma_utils.SharedArray(sizes)
+            logger.info(f'sizes() calling time: {get_time_gap(start_time, time.time())}')
+            return self._epoch_sizes.array
+
         size_cache = self._size_cache
         ret = []
         for i in range(len(self)):
@@ -139,7 +156,7 @@ class SampledMultiEpochDataset(SampledMultiDataset):
                 s = (s, s) if not isinstance(s, tuple) else s
                 size_cache[(ds_idx, ds_sample_idx)] = s
                 ret.append(s)
-        self._epoch_sizes = plasma_utils.PlasmaArray(np.array(ret, np.int64))
+        self._epoch_sizes = plasma_utils.SharedArray(np.array(ret, np.int64))
         logger.info(f'sizes() calling time: {get_time_gap(start_time, time.time())}')
         return self._epoch_sizes.array
 
@@ -162,7 +179,7 @@ class SampledMultiEpochDataset(SampledMultiDataset):
             sort_indices = indices[np.argsort(src_sizes[indices], kind='mergesort')]
         else:
             sort_indices = np.arange(len(self))
-        self._epoch_ordered_indices = plasma_utils.PlasmaArray(sort_indices)
+        self._epoch_ordered_indices = plasma_utils.SharedArray(sort_indices)
         return self._epoch_ordered_indices.array
 
     def prefetch(self, indices):
@@ -196,7 +213,7 @@ class SampledMultiEpochDataset(SampledMultiDataset):
            ]
         )
         del self._random_globa_indices
-        self._random_globa_indices = plasma_utils.PlasmaArray(
+        self._random_globa_indices = plasma_utils.SharedArray(
             rng.choice(self.virtual_size, self.virtual_size, replace=False))
         if self.load_next_shard is None:
             self.load_next_shard = False
@@ -5,6 +5,7 @@
 
 from collections import OrderedDict
 
+import numpy as np
 import torch
 from torch.utils.data.dataloader import default_collate
 
@@ -99,6 +100,11 @@ class NestedDictionaryDataset(FairseqDataset):
         else:
             return (s[index] for s in self.sizes)
 
+    def sizes_array(self):
+        if any(s is None for s in self.sizes):
+            return None
+        return np.stack([np.asarray(s) for s in self.sizes], axis=1)
+
     @property
     def supports_prefetch(self):
         """Whether this dataset supports prefetching."""
@@ -3,84 +3,83 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import subprocess
+from multiprocessing.context import get_spawning_popen
+import os
 import tempfile
+import weakref
 
+import numpy as np
 
-class PlasmaArray(object):
+
+def _shared_memory_dir():
+    # prefer a memory-backed filesystem when available
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _remove_file(path, owner_pid):
+    if os.getpid() == owner_pid and os.path.exists(path):
+        os.remove(path)
+
+
+class SharedArray(object):
     """
     Wrapper around numpy arrays that automatically moves the data to shared
-    memory upon serialization. This is particularly helpful when passing numpy
-    arrays through multiprocessing, so that data is not unnecessarily
-    duplicated or pickled.
+    memory when it is sent to a child process (e.g., a DataLoader worker).
+    The data is written once to a memory-mapped file in ``/dev/shm`` and
+    child processes map the same pages instead of unpickling a copy.
+
+    The file is removed when the wrapper is garbage collected in the process
+    that created it, or at exit. Arrays smaller than *min_nbytes* are always
+    pickled.
     """
 
-    def __init__(self, array):
+    def __init__(self, array, min_nbytes=1 << 20):
         super().__init__()
         self.array = array
-        self.disable = array.nbytes < 134217728  # disable for arrays <128MB
-        self.object_id = None
+        self.min_nbytes = min_nbytes
         self.path = None
+        self._finalizer = None
+
+    def _share(self):
+        fd, path = tempfile.mkstemp(prefix='fairseq_shared_array_', dir=_shared_memory_dir())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(np.ascontiguousarray(self.array).tobytes(order='C'))
+        self._finalizer = weakref.finalize(self, _remove_file, path, os.getpid())
+        self.path = path
+        # continue with the shared copy, so the data is only held once
+        self.array = self._open()
 
-        # variables with underscores shouldn't be pickled
-        self._client = None
-        self._server = None
-        self._server_tmp = None
-        self._plasma = None
-
-    @property
-    def plasma(self):
-        if self._plasma is None and not self.disable:
-            try:
-                import pyarrow.plasma as plasma
-                self._plasma = plasma
-            except ImportError:
-                self._plasma = None
-        return self._plasma
-
-    def start_server(self):
-        if self.plasma is None or self._server is not None:
-            return
-        assert self.object_id is None
-        assert self.path is None
-        self._server_tmp = tempfile.NamedTemporaryFile()
-        self.path = self._server_tmp.name
-        self._server = subprocess.Popen([
-            'plasma_store',
-            '-m', str(int(1.05 * self.array.nbytes)),
-            '-s', self.path,
-        ])
-
-    @property
-    def client(self):
-        if self._client is None:
-            assert self.path is not None
-            self._client = self.plasma.connect(self.path)
-        return self._client
+    def _open(self):
+        # copy-on-write, in-place updates stay local to the process
+        return np.memmap(self.path, dtype=self.dtype, mode='c', shape=self.shape)
 
     def __getstate__(self):
-        if self.plasma is None:
-            return self.__dict__
-        if self.object_id is None:
-            self.start_server()
-            self.object_id = self.client.put(self.array)
-        state = self.__dict__.copy()
-        del state['array']
-        state['_client'] = None
-        state['_server'] = None
-        state['_server_tmp'] = None
-        state['_plasma'] = None
-        return state
+        shareable = (
+            get_spawning_popen() is not None
+            and self.array.nbytes >= max(self.min_nbytes, 1)
+            and not self.array.dtype.hasobject
+        )
+        if not shareable:
+            return {'array': self.array, 'min_nbytes': self.min_nbytes}
+        if self.path is None:
+            self.shape, self.dtype = self.array.shape, self.array.dtype
+            self._share()
+        return {
+            'path': self.path,
+            'shape': self.shape,
+            'dtype': self.dtype,
+            'min_nbytes': self.min_nbytes,
+        }
 
     def __setstate__(self, state):
+        self.path = state.pop('path', None)
+        self._finalizer = None
         self.__dict__.update(state)
-        if self.plasma is None:
-            return
-        self.array = self.client.get(self.object_id)
-
-    def __del__(self):
-        if self._server is not None:
-            self._server.kill()
-            self._server = None
-            self._server_tmp.close()
-            self._server_tmp = None
+        if self.path is not None:
+            self.array = self._open()
+
+
+# backward compatibility, pyarrow.plasma is no longer used
+PlasmaArray = SharedArray
@@ -58,7 +58,7 @@ class ResamplingDataset(BaseWrapperDataset):
             assert len(weights) == len(dataset)
             weights_arr = np.array(weights, dtype=np.float64)
             weights_arr /= weights_arr.sum()
-            self.weights = plasma_utils.PlasmaArray(weights_arr)
+            self.weights = plasma_utils.SharedArray(weights_arr)
 
         self.replace = replace
 
@@ -94,6 +94,12 @@ class ResamplingDataset(BaseWrapperDataset):
     def size(self, index):
         return self.dataset.size(self._cur_indices.array[index])
 
+    def sizes_array(self):
+        sizes = super().sizes_array()
+        if sizes is None:
+            return None
+        return sizes[self._cur_indices.array]
+
     def ordered_indices(self):
         if self.batch_by_size:
             order = [
@@ -126,7 +132,7 @@ class ResamplingDataset(BaseWrapperDataset):
                 self._cur_epoch,  # epoch index
             ]
         )
-        self._cur_indices = plasma_utils.PlasmaArray(
+        self._cur_indices = plasma_utils.SharedArray(
             rng.choice(
                 len(self.dataset),
                 self.actual_size,
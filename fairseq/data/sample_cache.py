@@ -0,0 +1,213 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import OrderedDict, defaultdict
+import multiprocessing
+from multiprocessing.context import get_spawning_popen
+import sys
+import weakref
+
+import numpy as np
+import torch
+
+from fairseq.logging import metrics
+
+
+# caches created in this process, see :func:`log_stats`
+_caches = weakref.WeakSet()
+
+_MISSING = object()
+
+
+def sizeof(sample):
+    """Estimates the number of bytes held by a (nested) sample."""
+    if torch.is_tensor(sample):
+        return sample.element_size() * sample.nelement()
+    elif isinstance(sample, np.ndarray):
+        return sample.nbytes
+    elif isinstance(sample, dict):
+        return sum(sizeof(v) for v in sample.values())
+    elif isinstance(sample, (list, tuple)):
+        return sum(sizeof(v) for v in sample)
+    return sys.getsizeof(sample)
+
+
+class LRUPolicy(object):
+    """Evicts the least recently used key."""
+
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        self.keys[key] = None
+
+    def touch(self, key):
+        self.keys.move_to_end(key)
+
+    def evict(self):
+        return self.keys.popitem(last=False)[0]
+
+
+class LFUPolicy(object):
+    """Evicts the least frequently used key (the least recently used one
+    among keys with the same frequency)."""
+
+    def __init__(self):
+        self.freqs = {}
+        self.buckets = defaultdict(OrderedDict)
+        self.min_freq = 0
+
+    def add(self, key):
+        self.freqs[key] = 1
+        self.buckets[1][key] = None
+        self.min_freq = 1
+
+    def touch(self, key):
+        freq = self.freqs[key]
+        del self.buckets[freq][key]
+        if not self.buckets[freq]:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+        self.freqs[key] = freq + 1
+        self.buckets[freq + 1][key] = None
+
+    def evict(self):
+        bucket = self.buckets[self.min_freq]
+        key = bucket.popitem(last=False)[0]
+        if not bucket:
+            del self.buckets[self.min_freq]
+            self.min_freq = min(self.buckets) if self.buckets else 0
+        del self.freqs[key]
+        return key
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+}
+
+
+class SampleCache(object):
+    """Base class for sample caches bounded by a number of items and bytes.
+
+    Hit, miss and eviction counters live in shared memory, so they also count
+    lookups made by DataLoader worker processes. See :func:`log_stats`.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, name='sample_cache'):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.name = name
+        self._stats = multiprocessing.RawArray('q', 3)
+        _caches.add(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if get_spawning_popen() is None:
+            # counters can only be shared with child processes
+            state['_stats'] = list(self._stats)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['_stats'], list):
+            state['_stats'] = multiprocessing.RawArray('q', state['_stats'])
+        self.__dict__.update(state)
+        _caches.add(self)
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes all the samples, e.g., when they depend on the epoch."""
+        raise NotImplementedError
+
+    @property
+    def hits(self):
+        return self._stats[0]
+
+    @property
+    def misses(self):
+        return self._stats[1]
+
+    @property
+    def evictions(self):
+        return self._stats[2]
+
+    def log_stats(self):
+        """Logs the counters of this cache through :mod:`fairseq.logging.metrics`."""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return
+        metrics.log_scalar(self.name + '_hit', 100. * self.hits / lookups, weight=0, priority=900, round=1)
+        metrics.log_scalar(self.name + '_miss', self.misses, weight=0, priority=900)
+        metrics.log_scalar(self.name + '_evict', self.evictions, weight=0, priority=900)
+
+
+class InProcessSampleCache(SampleCache):
+    """Keeps samples as Python objects in the current process.
+
+    Args:
+        max_items (int, optional): maximum number of cached samples
+        max_bytes (int, optional): maximum total size of the cached samples,
+            as estimated by :func:`sizeof`
+        eviction (str, optional): eviction policy, one of
+            :data:`EVICTION_POLICIES` (default: 'lru')
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, eviction='lru', name='sample_cache'):
+        super().__init__(max_items=max_items, max_bytes=max_bytes, name=name)
+        self.eviction = eviction
+        self._policy = EVICTION_POLICIES[eviction]()
+        self._items = {}
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, default=None):
+        item = self._items.get(key, _MISSING)
+        if item is _MISSING:
+            self._stats[1] += 1
+            return default
+        self._stats[0] += 1
+        self._policy.touch(key)
+        return item[0]
+
+    def put(self, key, value):
+        if key in self._items:
+            return
+        nbytes = sizeof(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        while self._items and (
+            (self.max_items is not None and len(self._items) >= self.max_items)
+            or (self.max_bytes is not None and self._nbytes + nbytes > self.max_bytes)
+        ):
+            evicted = self._policy.evict()
+            self._nbytes -= self._items.pop(evicted)[1]
+            self._stats[2] += 1
+        self._items[key] = (value, nbytes)
+        self._nbytes += nbytes
+        self._policy.add(key)
+
+    def clear(self):
+        self._policy = EVICTION_POLICIES[self.eviction]()
+        self._items = {}
+        self._nbytes = 0
+
+
+def log_stats():
+    """Logs the counters of all sample caches through
+    :mod:`fairseq.logging.metrics`."""
+    for cache in list(_caches):
+        cache.log_stats()
@@ -30,6 +30,12 @@ class TruncateDataset(BaseWrapperDataset):
     def sizes(self):
         return np.minimum(self.dataset.sizes, self.truncation_length)
 
+    def sizes_array(self):
+        sizes = super().sizes_array()
+        if sizes is not None:
+            sizes = np.minimum(sizes, self.truncation_length)
+        return sizes
+
     def __len__(self):
         return len(self.dataset)
 
@@ -57,6 +57,12 @@ class SubsampleDataset(BaseWrapperDataset):
     def size(self, index):
         return self.dataset.size(self.indices[index])
 
+    def sizes_array(self):
+        sizes = super().sizes_array()
+        if sizes is None:
+            return None
+        return sizes[self.indices]
+
     def ordered_indices(self):
         """Return an ordered list of indices. Batches will be constructed based
         on this order."""
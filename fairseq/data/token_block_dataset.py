@@ -96,9 +96,9 @@ class TokenBlockDataset(FairseqDataset):
                 sizes,
                 slice_indices,
             )
-        self._slice_indices = plasma_utils.PlasmaArray(slice_indices)
-        self._sizes = plasma_utils.PlasmaArray(self._sizes)
-        self._block_to_dataset_index = plasma_utils.PlasmaArray(block_to_dataset_index)
+        self._slice_indices = plasma_utils.SharedArray(slice_indices)
+        self._sizes = plasma_utils.SharedArray(self._sizes)
+        self._block_to_dataset_index = plasma_utils.SharedArray(block_to_dataset_index)
 
     @property
     def slice_indices(self):
@@ -119,30 +119,40 @@ class TokenBlockDataset(FairseqDataset):
     def __getitem__(self, index):
         start_ds_idx, start_offset, end_ds_idx = self.block_to_dataset_index[index]
 
-        buffer = torch.cat(
-            [self.dataset[idx] for idx in range(start_ds_idx, end_ds_idx + 1)]
-        )
-
         slice_s, slice_e = self.slice_indices[index]
         length = slice_e - slice_s
         s, e = start_offset, start_offset + length
-        item = buffer[s:e]
+
+        if hasattr(self.dataset, "get_range") and (not self.include_targets or e >= 2):
+            # read the block directly from the contiguous token buffer
+            def buffer(start, end):
+                tokens = self.dataset.get_range(start_ds_idx, start, end - start)
+                return torch.from_numpy(tokens.astype(np.int64))
+        else:
+            tokens = torch.cat(
+                [self.dataset[idx] for idx in range(start_ds_idx, end_ds_idx + 1)]
+            )
+
+            def buffer(start, end):
+                return tokens[start:end]
+
+        item = buffer(s, e)
 
         if self.include_targets:
             # *target* is the original sentence (=item)
             # *source* is shifted right by 1 (maybe left-padded with eos)
             # *past_target* is shifted right by 2 (left-padded as needed)
             if s == 0:
-                source = torch.cat([item.new([self.eos]), buffer[0 : e - 1]])
+                source = torch.cat([item.new([self.eos]), buffer(0, e - 1)])
                 past_target = torch.cat(
-                    [item.new([self.pad, self.eos]), buffer[0 : e - 2]]
+                    [item.new([self.pad, self.eos]), buffer(0, e - 2)]
                 )
             else:
-                source = buffer[s - 1 : e - 1]
+                source = buffer(s - 1, e - 1)
                 if s == 1:
-                    past_target = torch.cat([item.new([self.eos]), buffer[0 : e - 2]])
+                    past_target = torch.cat([item.new([self.eos]), buffer(0, e - 2)])
                 else:
-                    past_target = buffer[s - 2 : e - 2]
+                    past_target = buffer(s - 2, e - 2)
 
             return source, item, past_target
 
@@ -6,6 +6,7 @@
 from typing import Dict, Optional
 import uuid
 
+import torch
 from torch import Tensor
 
 
@@ -48,3 +49,36 @@ class FairseqIncrementalState(object):
 def with_incremental_state(cls):
     cls.__bases__ = (FairseqIncrementalState,) + tuple(b for b in cls.__bases__ if b != FairseqIncrementalState)
     return cls
+
+
+def enable_kv_cache(
+    incremental_state: Dict[str, Dict[str, Optional[Tensor]]], max_len: int
+):
+    """Make the attention modules using *incremental_state* preallocate their
+    keys and values for *max_len* steps, instead of concatenating them at
+    every step (see :class:`fairseq.modules.MultiheadAttention`)."""
+    incremental_state["kv_cache"] = torch.jit.annotate(
+        Dict[str, Optional[Tensor]], {"max_len": torch.tensor(max_len)}
+    )
+
+
+def share_encoder_kv(
+    incremental_state: Dict[str, Dict[str, Optional[Tensor]]], beam_size: int
+):
+    """Tell the encoder-decoder attention modules using *incremental_state*
+    that their keys and values are shared by the *beam_size* consecutive
+    hypotheses of each sentence, instead of being repeated for each of them
+    (see :class:`fairseq.modules.MultiheadAttention`)."""
+    incremental_state["shared_encoder_kv"] = torch.jit.annotate(
+        Dict[str, Optional[Tensor]], {"beam_size": torch.tensor(beam_size)}
+    )
+
+
+def left_pad_positions(incremental_state: Dict[str, Dict[str, Optional[Tensor]]]):
+    """Tell the decoders using *incremental_state* that their previous output
+    tokens may be left-padded, so that the position of the current step is
+    computed for each row from its number of non-padding tokens (see
+    :class:`fairseq.models.transformer.TransformerDecoder`)."""
+    incremental_state["left_pad_positions"] = torch.jit.annotate(
+        Dict[str, Optional[Tensor]], {}
+    )
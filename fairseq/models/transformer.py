@@ -259,25 +259,49 @@ class TransformerModel(FairseqEncoderDecoderModel):
         features_only: bool = False,
         alignment_layer: Optional[int] = None,
         alignment_heads: Optional[int] = None,
+        src_segments: Optional[Tensor] = None,
+        tgt_segments: Optional[Tensor] = None,
     ):
         """
         Run the forward pass for an encoder-decoder model.
 
         Copied from the base class, but without ``**kwargs``,
         which are not supported by TorchScript.
+
+        *src_segments* and *tgt_segments* are given for packed batches, see
+        :func:`fairseq.data.language_pair_dataset.collate_packed`.
         """
-        encoder_out = self.encoder(
-            src_tokens, src_lengths=src_lengths, return_all_hiddens=return_all_hiddens
-        )
-        decoder_out = self.decoder(
-            prev_output_tokens,
-            encoder_out=encoder_out,
-            features_only=features_only,
-            alignment_layer=alignment_layer,
-            alignment_heads=alignment_heads,
-            src_lengths=src_lengths,
-            return_all_hiddens=return_all_hiddens,
-        )
+        if src_segments is None and tgt_segments is None:
+            encoder_out = self.encoder(
+                src_tokens, src_lengths=src_lengths, return_all_hiddens=return_all_hiddens
+            )
+            decoder_out = self.decoder(
+                prev_output_tokens,
+                encoder_out=encoder_out,
+                features_only=features_only,
+                alignment_layer=alignment_layer,
+                alignment_heads=alignment_heads,
+                src_lengths=src_lengths,
+                return_all_hiddens=return_all_hiddens,
+            )
+        else:
+            encoder_out = self.encoder(
+                src_tokens,
+                src_lengths=src_lengths,
+                return_all_hiddens=return_all_hiddens,
+                src_segments=src_segments,
+            )
+            decoder_out = self.decoder(
+                prev_output_tokens,
+                encoder_out=encoder_out,
+                features_only=features_only,
+                alignment_layer=alignment_layer,
+                alignment_heads=alignment_heads,
+                src_lengths=src_lengths,
+                return_all_hiddens=return_all_hiddens,
+                src_segments=src_segments,
+                tgt_segments=tgt_segments,
+            )
         return decoder_out
 
     # Since get_normalized_probs is in the Fairseq Model which is not scriptable,
@@ -362,11 +386,17 @@ class TransformerEncoder(FairseqEncoder):
     def build_encoder_layer(self, args):
         return TransformerEncoderLayer(args)
 
-    def forward_embedding(self, src_tokens):
+    def forward_embedding(self, src_tokens, src_segments: Optional[Tensor] = None):
         # embed tokens and positions
         x = embed = self.embed_scale * self.embed_tokens(src_tokens)
         if self.embed_positions is not None:
-            x = embed + self.embed_positions(src_tokens)
+            if src_segments is None:
+                x = embed + self.embed_positions(src_tokens)
+            else:
+                x = embed + self.embed_positions(
+                    src_tokens,
+                    positions=utils.make_segment_positions(src_segments, self.padding_idx),
+                )
         if self.layernorm_embedding is not None:
             x = self.layernorm_embedding(x)
         x = self.dropout_module(x)
@@ -374,7 +404,13 @@ class TransformerEncoder(FairseqEncoder):
             x = self.quant_noise(x)
         return x, embed
 
-    def forward(self, src_tokens, src_lengths, return_all_hiddens: bool = False):
+    def forward(
+        self,
+        src_tokens,
+        src_lengths,
+        return_all_hiddens: bool = False,
+        src_segments: Optional[Tensor] = None,
+    ):
         """
         Args:
             src_tokens (LongTensor): tokens in the source language of shape
@@ -383,6 +419,9 @@ class TransformerEncoder(FairseqEncoder):
                 shape `(batch)`
             return_all_hiddens (bool, optional): also return all of the
                 intermediate hidden states (default: False).
+            src_segments (LongTensor, optional): segment ids of the tokens of
+                a packed batch of shape `(batch, src_len)`. Tokens only attend
+                to tokens of the same segment (default: None).
 
         Returns:
             namedtuple:
@@ -396,7 +435,7 @@ class TransformerEncoder(FairseqEncoder):
                   hidden states of shape `(src_len, batch, embed_dim)`.
                   Only populated if *return_all_hiddens* is True.
         """
-        x, encoder_embedding = self.forward_embedding(src_tokens)
+        x, encoder_embedding = self.forward_embedding(src_tokens, src_segments)
 
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
@@ -404,11 +443,15 @@ class TransformerEncoder(FairseqEncoder):
         # compute padding mask
         encoder_padding_mask = src_tokens.eq(self.padding_idx)
 
+        attn_mask: Optional[Tensor] = None
+        if src_segments is not None:
+            attn_mask = utils.segment_attention_mask(src_segments, src_segments).to(x)
+
         encoder_states = [] if return_all_hiddens else None
 
         # encoder layers
         for layer in self.layers:
-            x = layer(x, encoder_padding_mask)
+            x = layer(x, encoder_padding_mask, attn_mask=attn_mask)
             if return_all_hiddens:
                 assert encoder_states is not None
                 encoder_states.append(x)
@@ -646,6 +689,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         alignment_heads: Optional[int] = None,
         src_lengths: Optional[Any] = None,
         return_all_hiddens: bool = False,
+        src_segments: Optional[Tensor] = None,
+        tgt_segments: Optional[Tensor] = None,
     ):
         """
         Args:
@@ -657,19 +702,36 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 :ref:`Incremental decoding`
             features_only (bool, optional): only return features without
                 applying output layer (default: False).
+            src_segments (LongTensor, optional): segment ids of the source
+                tokens of a packed batch of shape `(batch, src_len)`
+            tgt_segments (LongTensor, optional): segment ids of
+                *prev_output_tokens* in a packed batch of shape
+                `(batch, tgt_len)`. Tokens only attend to (source) tokens of
+                the same segment.
 
         Returns:
             tuple:
                 - the decoder's output of shape `(batch, tgt_len, vocab)`
                 - a dictionary with any model-specific outputs
         """
-        x, extra = self.extract_features(
-            prev_output_tokens,
-            encoder_out=encoder_out,
-            incremental_state=incremental_state,
-            alignment_layer=alignment_layer,
-            alignment_heads=alignment_heads,
-        )
+        if src_segments is None and tgt_segments is None:
+            x, extra = self.extract_features(
+                prev_output_tokens,
+                encoder_out=encoder_out,
+                incremental_state=incremental_state,
+                alignment_layer=alignment_layer,
+                alignment_heads=alignment_heads,
+            )
+        else:
+            x, extra = self.extract_features(
+                prev_output_tokens,
+                encoder_out=encoder_out,
+                incremental_state=incremental_state,
+                alignment_layer=alignment_layer,
+                alignment_heads=alignment_heads,
+                src_segments=src_segments,
+                tgt_segments=tgt_segments,
+            )
         if not features_only:
             x = self.output_layer(x)
         return x, extra
@@ -682,6 +744,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         full_context_alignment: bool = False,
         alignment_layer: Optional[int] = None,
         alignment_heads: Optional[int] = None,
+        src_segments: Optional[Tensor] = None,
+        tgt_segments: Optional[Tensor] = None,
     ):
         return self.extract_features_scriptable(
             prev_output_tokens,
@@ -690,6 +754,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             full_context_alignment,
             alignment_layer,
             alignment_heads,
+            src_segments,
+            tgt_segments,
         )
 
     """
@@ -706,6 +772,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         full_context_alignment: bool = False,
         alignment_layer: Optional[int] = None,
         alignment_heads: Optional[int] = None,
+        src_segments: Optional[Tensor] = None,
+        tgt_segments: Optional[Tensor] = None,
     ):
         """
         Similar to *forward* but only return features.
@@ -730,13 +798,33 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             alignment_layer = self.num_layers - 1
 
         # embed positions
-        positions = (
-            self.embed_positions(
-                prev_output_tokens, incremental_state=incremental_state
-            )
-            if self.embed_positions is not None
-            else None
-        )
+        positions: Optional[Tensor] = None
+        if self.embed_positions is not None:
+            if (
+                tgt_segments is None
+                and incremental_state is not None
+                and "left_pad_positions" in incremental_state
+            ):
+                # left-padded hypotheses started decoding after the others,
+                # so the current step has a different position in each row
+                # (see :func:`fairseq.incremental_decoding_utils.left_pad_positions`)
+                positions = self.embed_positions(
+                    prev_output_tokens,
+                    incremental_state=incremental_state,
+                    positions=prev_output_tokens.ne(self.padding_idx).sum(
+                        dim=1, keepdim=True
+                    ) + self.padding_idx,
+                )
+            elif tgt_segments is None:
+                positions = self.embed_positions(
+                    prev_output_tokens, incremental_state=incremental_state
+                )
+            else:
+                positions = self.embed_positions(
+                    prev_output_tokens,
+                    incremental_state=incremental_state,
+                    positions=utils.make_segment_positions(tgt_segments, self.padding_idx),
+                )
 
         if incremental_state is not None:
             prev_output_tokens = prev_output_tokens[:, -1:]
@@ -767,6 +855,22 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         if self.cross_self_attention or prev_output_tokens.eq(self.padding_idx).any():
             self_attn_padding_mask = prev_output_tokens.eq(self.padding_idx)
 
+        # packed batches only attend within segments
+        segment_mask: Optional[Tensor] = None
+        encoder_attn_mask: Optional[Tensor] = None
+        if tgt_segments is not None:
+            segment_mask = x.new_zeros(
+                tgt_segments.size(0), tgt_segments.size(1), tgt_segments.size(1)
+            ).masked_fill(
+                utils.segment_attention_mask(tgt_segments, tgt_segments), float("-inf")
+            )
+            if src_segments is not None:
+                encoder_attn_mask = x.new_zeros(
+                    tgt_segments.size(0), tgt_segments.size(1), src_segments.size(1)
+                ).masked_fill(
+                    utils.segment_attention_mask(tgt_segments, src_segments), float("-inf")
+                )
+
         # decoder layers
         attn: Optional[Tensor] = None
         inner_states: List[Optional[Tensor]] = [x]
@@ -775,6 +879,11 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 self_attn_mask = self.buffered_future_mask(x)
             else:
                 self_attn_mask = None
+            if segment_mask is not None:
+                if self_attn_mask is None:
+                    self_attn_mask = segment_mask
+                else:
+                    self_attn_mask = self_attn_mask.unsqueeze(0) + segment_mask
 
             x, layer_attn, _ = layer(
                 x,
@@ -785,6 +894,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 self_attn_padding_mask=self_attn_padding_mask,
                 need_attn=bool((idx == alignment_layer)),
                 need_head_weights=bool((idx == alignment_layer)),
+                encoder_attn_mask=encoder_attn_mask,
             )
             inner_states.append(x)
             if layer_attn is not None and idx == alignment_layer:
@@ -34,11 +34,16 @@ class LearnedPositionalEmbedding(nn.Embedding):
         incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]] = None,
         positions: Optional[Tensor] = None,
     ):
-        """Input is expected to be of size [bsz x seqlen]."""
-        assert (positions is None) or (
-            self.padding_idx is None
-        ), "If positions is pre-computed then padding_idx should not be set."
-
+        """Input is expected to be of size [bsz x seqlen]. Pre-computed
+        *positions* must be offset by the padding index if it is set, see
+        :func:`fairseq.utils.make_positions`."""
+        padding_idx = self.padding_idx
+        if positions is not None and padding_idx is not None:
+            is_token = positions.ne(padding_idx)
+            if positions.size() == input.size():
+                is_token = input.ne(padding_idx)
+            assert bool((positions.gt(padding_idx) | ~is_token).all()), \
+                "pre-computed positions must start at padding_idx + 1"
         if positions is None:
             if incremental_state is not None:
                 # positions is the same for every token when decoding a single step
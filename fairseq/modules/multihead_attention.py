@@ -131,12 +131,20 @@ class MultiheadAttention(nn.Module):
                 averaged over heads (default: False).
             attn_mask (ByteTensor, optional): typically used to
                 implement causal attention, where the mask prevents the
-                attention from looking forward in time (default: None).
+                attention from looking forward in time, of shape
+                `(tgt_len, src_len)`, `(batch, tgt_len, src_len)` or
+                `(batch * num_heads, tgt_len, src_len)` (default: None).
             before_softmax (bool, optional): return the raw attention
                 weights and values before the attention softmax.
             need_head_weights (bool, optional): return the attention
                 weights for each head. Implies *need_weights*. Default:
                 return the average attention weights over all heads.
+
+        For encoder-decoder attention, the batch size of *key* and *value*
+        may divide the batch size of *query*, in which case each key is
+        attended to by that many consecutive queries (e.g., all the beams of
+        a sentence share the encoder output, see
+        :func:`fairseq.incremental_decoding_utils.share_encoder_kv`).
         """
         if need_head_weights:
             need_weights = True
@@ -145,6 +153,10 @@ class MultiheadAttention(nn.Module):
         assert embed_dim == self.embed_dim
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
 
+        if attn_mask is not None and attn_mask.dim() == 3 and attn_mask.size(0) != bsz * self.num_heads:
+            # per-sequence mask, shared by all heads
+            attn_mask = attn_mask.repeat_interleave(self.num_heads, dim=0)
+
         if (
             not self.onnx_trace
             and not self.tpu  # don't use PyTorch version on TPUs
@@ -179,6 +191,8 @@ class MultiheadAttention(nn.Module):
                 v_proj_weight=self.v_proj.weight,
             )
 
+        # batch size of the keys and values
+        kv_bsz = bsz
         if incremental_state is not None:
             saved_state = self._get_input_buffer(incremental_state)
             if saved_state is not None and "prev_key" in saved_state:
@@ -187,6 +201,9 @@ class MultiheadAttention(nn.Module):
                 if static_kv:
                     assert self.encoder_decoder_attention and not self.self_attention
                     key = value = None
+                    _prev_key = saved_state["prev_key"]
+                    assert _prev_key is not None
+                    kv_bsz = _prev_key.size(0)
         else:
             saved_state = None
 
@@ -203,6 +220,7 @@ class MultiheadAttention(nn.Module):
             else:
                 k = self.k_proj(key)
                 v = self.v_proj(key)
+                kv_bsz = key.size(1)
 
         else:
             assert key is not None and value is not None
@@ -213,8 +231,8 @@ class MultiheadAttention(nn.Module):
 
         if self.bias_k is not None:
             assert self.bias_v is not None
-            k = torch.cat([k, self.bias_k.repeat(1, bsz, 1)])
-            v = torch.cat([v, self.bias_v.repeat(1, bsz, 1)])
+            k = torch.cat([k, self.bias_k.repeat(1, kv_bsz, 1)])
+            v = torch.cat([v, self.bias_v.repeat(1, kv_bsz, 1)])
             if attn_mask is not None:
                 attn_mask = torch.cat(
                     [attn_mask, attn_mask.new_zeros(attn_mask.size(0), 1)], dim=1
@@ -236,36 +254,57 @@ class MultiheadAttention(nn.Module):
         if k is not None:
             k = (
                 k.contiguous()
-                .view(-1, bsz * self.num_heads, self.head_dim)
+                .view(-1, kv_bsz * self.num_heads, self.head_dim)
                 .transpose(0, 1)
             )
         if v is not None:
             v = (
                 v.contiguous()
-                .view(-1, bsz * self.num_heads, self.head_dim)
+                .view(-1, kv_bsz * self.num_heads, self.head_dim)
                 .transpose(0, 1)
             )
 
         if saved_state is not None:
+            assert incremental_state is not None
+            key_buffer: Optional[Tensor] = None
+            value_buffer: Optional[Tensor] = None
+            if not static_kv:
+                assert k is not None
+                key_buffer, value_buffer = self._get_kv_buffers(
+                    incremental_state, saved_state, k, bsz
+                )
             # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
-            if "prev_key" in saved_state:
-                _prev_key = saved_state["prev_key"]
-                assert _prev_key is not None
-                prev_key = _prev_key.view(bsz * self.num_heads, -1, self.head_dim)
-                if static_kv:
-                    k = prev_key
-                else:
-                    assert k is not None
-                    k = torch.cat([prev_key, k], dim=1)
-            if "prev_value" in saved_state:
-                _prev_value = saved_state["prev_value"]
-                assert _prev_value is not None
-                prev_value = _prev_value.view(bsz * self.num_heads, -1, self.head_dim)
-                if static_kv:
-                    v = prev_value
-                else:
-                    assert v is not None
-                    v = torch.cat([prev_value, v], dim=1)
+            if key_buffer is not None and value_buffer is not None:
+                # write the new steps in place, after the previous ones
+                assert k is not None and v is not None
+                prev_len = 0
+                _prev_key = saved_state.get("prev_key")
+                if _prev_key is not None:
+                    prev_len = _prev_key.size(2)
+                src_len = prev_len + k.size(1)
+                key_buffer[:bsz, :, prev_len:src_len] = k.view(bsz, self.num_heads, -1, self.head_dim)
+                value_buffer[:bsz, :, prev_len:src_len] = v.view(bsz, self.num_heads, -1, self.head_dim)
+                k = key_buffer[:bsz, :, :src_len].view(bsz * self.num_heads, -1, self.head_dim)
+                v = value_buffer[:bsz, :, :src_len].view(bsz * self.num_heads, -1, self.head_dim)
+            else:
+                if "prev_key" in saved_state:
+                    _prev_key = saved_state["prev_key"]
+                    assert _prev_key is not None
+                    prev_key = _prev_key.view(kv_bsz * self.num_heads, -1, self.head_dim)
+                    if static_kv:
+                        k = prev_key
+                    else:
+                        assert k is not None
+                        k = torch.cat([prev_key, k], dim=1)
+                if "prev_value" in saved_state:
+                    _prev_value = saved_state["prev_value"]
+                    assert _prev_value is not None
+                    prev_value = _prev_value.view(kv_bsz * self.num_heads, -1, self.head_dim)
+                    if static_kv:
+                        v = prev_value
+                    else:
+                        assert v is not None
+                        v = torch.cat([prev_value, v], dim=1)
             prev_key_padding_mask: Optional[Tensor] = None
             if "prev_key_padding_mask" in saved_state:
                 prev_key_padding_mask = saved_state["prev_key_padding_mask"]
@@ -273,16 +312,14 @@ class MultiheadAttention(nn.Module):
             key_padding_mask = MultiheadAttention._append_prev_key_padding_mask(
                 key_padding_mask=key_padding_mask,
                 prev_key_padding_mask=prev_key_padding_mask,
-                batch_size=bsz,
+                batch_size=kv_bsz,
                 src_len=k.size(1),
                 static_kv=static_kv,
             )
 
-            saved_state["prev_key"] = k.view(bsz, self.num_heads, -1, self.head_dim)
-            saved_state["prev_value"] = v.view(bsz, self.num_heads, -1, self.head_dim)
+            saved_state["prev_key"] = k.view(kv_bsz, self.num_heads, -1, self.head_dim)
+            saved_state["prev_value"] = v.view(kv_bsz, self.num_heads, -1, self.head_dim)
             saved_state["prev_key_padding_mask"] = key_padding_mask
-            # In this branch incremental_state is never None
-            assert incremental_state is not None
             incremental_state = self._set_input_buffer(incremental_state, saved_state)
         assert k is not None
         src_len = k.size(1)
@@ -292,6 +329,9 @@ class MultiheadAttention(nn.Module):
         if key_padding_mask is not None and key_padding_mask.dim() == 0:
             key_padding_mask = None
 
+        if key_padding_mask is not None and kv_bsz != bsz:
+            key_padding_mask = key_padding_mask.repeat_interleave(bsz // kv_bsz, dim=0)
+
         if key_padding_mask is not None:
             assert key_padding_mask.size(0) == bsz
             assert key_padding_mask.size(1) == src_len
@@ -316,15 +356,24 @@ class MultiheadAttention(nn.Module):
                     dim=1,
                 )
 
-        attn_weights = torch.bmm(q, k.transpose(1, 2))
+        if kv_bsz == bsz:
+            attn_weights = torch.bmm(q, k.transpose(1, 2))
+        else:
+            # broadcast the keys over the queries sharing them
+            attn_weights = torch.einsum(
+                "bxhtd,bhsd->bxhts",
+                q.view(kv_bsz, -1, self.num_heads, tgt_len, self.head_dim),
+                k.view(kv_bsz, self.num_heads, src_len, self.head_dim),
+            ).reshape(bsz * self.num_heads, tgt_len, src_len)
         attn_weights = MultiheadAttention.apply_sparse_mask(attn_weights, tgt_len, src_len, bsz)
 
         assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
 
         if attn_mask is not None:
-            attn_mask = attn_mask.unsqueeze(0)
-            if self.onnx_trace:
-                attn_mask = attn_mask.repeat(attn_weights.size(0), 1, 1)
+            if attn_mask.dim() == 2:
+                attn_mask = attn_mask.unsqueeze(0)
+                if self.onnx_trace:
+                    attn_mask = attn_mask.repeat(attn_weights.size(0), 1, 1)
             attn_weights += attn_mask
 
         if key_padding_mask is not None:
@@ -351,7 +400,14 @@ class MultiheadAttention(nn.Module):
         attn_probs = self.dropout_module(attn_weights)
 
         assert v is not None
-        attn = torch.bmm(attn_probs, v)
+        if kv_bsz == bsz:
+            attn = torch.bmm(attn_probs, v)
+        else:
+            attn = torch.einsum(
+                "bxhts,bhsd->bxhtd",
+                attn_probs.view(kv_bsz, -1, self.num_heads, tgt_len, src_len),
+                v.view(kv_bsz, self.num_heads, src_len, self.head_dim),
+            ).reshape(bsz * self.num_heads, tgt_len, self.head_dim)
         assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
         if self.onnx_trace and attn.size(1) == 1:
             # when ONNX tracing a single decoder step (sequence length == 1)
@@ -409,6 +465,43 @@ class MultiheadAttention(nn.Module):
             new_key_padding_mask = prev_key_padding_mask
         return new_key_padding_mask
 
+    def _get_kv_buffers(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        saved_state: Dict[str, Optional[Tensor]],
+        k: Tensor,
+        bsz: int,
+    ) -> Tuple[Optional[Tensor], Optional[Tensor]]:
+        """Return the preallocated key and value buffers of shape
+        `(bsz, num_heads, max_len, head_dim)` if they are enabled (see
+        :func:`fairseq.incremental_decoding_utils.enable_kv_cache`) and the
+        new steps fit in them, else `None` to concatenate the steps."""
+        key_buffer = saved_state.get("key_buffer")
+        value_buffer = saved_state.get("value_buffer")
+        prev_len = 0
+        prev_key = saved_state.get("prev_key")
+        if prev_key is not None:
+            prev_len = prev_key.size(2)
+        if key_buffer is None or value_buffer is None:
+            kv_cache = incremental_state.get("kv_cache")
+            if prev_len > 0 or kv_cache is None:
+                return None, None
+            max_len = kv_cache["max_len"]
+            assert max_len is not None
+            shape = [bsz, self.num_heads, int(max_len.item()), self.head_dim]
+            key_buffer = k.new_empty(shape)
+            value_buffer = k.new_empty(shape)
+            saved_state["key_buffer"] = key_buffer
+            saved_state["value_buffer"] = value_buffer
+        if key_buffer.size(0) < bsz or key_buffer.size(2) < prev_len + k.size(1):
+            # does not fit anymore, fall back to concatenation
+            saved_state["key_buffer"] = None
+            saved_state["value_buffer"] = None
+            saved_state["key_swap"] = None
+            saved_state["value_swap"] = None
+            return None, None
+        return key_buffer, value_buffer
+
     @torch.jit.export
     def reorder_incremental_state(
         self, incremental_state: Dict[str, Dict[str, Optional[Tensor]]], new_order: Tensor
@@ -416,15 +509,62 @@ class MultiheadAttention(nn.Module):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
+            kv_order = new_order
+            shared_encoder_kv = incremental_state.get("shared_encoder_kv")
+            if self.encoder_decoder_attention and shared_encoder_kv is not None:
+                # the static keys and values are shared by the beams of each
+                # sentence, which only change when sentences are removed
+                beam_size = shared_encoder_kv["beam_size"]
+                assert beam_size is not None
+                kv_order = new_order.view(-1, int(beam_size.item()))[:, 0] // beam_size
+            key_buffer = input_buffer.get("key_buffer")
+            value_buffer = input_buffer.get("value_buffer")
+            if key_buffer is not None and value_buffer is not None:
+                # preallocated buffers are reordered into a second pair of
+                # buffers, which then take their place
+                input_buffer["key_buffer"], input_buffer["key_swap"] = self._reorder_kv_buffer(
+                    input_buffer, "prev_key", key_buffer, input_buffer.get("key_swap"), new_order
+                )
+                input_buffer["value_buffer"], input_buffer["value_swap"] = self._reorder_kv_buffer(
+                    input_buffer, "prev_value", value_buffer, input_buffer.get("value_swap"), new_order
+                )
             for k in input_buffer.keys():
+                if k in ["prev_key", "prev_value"] and key_buffer is not None:
+                    continue
+                if k in ["key_buffer", "value_buffer", "key_swap", "value_swap"]:
+                    continue
                 input_buffer_k = input_buffer[k]
                 if input_buffer_k is not None:
-                    if self.encoder_decoder_attention and input_buffer_k.size(0) == new_order.size(0):
-                        break
-                    input_buffer[k] = input_buffer_k.index_select(0, new_order)
+                    if self.encoder_decoder_attention:
+                        if input_buffer_k.size(0) == kv_order.size(0):
+                            break
+                        input_buffer[k] = input_buffer_k.index_select(0, kv_order)
+                    else:
+                        input_buffer[k] = input_buffer_k.index_select(0, new_order)
             incremental_state = self._set_input_buffer(incremental_state, input_buffer)
         return incremental_state
 
+    @staticmethod
+    def _reorder_kv_buffer(
+        input_buffer: Dict[str, Optional[Tensor]],
+        key: str,
+        buffer: Tensor,
+        swap: Optional[Tensor],
+        new_order: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        if swap is None:
+            swap = torch.empty_like(buffer)
+        prev = input_buffer[key]
+        assert prev is not None
+        out = swap[: new_order.size(0), :, : prev.size(2)]
+        if prev.requires_grad:
+            # out= does not support autograd
+            out.copy_(prev.index_select(0, new_order))
+        else:
+            torch.index_select(prev, 0, new_order, out=out)
+        input_buffer[key] = out
+        return swap, buffer
+
     def _get_input_buffer(
         self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
     ) -> Dict[str, Optional[Tensor]]:
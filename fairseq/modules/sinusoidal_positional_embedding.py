@@ -62,9 +62,11 @@ class SinusoidalPositionalEmbedding(nn.Module):
         input,
         incremental_state: Optional[Any] = None,
         timestep: Optional[Tensor] = None,
-        positions: Optional[Any] = None,
+        positions: Optional[Tensor] = None,
     ):
-        """Input is expected to be of size [bsz x seqlen]."""
+        """Input is expected to be of size [bsz x seqlen]. Pre-computed
+        *positions* must be offset by the padding index, and may only cover
+        the last steps of *input*."""
         bspair = torch.onnx.operators.shape_as_tensor(input)
         bsz, seq_len = bspair[0], bspair[1]
         max_pos = self.padding_idx + 1 + seq_len
@@ -75,7 +77,7 @@ class SinusoidalPositionalEmbedding(nn.Module):
             )
         self.weights = self.weights.to(self._float_tensor)
 
-        if incremental_state is not None:
+        if incremental_state is not None and positions is None:
             # positions is the same for every token when decoding a single step
             pos = timestep.view(-1)[0] + 1 if timestep is not None else seq_len
             if self.onnx_trace:
@@ -86,9 +88,10 @@ class SinusoidalPositionalEmbedding(nn.Module):
                 )
             return self.weights[self.padding_idx + pos, :].expand(bsz, 1, -1)
 
-        positions = utils.make_positions(
-            input, self.padding_idx, onnx_trace=self.onnx_trace
-        )
+        if positions is None:
+            positions = utils.make_positions(
+                input, self.padding_idx, onnx_trace=self.onnx_trace
+            )
         if self.onnx_trace:
             flat_embeddings = self.weights.detach().index_select(0, positions.view(-1))
             embedding_shape = torch.cat(
@@ -100,6 +103,6 @@ class SinusoidalPositionalEmbedding(nn.Module):
             return embeddings
         return (
             self.weights.index_select(0, positions.view(-1))
-            .view(bsz, seq_len, -1)
+            .view(positions.size(0), positions.size(1), -1)
             .detach()
         )
@@ -93,9 +93,10 @@ class TransformerEncoderLayer(nn.Module):
             x (Tensor): input to the layer of shape `(seq_len, batch, embed_dim)`
             encoder_padding_mask (ByteTensor): binary ByteTensor of shape
                 `(batch, seq_len)` where padding elements are indicated by ``1``.
-            attn_mask (ByteTensor): binary tensor of shape `(tgt_len, src_len)`,
-                where `tgt_len` is the length of output and `src_len` is the
-                length of input, though here both are equal to `seq_len`.
+            attn_mask (ByteTensor): binary tensor of shape `(tgt_len, src_len)`
+                or `(batch, tgt_len, src_len)`, where `tgt_len` is the length of
+                output and `src_len` is the length of input, though here both
+                are equal to `seq_len`.
                 `attn_mask[tgt_i, src_j] = 1` means that when calculating the
                 embedding for `tgt_i`, we exclude (mask out) `src_j`. This is
                 useful for strided self-attention.
@@ -255,6 +256,7 @@ class TransformerDecoderLayer(nn.Module):
         self_attn_padding_mask: Optional[torch.Tensor] = None,
         need_attn: bool = False,
         need_head_weights: bool = False,
+        encoder_attn_mask: Optional[torch.Tensor] = None,
     ):
         """
         Args:
@@ -265,6 +267,8 @@ class TransformerDecoderLayer(nn.Module):
             need_attn (bool, optional): return attention weights
             need_head_weights (bool, optional): return attention weights
                 for each head (default: return average over heads).
+            encoder_attn_mask (Tensor, optional): additive mask of the
+                encoder attention of shape `(batch, seq_len, src_len)`.
 
         Returns:
             encoded output of shape `(seq_len, batch, embed_dim)`
@@ -348,6 +352,7 @@ class TransformerDecoderLayer(nn.Module):
                 static_kv=True,
                 need_weights=need_attn or (not self.training and self.need_attn),
                 need_head_weights=need_head_weights,
+                attn_mask=encoder_attn_mask,
             )
             x = self.dropout_module(x)
             x = residual + x
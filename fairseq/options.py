@@ -330,6 +330,12 @@ def add_preprocess_args(parser):
                        help="Pad dictionary size to be multiple of N")
     group.add_argument("--workers", metavar="N", default=1, type=int,
                        help="number of parallel workers")
+    group.add_argument("--single-pass", action="store_true",
+                       help="read and tokenize the training data only once to both "
+                            "build the dictionaries and binarize it")
+    group.add_argument("--append", action="store_true",
+                       help="append to the datasets in --destdir, binarizing the new data "
+                            "with the dictionaries there (mmap datasets only)")
     # fmt: on
     return parser
 
@@ -339,12 +345,23 @@ def add_dataset_args(parser, train=False, gen=False):
     # fmt: off
     group.add_argument('--num-workers', default=1, type=int, metavar='N',
                        help='how many subprocesses to use for data loading')
+    group.add_argument('--persistent-workers', action='store_true',
+                       help='keep the data loading workers alive across epochs '
+                            '(not for datasets that change between epochs, '
+                            'requires PyTorch >= 1.7)')
     group.add_argument('--skip-invalid-size-inputs-valid-test', action='store_true',
                        help='ignore too long or too short lines in valid and test set')
     group.add_argument('--max-tokens', type=int, metavar='N',
                        help='maximum number of tokens in a batch')
     group.add_argument('--max-sentences', '--batch-size', type=int, metavar='N',
                        help='maximum number of sentences in a batch')
+    group.add_argument('--batch-planner', default='greedy', choices=['greedy', 'padded_cost'],
+                       help='greedy: fill batches in the order of the dataset; '
+                            'padded_cost: sort the whole dataset by length and bound the '
+                            'padded tokens of the source and target separately')
+    group.add_argument('--max-attention-tokens', type=int, metavar='N',
+                       help='with --batch-planner=padded_cost, maximum value of '
+                            'batch size * length^2 in a batch')
     group.add_argument('--required-batch-size-multiple', default=8, type=int, metavar='N',
                        help='batch size will either be less than this value, '
                             'or a multiple of this value')
@@ -353,6 +370,13 @@ def add_dataset_args(parser, train=False, gen=False):
                         help='output dataset implementation')
     group.add_argument('--data-buffer-size', default=10, type=int, metavar='N',
                         help='number of batches to preload')
+    group.add_argument('--prefetch-to-device', action='store_true',
+                       help='pin batches and copy them to the GPU one batch ahead '
+                            'on a separate CUDA stream')
+    group.add_argument('--batch-plan-cache-dir', metavar='DIR', default=None,
+                       help='cache the filtered and batched dataset indices in this '
+                            'directory, so that later runs with the same data and '
+                            'batching options can skip computing them')
     if train:
         group.add_argument('--train-subset', default='train', metavar='SPLIT',
                            help='data subset to use for training (e.g. train, valid, test)')
@@ -603,6 +627,12 @@ def add_generation_args(parser):
                        help='initialize generation by target prefix of given length')
     group.add_argument('--no-repeat-ngram-size', default=0, type=int, metavar='N',
                        help='ngram blocking such that this size ngram cannot be repeated in the generation')
+    group.add_argument('--preallocate-kv-cache', action='store_true',
+                       help='preallocate the cached keys and values of the decoder for the '
+                            'maximum output length instead of growing them at every step')
+    group.add_argument('--share-encoder-out', action='store_true',
+                       help='keep one copy of the encoder output and of the encoder-decoder '
+                            'attention keys and values for all the beams of a sentence')
     group.add_argument('--sampling', action='store_true',
                        help='sample hypotheses instead of using beam search')
     group.add_argument('--sampling-topk', default=-1, type=int, metavar='PS',
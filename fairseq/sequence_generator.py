@@ -10,8 +10,10 @@ import torch
 import torch.nn as nn
 from fairseq import search, utils
 from fairseq.data import data_utils
+from fairseq.incremental_decoding_utils import enable_kv_cache, share_encoder_kv
 from fairseq.models import FairseqIncrementalDecoder
 from fairseq.models.fairseq_encoder import EncoderOut
+from fairseq.models.transformer import TransformerDecoder
 from torch import Tensor
 
 
@@ -33,6 +35,8 @@ class SequenceGenerator(nn.Module):
         search_strategy=None,
         eos=None,
         symbols_to_strip_from_output=None,
+        preallocate_kv_cache=False,
+        share_encoder_out=False,
     ):
         """Generates translations of a given source sentence.
 
@@ -55,6 +59,13 @@ class SequenceGenerator(nn.Module):
                 sharper samples (default: 1.0)
             match_source_len (bool, optional): outputs should match the source
                 length (default: False)
+            preallocate_kv_cache (bool, optional): preallocate the keys and
+                values of the attention layers for the maximum output length,
+                instead of concatenating them at every step (default: False)
+            share_encoder_out (bool, optional): keep a single copy of the
+                encoder output and of the encoder-decoder attention keys and
+                values for all the beams of a sentence, instead of one per
+                beam; only supported by transformer decoders (default: False)
         """
         super().__init__()
         if isinstance(models, EnsembleModel):
@@ -81,6 +92,13 @@ class SequenceGenerator(nn.Module):
         self.temperature = temperature
         self.match_source_len = match_source_len
         self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.preallocate_kv_cache = preallocate_kv_cache
+        self.share_encoder_out = share_encoder_out
+        if share_encoder_out:
+            assert all(
+                isinstance(m.decoder, TransformerDecoder) and not m.decoder.cross_self_attention
+                for m in self.model.models
+            ), "--share-encoder-out is only supported by transformer decoders"
         assert temperature > 0, "--temperature must be greater than 0"
 
         self.search = (
@@ -204,13 +222,21 @@ class SequenceGenerator(nn.Module):
         assert (
             self.min_len <= max_len
         ), "min_len cannot be larger than max_len, please adjust these!"
+        if self.preallocate_kv_cache:
+            for incremental_state in incremental_states:
+                # +1 for the EOS step
+                enable_kv_cache(incremental_state, max_len + 1)
+        if self.share_encoder_out:
+            for incremental_state in incremental_states:
+                share_encoder_kv(incremental_state, beam_size)
         # compute the encoder output for each beam
         encoder_outs = self.model.forward_encoder(net_input)
 
         # placeholder of indices for bsz * beam_size to hold tokens and accumulative scores
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
         new_order = new_order.to(src_tokens.device).long()
-        encoder_outs = self.model.reorder_encoder_out(encoder_outs, new_order)
+        if not self.share_encoder_out:
+            encoder_outs = self.model.reorder_encoder_out(encoder_outs, new_order)
         # ensure encoder_outs is a List.
         assert encoder_outs is not None
 
@@ -235,16 +261,21 @@ class SequenceGenerator(nn.Module):
             torch.zeros(bsz, beam_size).to(src_tokens).eq(-1)
         )  # forward and backward-compatible False mask
 
-        # list of completed sentences
-        finalized = torch.jit.annotate(
-            List[List[Dict[str, Tensor]]],
-            [torch.jit.annotate(List[Dict[str, Tensor]], []) for i in range(bsz)],
-        )  # contains lists of dictionaries of infomation about the hypothesis being finalized at each step
-
-        finished = [
-            False for i in range(bsz)
-        ]  # a boolean array indicating if the sentence at the index is finished or not
-        num_remaining_sent = bsz  # number of sentences remaining
+        # buffers of the hypotheses finalized for each sentence, with an extra
+        # slot per sentence which receives those beyond beam_size
+        fin_tokens = (
+            torch.zeros(bsz, beam_size + 1, max_len + 1)
+            .to(src_tokens)
+            .long()
+            .fill_(self.pad)
+        )
+        fin_scores = torch.zeros(bsz, beam_size + 1).to(scores)
+        fin_pos_scores = torch.zeros(bsz, beam_size + 1, max_len + 1).to(scores)
+        fin_lengths = torch.zeros(bsz, beam_size + 1).to(tokens)
+        fin_attn: Optional[Tensor] = None
+        num_finalized = torch.zeros(bsz).to(tokens)
+        # index of the original sentence of each remaining sentence
+        sent_idxs = torch.arange(bsz).to(tokens)
 
         # number of candidate hypos per step
         cand_size = 2 * beam_size  # 2 x beam size in case half are EOS
@@ -268,9 +299,16 @@ class SequenceGenerator(nn.Module):
                         corr.unsqueeze(-1) * beam_size
                     )
                 self.model.reorder_incremental_state(incremental_states, reorder_state)
-                encoder_outs = self.model.reorder_encoder_out(
-                    encoder_outs, reorder_state
-                )
+                if not self.share_encoder_out:
+                    encoder_outs = self.model.reorder_encoder_out(
+                        encoder_outs, reorder_state
+                    )
+                elif batch_idxs is not None:
+                    # the beams of a sentence stay together, so the shared
+                    # encoder outputs only lose the finished sentences
+                    encoder_outs = self.model.reorder_encoder_out(
+                        encoder_outs, batch_idxs
+                    )
 
             lprobs, avg_attn_scores = self.model.forward_decoder(
                 tokens[:, : step + 1],
@@ -278,7 +316,7 @@ class SequenceGenerator(nn.Module):
                 incremental_states,
                 self.temperature,
             )
-            lprobs[lprobs != lprobs] = torch.tensor(-math.inf).to(lprobs)
+            lprobs.masked_fill_(lprobs != lprobs, -math.inf)
 
             lprobs[:, self.pad] = -math.inf  # never select pad
             lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
@@ -307,15 +345,12 @@ class SequenceGenerator(nn.Module):
                     attn = torch.empty(
                         bsz * beam_size, avg_attn_scores.size(1), max_len + 2
                     ).to(scores)
+                    fin_attn = torch.zeros(
+                        fin_tokens.size(0), beam_size + 1, avg_attn_scores.size(1), max_len + 1
+                    ).to(scores)
                 attn[:, :, step + 1].copy_(avg_attn_scores)
 
             scores = scores.type_as(lprobs)
-            eos_bbsz_idx = torch.empty(0).to(
-                tokens
-            )  # indices of hypothesis ending with eos (finished sentences)
-            eos_scores = torch.empty(0).to(
-                scores
-            )  # scores of hypothesis ending with eos (finished sentences)
 
             if self.should_set_src_lengths:
                 self.search.set_src_lengths(src_lengths)
@@ -336,64 +371,74 @@ class SequenceGenerator(nn.Module):
 
             # finalize hypotheses that end in eos
             eos_mask = cand_indices.eq(self.eos) & cand_scores.ne(-math.inf)
-            eos_mask[:, :beam_size][cands_to_ignore] = torch.tensor(0).to(eos_mask)
+            eos_mask[:, :beam_size].masked_fill_(cands_to_ignore, False)
 
             # only consider eos when it's among the top beam_size indices
-            eos_bbsz_idx = torch.masked_select(
-                cand_bbsz_idx[:, :beam_size], mask=eos_mask[:, :beam_size]
+            top_eos_mask = eos_mask[:, :beam_size]
+            # slot of each hypothesis among the finalized hypotheses of its
+            # sentence, those beyond beam_size are not kept
+            eos_slots = (
+                num_finalized[sent_idxs].unsqueeze(1)
+                + top_eos_mask.long().cumsum(dim=1)
+                - 1
             )
-
-            finalized_sents: List[int] = []
-            if eos_bbsz_idx.numel() > 0:
-                eos_scores = torch.masked_select(
-                    cand_scores[:, :beam_size], mask=eos_mask[:, :beam_size]
-                )
-                finalized_sents = self.finalize_hypos(
+            num_finalized[sent_idxs] = (eos_slots[:, -1] + 1).clamp(max=beam_size)
+            # check termination conditions of the sentences
+            finished = top_eos_mask.any(dim=1)
+            if step < max_len:
+                finished = finished & num_finalized[sent_idxs].eq(beam_size)
+
+            # the only values of the step which are copied to the host
+            counts: List[int] = torch.stack(
+                [top_eos_mask.long().sum(), (~finished).long().sum()]
+            ).tolist()
+            num_eos, new_bsz = counts[0], counts[1]
+            if num_eos > 0:
+                self.finalize_hypos(
                     step,
-                    eos_bbsz_idx,
-                    eos_scores,
+                    self._masked_indices(top_eos_mask.reshape(-1), num_eos),
+                    cand_bbsz_idx[:, :beam_size],
+                    cand_scores[:, :beam_size],
+                    eos_slots,
                     tokens,
                     scores,
-                    finalized,
-                    finished,
-                    beam_size,
                     attn,
+                    sent_idxs,
+                    fin_tokens,
+                    fin_scores,
+                    fin_pos_scores,
+                    fin_lengths,
+                    fin_attn,
+                    beam_size,
                     src_lengths,
-                    max_len,
                 )
-                num_remaining_sent -= len(finalized_sents)
 
-            assert num_remaining_sent >= 0
-            if num_remaining_sent == 0:
+            if new_bsz == 0:
                 break
             assert step < max_len
 
-            if len(finalized_sents) > 0:
-                new_bsz = bsz - len(finalized_sents)
+            if new_bsz < bsz:
+                # indices of the sentences to keep for the next pass
+                keep_idxs = self._masked_indices(~finished, new_bsz)
+                batch_idxs = keep_idxs
+                sent_idxs = sent_idxs[keep_idxs]
 
-                # construct batch_idxs which holds indices of batches to keep for the next pass
-                batch_mask = torch.ones(bsz).to(cand_indices)
-                batch_mask[
-                    torch.tensor(finalized_sents).to(cand_indices)
-                ] = torch.tensor(0).to(batch_mask)
-                batch_idxs = batch_mask.nonzero().squeeze(-1)
-
-                eos_mask = eos_mask[batch_idxs]
-                cand_beams = cand_beams[batch_idxs]
+                eos_mask = eos_mask[keep_idxs]
+                cand_beams = cand_beams[keep_idxs]
                 bbsz_offsets.resize_(new_bsz, 1)
                 cand_bbsz_idx = cand_beams.add(bbsz_offsets)
-                cand_scores = cand_scores[batch_idxs]
-                cand_indices = cand_indices[batch_idxs]
+                cand_scores = cand_scores[keep_idxs]
+                cand_indices = cand_indices[keep_idxs]
 
                 if prefix_tokens is not None:
-                    prefix_tokens = prefix_tokens[batch_idxs]
-                src_lengths = src_lengths[batch_idxs]
-                cands_to_ignore = cands_to_ignore[batch_idxs]
+                    prefix_tokens = prefix_tokens[keep_idxs]
+                src_lengths = src_lengths[keep_idxs]
+                cands_to_ignore = cands_to_ignore[keep_idxs]
 
-                scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
-                tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                scores = scores.view(bsz, -1)[keep_idxs].view(new_bsz * beam_size, -1)
+                tokens = tokens.view(bsz, -1)[keep_idxs].view(new_bsz * beam_size, -1)
                 if attn is not None:
-                    attn = attn.view(bsz, -1)[batch_idxs].view(
+                    attn = attn.view(bsz, -1)[keep_idxs].view(
                         new_bsz * beam_size, attn.size(1), -1
                     )
                 bsz = new_bsz
@@ -419,7 +464,13 @@ class SequenceGenerator(nn.Module):
 
             # update cands_to_ignore to ignore any finalized hypos
             cands_to_ignore = new_cands_to_ignore.ge(cand_size)[:, :beam_size]
-            assert (~cands_to_ignore).any(dim=1).all()
+            # every sentence keeps at least one active hypothesis, which is
+            # not asserted here to avoid synchronizing with the device: the
+            # last beam_size candidates are never ignored, and they can only
+            # all be EOS if the first beam_size hold no EOS, i.e. if those
+            # were all ignored because no hypothesis was active at the
+            # previous step, which never happens since none is ignored at
+            # the first step
 
             active_bbsz_idx = torch.gather(cand_bbsz_idx, dim=1, index=active_hypos)
             active_scores = torch.gather(cand_scores, dim=1, index=active_hypos)
@@ -451,16 +502,36 @@ class SequenceGenerator(nn.Module):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
-        for sent in range(len(finalized)):
+        # list of completed sentences, which contains lists of dictionaries of
+        # information about the finalized hypotheses
+        # (the tensors are cloned so that they do not keep the buffers of all
+        # the finalized hypotheses alive)
+        finalized = torch.jit.annotate(List[List[Dict[str, Tensor]]], [])
+        num_finalized_list: List[int] = num_finalized.tolist()
+        fin_scores_list: List[List[float]] = fin_scores.tolist()
+        fin_lengths_list: List[List[int]] = fin_lengths.tolist()
+        for sent in range(len(num_finalized_list)):
             # make into beam container
-            BCList = [
-                BeamContainer(elem["score"].item(), elem) for elem in finalized[sent]
-            ]
+            BCList: List[BeamContainer] = []
+            for i in range(num_finalized_list[sent]):
+                length = fin_lengths_list[sent][i]
+                if fin_attn is not None:
+                    hypo_attn = fin_attn[sent, i, :, :length].clone()
+                else:
+                    hypo_attn = torch.empty(0)
+                elem = {
+                    "tokens": fin_tokens[sent, i, :length].clone(),
+                    "score": fin_scores[sent, i].clone(),
+                    "attention": hypo_attn,  # src_len x tgt_len
+                    "alignment": torch.empty(0),
+                    "positional_scores": fin_pos_scores[sent, i, :length].clone(),
+                }
+                BCList.append(BeamContainer(fin_scores_list[sent][i], elem))
+            # sort by score descending
             BCList.sort()
             BCList.reverse()
-            finalized[sent] = torch.jit.annotate(
-                List[Dict[str, Tensor]], [x.elem for x in BCList]
+            finalized.append(
+                torch.jit.annotate(List[Dict[str, Tensor]], [x.elem for x in BCList])
             )
 
         return finalized
@@ -499,174 +570,102 @@ class SequenceGenerator(nn.Module):
         tensor[mask] = tensor[mask][:, :1, :]
         return tensor.view(-1, tensor.size(-1))
 
+    def _masked_indices(self, mask, num: int):
+        """Return the indices of the ``num`` true values of the 1-D ``mask``,
+        like ``mask.nonzero()`` but without waiting for the device to count
+        them."""
+        positions = mask.long().cumsum(dim=0) - 1
+        # the false values are scattered past the returned indices
+        positions = positions.masked_fill(~mask, mask.numel())
+        indices = torch.zeros(mask.numel() + 1).to(positions)
+        indices.scatter_(0, positions, torch.arange(mask.numel()).to(positions))
+        return indices[:num]
+
     def finalize_hypos(
         self,
         step: int,
-        bbsz_idx,
-        eos_scores,
+        eos_idx,
+        cand_bbsz_idx,
+        cand_scores,
+        eos_slots,
         tokens,
         scores,
-        finalized: List[List[Dict[str, Tensor]]],
-        finished: List[bool],
-        beam_size: int,
         attn: Optional[Tensor],
+        sent_idxs,
+        fin_tokens,
+        fin_scores,
+        fin_pos_scores,
+        fin_lengths,
+        fin_attn: Optional[Tensor],
+        beam_size: int,
         src_lengths,
-        max_len: int,
     ):
-        """Finalize hypothesis, store finalized information in `finalized`, and change `finished` accordingly.
-        Returns number of sentences being finalized.
+        """Finalize the hypotheses which end with eos, by copying them to the
+        buffers of finalized hypotheses of their sentence.
         Args:
-            bbsz_idx (Tensor):
+            eos_idx (Tensor): indices of the candidates which end with eos,
+                in the flattened (bsz, beam_size) candidates
+            cand_bbsz_idx (Tensor): the hypothesis of each candidate
+            cand_scores (Tensor): the cumulative score of each candidate
+            eos_slots (Tensor): the slot of each candidate among the finalized
+                hypotheses of its sentence
+            sent_idxs (Tensor): the original index of each sentence
         """
-        assert bbsz_idx.numel() == eos_scores.numel()
+        bbsz_idx = cand_bbsz_idx.reshape(-1).index_select(0, eos_idx)
+        eos_scores = cand_scores.reshape(-1).index_select(0, eos_idx)
+        unfin_idx = eos_idx // beam_size
+        # the hypotheses beyond beam_size go to the last, discarded, slot
+        slots = eos_slots.reshape(-1).index_select(0, eos_idx).clamp(max=beam_size)
+        fin_idx = sent_idxs.index_select(0, unfin_idx) * (beam_size + 1) + slots
 
         # clone relevant token and attention tensors
         tokens_clone = tokens.index_select(0, bbsz_idx)[
             :, 1 : step + 2
         ]  # skip the first index, which is EOS
-
         tokens_clone[:, step] = self.eos
-        attn_clone = (
-            attn.index_select(0, bbsz_idx)[:, :, 1 : step + 2]
-            if attn is not None
-            else None
+        fin_tokens.view(-1, fin_tokens.size(2))[:, : step + 1].index_copy_(
+            0, fin_idx, tokens_clone
         )
+        if attn is not None and fin_attn is not None:
+            attn_clone = attn.index_select(0, bbsz_idx)[:, :, 1 : step + 2]
+            fin_attn.view(-1, fin_attn.size(2), fin_attn.size(3))[
+                :, :, : step + 1
+            ].index_copy_(0, fin_idx, attn_clone)
 
         # compute scores per token position
         pos_scores = scores.index_select(0, bbsz_idx)[:, : step + 1]
         pos_scores[:, step] = eos_scores
         # convert from cumulative to per-position scores
         pos_scores[:, 1:] = pos_scores[:, 1:] - pos_scores[:, :-1]
+        fin_pos_scores.view(-1, fin_pos_scores.size(2))[:, : step + 1].index_copy_(
+            0, fin_idx, pos_scores
+        )
 
         # normalize sentence-level scores
         if self.normalize_scores:
-            eos_scores /= (step + 1) ** self.len_penalty
-
-        cum_unfin: List[int] = []
-        prev = 0
-        for f in finished:
-            if f:
-                prev += 1
-            else:
-                cum_unfin.append(prev)
-
-        # set() is not supported in script export
-        sents_seen: Dict[str, Optional[Tensor]] = {}
-        for i in range(bbsz_idx.size()[0]):
-            idx = bbsz_idx[i]
-            score = eos_scores[i]
-            unfin_idx = idx // beam_size
-            sent = unfin_idx + cum_unfin[unfin_idx]
-            # Cannot create dict for key type '(int, int)' in torchscript.
-            # The workaround is to cast int to string
-            seen = str(sent.item()) + "_" + str(unfin_idx.item())
-            if seen not in sents_seen:
-                sents_seen[seen] = None
-
-            if self.match_source_len and step > src_lengths[unfin_idx]:
-                score = torch.tensor(-math.inf).to(score)
-
-            if len(finalized[sent]) < beam_size:
-                if attn_clone is not None:
-                    # remove padding tokens from attn scores
-                    hypo_attn = attn_clone[i]
-                else:
-                    hypo_attn = torch.empty(0)
-                finalized[sent].append(
-                    {
-                        "tokens": tokens_clone[i],
-                        "score": score,
-                        "attention": hypo_attn,  # src_len x tgt_len
-                        "alignment": torch.empty(0),
-                        "positional_scores": pos_scores[i],
-                    }
-                )
-
-        newly_finished: List[int] = []
-        for seen in sents_seen.keys():
-            # check termination conditions for this sentence
-            sent: int = int(float(seen.split("_")[0]))
-            unfin_idx: int = int(float(seen.split("_")[1]))
-            if not finished[sent] and self.is_finished(
-                step, unfin_idx, max_len, len(finalized[sent]), beam_size
-            ):
-                finished[sent] = True
-                newly_finished.append(unfin_idx)
-        return newly_finished
-
-    def is_finished(
-        self,
-        step: int,
-        unfin_idx: int,
-        max_len: int,
-        finalized_sent_len: int,
-        beam_size: int,
-    ):
-        """
-        Check whether we've finished generation for a given sentence, by
-        comparing the worst score among finalized hypotheses to the best
-        possible score among unfinalized hypotheses.
-        """
-        assert finalized_sent_len <= beam_size
-        if finalized_sent_len == beam_size or step == max_len:
-            return True
-        return False
-
-    def calculate_banned_tokens(
-        self,
-        tokens,
-        step: int,
-        gen_ngrams: List[Dict[str, List[int]]],
-        no_repeat_ngram_size: int,
-        bbsz_idx: int,
-    ):
-        tokens_list: List[int] = tokens[
-            bbsz_idx, step + 2 - no_repeat_ngram_size : step + 1
-        ].tolist()
-        # before decoding the next token, prevent decoding of ngrams that have already appeared
-        ngram_index = ",".join([str(x) for x in tokens_list])
-        return gen_ngrams[bbsz_idx].get(ngram_index, torch.jit.annotate(List[int], []))
-
-    def transpose_list(self, l: List[List[int]]):
-        # GeneratorExp aren't supported in TS so ignoring the lint
-        min_len = min([len(x) for x in l])  # noqa
-        l2 = [[row[i] for row in l] for i in range(min_len)]
-        return l2
+            eos_scores = eos_scores / (step + 1) ** self.len_penalty
+        if self.match_source_len:
+            eos_scores = eos_scores.masked_fill(
+                src_lengths.index_select(0, unfin_idx).lt(step), -math.inf
+            )
+        fin_scores.view(-1).index_copy_(0, fin_idx, eos_scores)
+        fin_lengths.view(-1).index_fill_(0, fin_idx, step + 1)
 
     def _no_repeat_ngram(self, tokens, lprobs, bsz: int, beam_size: int, step: int):
-        # for each beam and batch sentence, generate a list of previous ngrams
-        gen_ngrams: List[Dict[str, List[int]]] = [
-            torch.jit.annotate(Dict[str, List[int]], {})
-            for bbsz_idx in range(bsz * beam_size)
-        ]
-        cpu_tokens = tokens.cpu()
-        for bbsz_idx in range(bsz * beam_size):
-            gen_tokens: List[int] = cpu_tokens[bbsz_idx].tolist()
-            for ngram in self.transpose_list(
-                [gen_tokens[i:] for i in range(self.no_repeat_ngram_size)]
-            ):
-                key = ",".join([str(x) for x in ngram[:-1]])
-                gen_ngrams[bbsz_idx][key] = gen_ngrams[bbsz_idx].get(
-                    key, torch.jit.annotate(List[int], [])
-                ) + [ngram[-1]]
-
-        if step + 2 - self.no_repeat_ngram_size >= 0:
+        """Ban the tokens which would repeat an ngram of the hypothesis."""
+        n = self.no_repeat_ngram_size
+        if step + 1 < n:
             # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-            banned_tokens = [
-                self.calculate_banned_tokens(
-                    tokens, step, gen_ngrams, self.no_repeat_ngram_size, bbsz_idx
-                )
-                for bbsz_idx in range(bsz * beam_size)
-            ]
-        else:
-            banned_tokens = [
-                torch.jit.annotate(List[int], []) for bbsz_idx in range(bsz * beam_size)
-            ]
-        for bbsz_idx in range(bsz * beam_size):
-            lprobs[bbsz_idx][
-                torch.tensor(banned_tokens[bbsz_idx]).long()
-            ] = torch.tensor(-math.inf, dtype=torch.float)
-        return lprobs
+            return lprobs
+        # all the ngrams of each hypothesis, of shape (bsz * beam_size, num_ngrams, n)
+        ngrams = tokens[:, : step + 1].unfold(1, n, 1)
+        # the ngrams starting with the last n - 1 tokens can't be completed
+        prefix = tokens[:, step + 2 - n : step + 1].unsqueeze(1)
+        matches = (ngrams[:, :, :-1] == prefix).all(dim=2)
+        # the last token of the other ngrams is replaced with pad, which is
+        # never selected anyway
+        banned_tokens = ngrams[:, :, -1].masked_fill(~matches, self.pad)
+        return lprobs.scatter_(1, banned_tokens, -math.inf)
 
 
 class EnsembleModel(nn.Module):
@@ -3,13 +3,17 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import logging
 import warnings
 import os
 
 import torch
 
 from fairseq import metrics, search, tokenizer, utils
-from fairseq.data import data_utils, FairseqDataset, iterators, Dictionary
+from fairseq.data import batch_plan_cache, data_utils, FairseqDataset, iterators, Dictionary
+
+
+logger = logging.getLogger(__name__)
 
 
 class FairseqTask(object):
@@ -163,26 +167,73 @@ class FairseqTask(object):
         # initialize the dataset with the correct starting epoch
         dataset.set_epoch(epoch)
 
-        # get indices ordered by example size
-        with data_utils.numpy_seed(seed):
-            indices = dataset.ordered_indices()
-
-        # filter examples that are too large
-        if max_positions is not None:
-            indices = data_utils.filter_by_size(
-                indices,
+        # only passed to batch_by_size when not using the default planner
+        planner_kwargs = {}
+        batch_planner = getattr(self.args, 'batch_planner', 'greedy')
+        if batch_planner != 'greedy':
+            planner_kwargs = {
+                'batch_planner': batch_planner,
+                'max_attention_tokens': getattr(self.args, 'max_attention_tokens', None),
+            }
+
+        cache_dir = getattr(self.args, 'batch_plan_cache_dir', None)
+        cache_key = None
+        if cache_dir is not None:
+            cache_key = batch_plan_cache.batch_plan_key(
                 dataset,
-                max_positions,
-                raise_exception=(not ignore_invalid_inputs),
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                max_positions=max_positions,
+                ignore_invalid_inputs=ignore_invalid_inputs,
+                required_batch_size_multiple=required_batch_size_multiple,
+                seed=seed,
+                epoch=epoch,
+                **planner_kwargs
+            )
+        batch_sampler = None
+        if cache_key is not None:
+            batch_sampler = batch_plan_cache.load_batch_plan(cache_dir, cache_key)
+            if batch_sampler is not None:
+                logger.info('loaded batch plan {} from {}'.format(cache_key, cache_dir))
+
+        if batch_sampler is None:
+            # get indices ordered by example size
+            with data_utils.numpy_seed(seed):
+                indices = dataset.ordered_indices()
+
+            # filter examples that are too large
+            if max_positions is not None:
+                indices = data_utils.filter_by_size(
+                    indices,
+                    dataset,
+                    max_positions,
+                    raise_exception=(not ignore_invalid_inputs),
+                )
+
+            # create mini-batches with given size constraints
+            batch_sampler = dataset.batch_by_size(
+                indices,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+                **planner_kwargs
             )
 
-        # create mini-batches with given size constraints
-        batch_sampler = dataset.batch_by_size(
-            indices,
-            max_tokens=max_tokens,
-            max_sentences=max_sentences,
-            required_batch_size_multiple=required_batch_size_multiple,
-        )
+            if cache_key is not None:
+                batch_plan_cache.save_batch_plan(cache_dir, cache_key, batch_sampler)
+
+        prefetch_device, prefetch_float_dtype = None, None
+        if (
+            getattr(self.args, 'prefetch_to_device', False)
+            and not getattr(self.args, 'cpu', False)
+            and not getattr(self.args, 'tpu', False)
+            and torch.cuda.is_available()
+        ):
+            prefetch_device = torch.device('cuda', torch.cuda.current_device())
+            if getattr(self.args, 'fp16', False):
+                prefetch_float_dtype = torch.half
+            elif getattr(self.args, 'bf16', False):
+                prefetch_float_dtype = torch.bfloat16
 
         # return a reusable, sharded iterator
         epoch_iter = iterators.EpochBatchIterator(
@@ -194,7 +245,10 @@ class FairseqTask(object):
             shard_id=shard_id,
             num_workers=num_workers,
             epoch=epoch,
-            buffer_size=getattr(self.args, 'data_buffer_size', 0)
+            buffer_size=getattr(self.args, 'data_buffer_size', 0),
+            prefetch_device=prefetch_device,
+            prefetch_float_dtype=prefetch_float_dtype,
+            persistent_workers=getattr(self.args, 'persistent_workers', False),
         )
         self.dataset_to_epoch_iter[dataset] = epoch_iter
         return epoch_iter
@@ -305,6 +359,10 @@ class FairseqTask(object):
             else:
                 seq_gen_cls = SequenceGenerator
         extra_gen_cls_kwargs = extra_gen_cls_kwargs or {}
+        if getattr(args, "preallocate_kv_cache", False):
+            extra_gen_cls_kwargs["preallocate_kv_cache"] = True
+        if getattr(args, "share_encoder_out", False):
+            extra_gen_cls_kwargs["share_encoder_out"] = True
         return seq_gen_cls(
             models,
             self.target_dictionary,
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import inspect
 import logging
 import os
 
@@ -88,6 +89,9 @@ class LanguageModelingTask(FairseqTask):
                             help='prepend beginning of sentence token (<s>)')
         parser.add_argument('--max-target-positions', type=int, metavar='N',
                             help='max number of tokens in the target sequence')
+        parser.add_argument('--pack-sequences', action='store_true',
+                            help='pack several training samples into each row of a batch '
+                                 '(transformer models only)')
         parser.add_argument('--shorten-method', default='none',
                             choices=['none', 'truncate', 'random_crop'],
                             help='if not none, shorten sequences that exceed --tokens-per-sample')
@@ -129,6 +133,9 @@ class LanguageModelingTask(FairseqTask):
             args (argparse.Namespace): parsed command-line arguments
         """
         dictionary, output_dictionary = cls.setup_dictionary(args, **kwargs)
+        if getattr(args, 'pack_sequences', False) and getattr(args, 'sentence_avg', False):
+            # packed batches have fewer rows than sentences
+            raise ValueError('--pack-sequences cannot be combined with --sentence-avg')
 
         # upgrade old checkpoints
         if hasattr(args, "exclude_self_target"):
@@ -156,6 +163,15 @@ class LanguageModelingTask(FairseqTask):
                     "Unsupported language modeling target: {}".format(target)
                 )
 
+        # decoder-only models pass the segments of packed batches to the decoder
+        if getattr(args, "pack_sequences", False) and "tgt_segments" not in (
+            inspect.signature(model.decoder.forward).parameters
+        ):
+            raise ValueError(
+                "--pack-sequences requires a decoder which accepts tgt_segments "
+                "(e.g., transformer_lm), got --arch={}".format(args.arch)
+            )
+
         return model
 
     def load_dataset(self, split, epoch=1, combine=False, **kwargs):
@@ -211,6 +227,10 @@ class LanguageModelingTask(FairseqTask):
             shuffle=True,
             targets=self.targets,
             add_bos_token=self.args.add_bos_token,
+            packed=(
+                getattr(self.args, 'pack_sequences', False)
+                and split == getattr(self.args, 'train_subset', 'train')
+            ),
         )
 
     def _initialize_dataset(self, **kwargs):
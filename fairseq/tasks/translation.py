@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 from argparse import Namespace
+import inspect
 import json
 import itertools
 import logging
@@ -42,6 +43,7 @@ def load_langpair_dataset(
     truncate_source=False, append_source_id=False,
     num_buckets=0,
     shuffle=True,
+    packed=False,
 ):
 
     def split_exists(split, src, tgt, lang, data_path):
@@ -129,6 +131,7 @@ def load_langpair_dataset(
         align_dataset=align_dataset, eos=eos,
         num_buckets=num_buckets,
         shuffle=shuffle,
+        packed=packed,
     )
 
 
@@ -182,6 +185,9 @@ class TranslationTask(FairseqTask):
                             help='if >0, then bucket source and target lengths into N '
                                  'buckets and pad accordingly; this is useful on TPUs '
                                  'to minimize the number of compilations')
+        parser.add_argument('--pack-sequences', action='store_true',
+                            help='pack several training sentence pairs into each row of a '
+                                 'batch (transformer models only)')
 
         # options for reporting BLEU during validation
         parser.add_argument('--eval-bleu', action='store_true',
@@ -218,6 +224,9 @@ class TranslationTask(FairseqTask):
         """
         args.left_pad_source = options.eval_bool(args.left_pad_source)
         args.left_pad_target = options.eval_bool(args.left_pad_target)
+        if getattr(args, 'pack_sequences', False) and getattr(args, 'sentence_avg', False):
+            # packed batches have fewer rows than sentences
+            raise ValueError('--pack-sequences cannot be combined with --sentence-avg')
 
         paths = utils.split_paths(args.data)
         assert len(paths) > 0
@@ -263,6 +272,10 @@ class TranslationTask(FairseqTask):
             truncate_source=self.args.truncate_source,
             num_buckets=self.args.num_batch_buckets,
             shuffle=(split != 'test'),
+            packed=(
+                getattr(self.args, 'pack_sequences', False)
+                and split == getattr(self.args, 'train_subset', 'train')
+            ),
         )
 
     def build_dataset_for_inference(self, src_tokens, src_lengths):
@@ -270,6 +283,13 @@ class TranslationTask(FairseqTask):
 
     def build_model(self, args):
         model = super().build_model(args)
+        if getattr(args, 'pack_sequences', False):
+            params = inspect.signature(model.forward).parameters
+            if 'src_segments' not in params or 'tgt_segments' not in params:
+                raise ValueError(
+                    '--pack-sequences requires a model which accepts src_segments '
+                    'and tgt_segments (e.g., transformer), got --arch={}'.format(args.arch)
+                )
         if getattr(args, 'eval_bleu', False):
             assert getattr(args, 'eval_bleu_detok', None) is not None, (
                 '--eval-bleu-detok is required if using --eval-bleu; '
@@ -17,6 +17,7 @@ from typing import Any, Dict, List
 import torch
 
 from fairseq import checkpoint_utils, distributed_utils, models, optim, utils
+from fairseq.data import sample_cache
 from fairseq.file_io import PathManager
 from fairseq.logging import meters, metrics
 from fairseq.nan_detector import NanDetector
@@ -930,6 +931,9 @@ class Trainer(object):
                     round=1,
                 )
 
+        # includes lookups made by the data loader workers
+        sample_cache.log_stats()
+
         with metrics.aggregate() as agg:
             if logging_outputs is not None:
                 self.task.reduce_metrics(logging_outputs, self.get_criterion())
@@ -211,6 +211,37 @@ def make_positions(tensor, padding_idx: int, onnx_trace: bool = False):
     return (torch.cumsum(mask, dim=1).type_as(mask) * mask).long() + padding_idx
 
 
+def make_segment_positions(segments, padding_idx: int):
+    """Like :func:`make_positions`, but for packed batches, where position
+    numbers restart at every segment.
+
+    *segments* holds the (non-zero) segment id of each token, and ``0`` for
+    padding. Tokens of a segment must be contiguous.
+    """
+    mask = segments.ne(0).long()
+    idx = torch.arange(segments.size(1), device=segments.device).expand_as(segments)
+    is_start = segments.ne(
+        torch.cat([segments.new_full((segments.size(0), 1), -1), segments[:, :-1]], dim=1)
+    )
+    # index of the first token of each segment, gathered by segment number
+    # (rather than with torch.cummax, which requires PyTorch >= 1.5)
+    is_start = is_start.long()
+    segment_num = torch.cumsum(is_start, dim=1)
+    first_idx = segments.new_zeros(segments.size(0), segments.size(1) + 1).long()
+    first_idx.scatter_(1, segment_num * is_start, idx * is_start)
+    starts = torch.gather(first_idx, 1, segment_num)
+    return (idx - starts + 1) * mask + padding_idx
+
+
+def segment_attention_mask(query_segments, key_segments):
+    """Returns a mask of shape `(batch, query_len, key_len)` that is ``True``
+    where a query of a packed batch would attend to a key of another segment.
+    Padding queries (segment ``0``) are not masked, their outputs are unused.
+    """
+    same_segment = query_segments.unsqueeze(2).eq(key_segments.unsqueeze(1))
+    return ~(same_segment | query_segments.eq(0).unsqueeze(2))
+
+
 def strip_pad(tensor, pad):
     return tensor[tensor.ne(pad)]
 
@@ -8,6 +8,7 @@ Data pre-processing: build vocabularies and binarize training data.
 """
 
 from collections import Counter
+import hashlib
 from itertools import zip_longest
 import logging
 from multiprocessing import Pool
@@ -16,8 +17,9 @@ import shutil
 import sys
 
 from fairseq import options, tasks, utils
-from fairseq.data import indexed_dataset
+from fairseq.data import Dictionary, indexed_dataset
 from fairseq.binarizer import Binarizer
+from fairseq.tasks.fairseq_task import FairseqTask
 
 
 logging.basicConfig(
@@ -56,18 +58,83 @@ def main(args):
     def dict_path(lang):
         return dest_path("dict", lang) + ".txt"
 
-    def build_dictionary(filenames, src=False, tgt=False):
+    # with --single-pass, worker outputs of hash_tokens for each training file
+    hashed = {}
+
+    def hash_tokens(lang):
+        input_file = train_path(lang)
+        offsets = Binarizer.find_offsets(input_file, args.workers)
+        pool = Pool(processes=args.workers) if args.workers > 1 else None
+        results = []
+        for worker_id in range(args.workers):
+            worker_args = (
+                input_file,
+                dataset_dest_prefix(args, "train.hash{}".format(worker_id), lang),
+                Dictionary().eos_word,
+                offsets[worker_id],
+                offsets[worker_id + 1],
+            )
+            if pool is not None:
+                results.append((worker_args[1], pool.apply_async(Binarizer.hash_tokens, worker_args)))
+            else:
+                results.append((worker_args[1], Binarizer.hash_tokens(*worker_args)))
+        if pool is not None:
+            pool.close()
+            pool.join()
+            results = [(prefix, r.get()) for prefix, r in results]
+        hashed[lang] = results
+
+    def build_dictionary(langs, src=False, tgt=False):
         assert src ^ tgt
-        return task.build_dictionary(
-            filenames,
-            workers=args.workers,
-            threshold=args.thresholdsrc if src else args.thresholdtgt,
-            nwords=args.nwordssrc if src else args.nwordstgt,
-            padding_factor=args.padding_factor,
-        )
+        threshold = args.thresholdsrc if src else args.thresholdtgt
+        nwords = args.nwordssrc if src else args.nwordstgt
+        if not args.single_pass:
+            return task.build_dictionary(
+                [train_path(lang) for lang in langs],
+                workers=args.workers,
+                threshold=threshold,
+                nwords=nwords,
+                padding_factor=args.padding_factor,
+            )
+        d = Dictionary()
+        for lang in langs:
+            hash_tokens(lang)
+            for _, result in hashed[lang]:
+                d.add_counts(zip(result["words"], result["counts"].tolist()))
+        d.finalize(threshold=threshold, nwords=nwords, padding_factor=args.padding_factor)
+        return d
 
     target = not args.only_source
 
+    if args.single_pass:
+        if args.dataset_impl == "raw":
+            raise ValueError("--single-pass requires a binary --dataset-impl")
+        if task.build_dictionary.__func__ is not FairseqTask.build_dictionary.__func__:
+            raise ValueError("--single-pass is not supported by tasks with a custom build_dictionary")
+
+    if args.append:
+        if args.dataset_impl != "mmap":
+            raise ValueError("--append requires --dataset-impl=mmap")
+        if args.single_pass or args.alignfile:
+            raise ValueError("--append cannot be combined with --single-pass or --alignfile")
+        # binarize with the dictionaries of the existing data
+        langs = [args.source_lang] if args.joined_dictionary or not target else [args.source_lang, args.target_lang]
+        for lang in langs:
+            existing = dict_path(lang)
+            if not os.path.exists(existing):
+                raise FileNotFoundError(existing)
+            if lang == args.source_lang:
+                given = args.srcdict or (args.tgtdict if args.joined_dictionary else None)
+            else:
+                given = args.tgtdict
+            if given is not None and dictionary_checksum(task.load_dictionary(given)) \
+                    != dictionary_checksum(task.load_dictionary(existing)):
+                raise ValueError(
+                    "{} does not match {}, the dictionary of the existing data".format(given, existing)
+                )
+        args.srcdict = dict_path(args.source_lang)
+        args.tgtdict = dict_path(args.target_lang) if target and not args.joined_dictionary else None
+
     if not args.srcdict and os.path.exists(dict_path(args.source_lang)):
         raise FileExistsError(dict_path(args.source_lang))
     if target and not args.tgtdict and os.path.exists(dict_path(args.target_lang)):
@@ -84,7 +151,7 @@ def main(args):
         else:
             assert args.trainpref, "--trainpref must be set if --srcdict is not specified"
             src_dict = build_dictionary(
-                {train_path(lang) for lang in [args.source_lang, args.target_lang]}, src=True
+                sorted({args.source_lang, args.target_lang}), src=True
             )
         tgt_dict = src_dict
     else:
@@ -92,20 +159,33 @@ def main(args):
             src_dict = task.load_dictionary(args.srcdict)
         else:
             assert args.trainpref, "--trainpref must be set if --srcdict is not specified"
-            src_dict = build_dictionary([train_path(args.source_lang)], src=True)
+            src_dict = build_dictionary([args.source_lang], src=True)
 
         if target:
             if args.tgtdict:
                 tgt_dict = task.load_dictionary(args.tgtdict)
             else:
                 assert args.trainpref, "--trainpref must be set if --tgtdict is not specified"
-                tgt_dict = build_dictionary([train_path(args.target_lang)], tgt=True)
+                tgt_dict = build_dictionary([args.target_lang], tgt=True)
         else:
             tgt_dict = None
 
-    src_dict.save(dict_path(args.source_lang))
-    if target and tgt_dict is not None:
-        tgt_dict.save(dict_path(args.target_lang))
+    if not args.append:
+        src_dict.save(dict_path(args.source_lang))
+        if target and tgt_dict is not None:
+            tgt_dict.save(dict_path(args.target_lang))
+
+    def make_builder(output_prefix, lang, vocab_size=None):
+        if args.append and indexed_dataset.MMapIndexedDataset.exists(
+            dataset_dest_prefix(args, output_prefix, lang)
+        ):
+            builder = indexed_dataset.MMapIndexedDatasetBuilder.append_to(
+                dataset_dest_prefix(args, output_prefix, lang)
+            )
+            logger.info("appending to {}".format(dataset_dest_file(args, output_prefix, lang, "bin")))
+            return builder
+        return indexed_dataset.make_builder(dataset_dest_file(args, output_prefix, lang, "bin"),
+                                            impl=args.dataset_impl, vocab_size=vocab_size)
 
     def make_binary_dataset(vocab, input_prefix, output_prefix, lang, num_workers):
         logger.info("[{}] Dictionary: {} types".format(lang, len(vocab)))
@@ -117,9 +197,33 @@ def main(args):
             n_seq_tok[0] += worker_result["nseq"]
             n_seq_tok[1] += worker_result["ntok"]
 
+        def log_result(input_file):
+            logger.info(
+                "[{}] {}: {} sents, {} tokens, {:.3}% replaced by {}".format(
+                    lang,
+                    input_file,
+                    n_seq_tok[0],
+                    n_seq_tok[1],
+                    100 * sum(replaced.values()) / n_seq_tok[1],
+                    vocab.unk_word,
+                )
+            )
+
         input_file = "{}{}".format(
             input_prefix, ("." + lang) if lang is not None else ""
         )
+        if output_prefix == "train" and lang in hashed:
+            ds = make_builder(output_prefix, lang, vocab_size=len(vocab))
+            for prefix, result in hashed.pop(lang):
+                merge_result(
+                    Binarizer.remap_tokens(
+                        prefix, result["words"], result["counts"], vocab, ds.add_items
+                    )
+                )
+            ds.finalize(dataset_dest_file(args, output_prefix, lang, "idx"))
+            log_result(input_file)
+            return
+
         offsets = Binarizer.find_offsets(input_file, num_workers)
         pool = None
         if num_workers > 1:
@@ -141,35 +245,19 @@ def main(args):
                 )
             pool.close()
 
-        ds = indexed_dataset.make_builder(dataset_dest_file(args, output_prefix, lang, "bin"),
-                                          impl=args.dataset_impl, vocab_size=len(vocab))
+        ds = make_builder(output_prefix, lang, vocab_size=len(vocab))
         merge_result(
-            Binarizer.binarize(
-                input_file, vocab, lambda t: ds.add_item(t),
+            Binarizer.binarize_blocks(
+                input_file, vocab, ds.add_items,
                 offset=0, end=offsets[1]
             )
         )
         if num_workers > 1:
             pool.join()
-            for worker_id in range(1, num_workers):
-                prefix = "{}{}".format(output_prefix, worker_id)
-                temp_file_path = dataset_dest_prefix(args, prefix, lang)
-                ds.merge_file_(temp_file_path)
-                os.remove(indexed_dataset.data_file_path(temp_file_path))
-                os.remove(indexed_dataset.index_file_path(temp_file_path))
+            merge_worker_files(args, ds, output_prefix, lang, num_workers)
 
         ds.finalize(dataset_dest_file(args, output_prefix, lang, "idx"))
-
-        logger.info(
-            "[{}] {}: {} sents, {} tokens, {:.3}% replaced by {}".format(
-                lang,
-                input_file,
-                n_seq_tok[0],
-                n_seq_tok[1],
-                100 * sum(replaced.values()) / n_seq_tok[1],
-                vocab.unk_word,
-            )
-        )
+        log_result(input_file)
 
     def make_binary_alignment_dataset(input_prefix, output_prefix, num_workers):
         nseq = [0]
@@ -198,8 +286,7 @@ def main(args):
                 )
             pool.close()
 
-        ds = indexed_dataset.make_builder(dataset_dest_file(args, output_prefix, None, "bin"),
-                                          impl=args.dataset_impl)
+        ds = make_builder(output_prefix, None)
 
         merge_result(
             Binarizer.binarize_alignments(
@@ -209,12 +296,7 @@ def main(args):
         )
         if num_workers > 1:
             pool.join()
-            for worker_id in range(1, num_workers):
-                prefix = "{}{}".format(output_prefix, worker_id)
-                temp_file_path = dataset_dest_prefix(args, prefix, None)
-                ds.merge_file_(temp_file_path)
-                os.remove(indexed_dataset.data_file_path(temp_file_path))
-                os.remove(indexed_dataset.index_file_path(temp_file_path))
+            merge_worker_files(args, ds, output_prefix, None, num_workers)
 
         ds.finalize(dataset_dest_file(args, output_prefix, None, "idx"))
 
@@ -307,15 +389,18 @@ def main(args):
                 print("{} {}".format(src_dict[k], tgt_dict[v]), file=f)
 
 
+def dictionary_checksum(d):
+    """SHA-1 of the symbols of *d*, which determine the ids of binarized
+    data."""
+    return hashlib.sha1("\n".join(d.symbols).encode("utf-8")).hexdigest()
+
+
 def binarize(args, filename, vocab, output_prefix, lang, offset, end, append_eos=True):
     ds = indexed_dataset.make_builder(dataset_dest_file(args, output_prefix, lang, "bin"),
                                       impl=args.dataset_impl, vocab_size=len(vocab))
 
-    def consumer(tensor):
-        ds.add_item(tensor)
-
-    res = Binarizer.binarize(filename, vocab, consumer, append_eos=append_eos,
-                             offset=offset, end=end)
+    res = Binarizer.binarize_blocks(filename, vocab, ds.add_items, append_eos=append_eos,
+                                    offset=offset, end=end)
     ds.finalize(dataset_dest_file(args, output_prefix, lang, "idx"))
     return res
 
@@ -333,6 +418,22 @@ def binarize_alignments(args, filename, parse_alignment, output_prefix, offset,
     return res
 
 
+def merge_worker_files(args, ds, output_prefix, lang, num_workers):
+    temp_file_paths = [
+        dataset_dest_prefix(args, "{}{}".format(output_prefix, worker_id), lang)
+        for worker_id in range(1, num_workers)
+    ]
+    if args.dataset_impl == "mmap":
+        # copy all worker outputs concurrently into their final positions
+        ds.merge_files_(temp_file_paths, num_threads=num_workers - 1)
+    else:
+        for temp_file_path in temp_file_paths:
+            ds.merge_file_(temp_file_path)
+    for temp_file_path in temp_file_paths:
+        os.remove(indexed_dataset.data_file_path(temp_file_path))
+        os.remove(indexed_dataset.index_file_path(temp_file_path))
+
+
 def dataset_dest_prefix(args, output_prefix, lang):
     base = "{}/{}".format(args.destdir, output_prefix)
     if lang is not None:
@@ -12,6 +12,7 @@ import logging
 import math
 import random
 import sys
+import time
 
 import numpy as np
 import torch
@@ -210,10 +211,14 @@ def train(args, trainer, task, epoch_itr):
     valid_subsets = args.valid_subset.split(",")
     should_stop = False
     num_updates = trainer.get_num_updates()
+    data_wait_start = time.perf_counter()
     for i, samples in enumerate(progress):
+        # time spent waiting for the data iterator since the last update
+        data_wait = time.perf_counter() - data_wait_start
         with metrics.aggregate("train_inner"), torch.autograd.profiler.record_function(
             "train_step-%d" % i
         ):
+            metrics.log_scalar("data_wait", data_wait, priority=810, round=3)
             log_output = trainer.train_step(samples)
 
         if log_output is not None:  # not OOM, overflow, ...
@@ -234,6 +239,7 @@ def train(args, trainer, task, epoch_itr):
 
         if should_stop:
             break
+        data_wait_start = time.perf_counter()
 
     # log end-of-epoch stats
     logger.info("end of epoch {} (average epoch stats below)".format(epoch_itr.epoch))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compare the throughput of the line-by-line and the block-based binarizer on a
+text file and check that both produce identical .bin/.idx files.
+"""
+
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from fairseq.binarizer import BLOCK_SIZE, Binarizer
+from fairseq.data import Dictionary, indexed_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='text file to binarize')
+    parser.add_argument('--dict', help='dictionary (built from input if not given)')
+    parser.add_argument('--dataset-impl', default='mmap', choices=['mmap', 'lazy'])
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+
+    if args.dict is not None:
+        d = Dictionary.load(args.dict)
+    else:
+        d = Dictionary()
+        Dictionary.add_file_to_dictionary(args.input, d, str.split, 1)
+        d.finalize()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefixes = []
+        for name in ['binarize', 'binarize_blocks']:
+            prefix = os.path.join(tmpdir, name)
+            prefixes.append(prefix)
+            ds = indexed_dataset.make_builder(
+                indexed_dataset.data_file_path(prefix), impl=args.dataset_impl,
+                vocab_size=len(d),
+            )
+            start = time.time()
+            if name == 'binarize':
+                res = Binarizer.binarize(args.input, d, ds.add_item)
+            else:
+                res = Binarizer.binarize_blocks(
+                    args.input, d, ds.add_items, block_size=args.block_size,
+                )
+            ds.finalize(indexed_dataset.index_file_path(prefix))
+            elapsed = time.time() - start
+            print('| {}: {} sents, {} tokens in {:.1f}s ({:.0f} tokens/s)'.format(
+                name, res['nseq'], res['ntok'], elapsed, res['ntok'] / elapsed,
+            ))
+
+        for path_fn in [indexed_dataset.data_file_path, indexed_dataset.index_file_path]:
+            same = filecmp.cmp(path_fn(prefixes[0]), path_fn(prefixes[1]), shallow=False)
+            print('| {} identical: {}'.format(os.path.basename(path_fn('')), same))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Convert an mmap dataset to the compressed block format and compare the
+bytes stored (i.e. read per epoch) and the read throughput of both formats.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from fairseq.data import indexed_dataset
+
+
+def read_speed(ds, order):
+    start = time.time()
+    for i in order:
+        ds[int(i)]
+    return len(order) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('prefix', help='prefix of an mmap dataset, e.g. data-bin/train.de-en.en')
+    parser.add_argument('--block-size', type=int, default=256,
+                        help='number of items per compressed block')
+    parser.add_argument('--codec', default=None, choices=['zlib', 'zstd'])
+    parser.add_argument('--num-samples', type=int, default=100000)
+    args = parser.parse_args()
+
+    mmap_ds = indexed_dataset.MMapIndexedDataset(args.prefix)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefix = os.path.join(tmpdir, 'compressed')
+        builder = indexed_dataset.CompressedIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(prefix), dtype=mmap_ds._index.dtype,
+            block_size=args.block_size, codec=args.codec,
+        )
+        for i in range(len(mmap_ds)):
+            builder.add_item(mmap_ds[i])
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+        compressed_ds = indexed_dataset.CompressedIndexedDataset(prefix)
+
+        rng = np.random.RandomState(0)
+        n = min(args.num_samples, len(mmap_ds))
+        # sequential reads and reads in batches of neighbouring (sorted) items
+        orders = {
+            'sequential': np.arange(n),
+            'shuffled batches': np.concatenate(
+                [b for b in rng.permutation(np.array_split(np.arange(n), max(1, n // 64)))]
+            ),
+        }
+        for name, ds, p in [('mmap', mmap_ds, args.prefix), ('compressed', compressed_ds, prefix)]:
+            nbytes = os.path.getsize(indexed_dataset.data_file_path(p))
+            print('| {}: {:.1f} MB per epoch, '.format(name, nbytes / 2 ** 20) + ', '.join(
+                '{}: {:.0f} samples/s'.format(k, read_speed(ds, order))
+                for k, order in orders.items()
+            ))
+
+
+if __name__ == '__main__':
+    main()
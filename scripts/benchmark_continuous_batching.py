@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compare the throughput and latency of beam search with a randomly initialized
+transformer, on fixed batches with SequenceGenerator and on a continuously
+refilled pool with ContinuousSequenceGenerator. All sentences are queued at
+the start, and the output of each sentence is forced to end after as many
+tokens as its source (with a length-constrained search for fixed batches,
+whose maximum length is that of their longest source).
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq import search
+from fairseq.continuous_sequence_generator import ContinuousSequenceGenerator
+from fairseq.data import data_utils, Dictionary
+from fairseq.models.transformer import TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks.fairseq_task import FairseqTask
+
+
+class _DummyTask(FairseqTask):
+
+    def __init__(self, args, dictionary):
+        super().__init__(args)
+        self.dictionary = dictionary
+
+    @property
+    def source_dictionary(self):
+        return self.dictionary
+
+    @property
+    def target_dictionary(self):
+        return self.dictionary
+
+
+def report(name, start, done_times, num_tokens, decoder_calls):
+    latencies = np.array(done_times) - start
+    elapsed = latencies.max()
+    print('{}: {:.1f} sentences/sec, {:.0f} tokens/sec, latency p50 {:.2f}s p90 {:.2f}s max {:.2f}s'.format(
+        name, len(latencies) / elapsed, num_tokens / elapsed,
+        np.percentile(latencies, 50), np.percentile(latencies, 90), elapsed,
+    ))
+    # the decoder steps take about as long for any batch size on a GPU
+    print('{}: {} decoder calls, {:.1f} hypotheses per call'.format(
+        name, len(decoder_calls), np.mean(decoder_calls),
+    ))
+    decoder_calls.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-sentences', type=int, default=256)
+    parser.add_argument('--min-src-len', type=int, default=5)
+    parser.add_argument('--max-src-len', type=int, default=80)
+    parser.add_argument('--max-sentences', type=int, default=32,
+                        help='batch size, or size of the continuous pool')
+    parser.add_argument('--beam', type=int, default=4)
+    parser.add_argument('--arch-args', default='')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    dictionary = Dictionary()
+    for i in range(1000):
+        dictionary.add_symbol(str(i))
+
+    model_parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    TransformerModel.add_args(model_parser)
+    model_args = model_parser.parse_args(args.arch_args.split())
+    torch.manual_seed(0)
+    model = TransformerModel.build_model(model_args, _DummyTask(model_args, dictionary))
+    model = model.to(device).eval()
+    decoder_calls = []
+    decoder_forward = model.decoder.forward
+
+    def forward(prev_output_tokens, *args, **kwargs):
+        decoder_calls.append(prev_output_tokens.size(0))
+        return decoder_forward(prev_output_tokens, *args, **kwargs)
+
+    model.decoder.forward = forward
+
+    src_tokens = [
+        torch.cat([
+            torch.randint(4, len(dictionary), (src_len,)), torch.LongTensor([dictionary.eos()]),
+        ]).to(device)
+        for src_len in np.random.RandomState(0).randint(
+            args.min_src_len, args.max_src_len + 1, args.num_sentences
+        )
+    ]
+    generator = SequenceGenerator(
+        [model], dictionary, beam_size=args.beam, max_len_a=1, max_len_b=0,
+        search_strategy=search.LengthConstrainedBeamSearch(
+            dictionary, min_len_a=0, min_len_b=0, max_len_a=1, max_len_b=0,
+        ),
+    )
+    start = time.time()
+    done_times, num_tokens = [], 0
+    for i in range(0, len(src_tokens), args.max_sentences):
+        batch = src_tokens[i:i + args.max_sentences]
+        hypos = generator.forward({'net_input': {
+            'src_tokens': data_utils.collate_tokens(batch, dictionary.pad(), left_pad=True),
+            'src_lengths': torch.LongTensor([src.numel() for src in batch]),
+        }})
+        num_tokens += sum(sent[0]['tokens'].numel() for sent in hypos)
+        done_times.extend([time.time()] * len(batch))
+    report('fixed batches', start, done_times, num_tokens, decoder_calls)
+
+    # the maximum length excludes the eos of the source
+    generator = ContinuousSequenceGenerator(
+        [model], dictionary, beam_size=args.beam, max_len_a=1, max_len_b=-1,
+        max_sentences=args.max_sentences,
+    )
+    start = time.time()
+    done_times, futures = [], []
+    for src in src_tokens:
+        future = generator.submit(src)
+        future.add_done_callback(lambda _: done_times.append(time.time()))
+        futures.append(future)
+    while generator.step():
+        pass
+    num_tokens = sum(future.result()[0]['tokens'].numel() for future in futures)
+    report('continuous', start, done_times, num_tokens, decoder_calls)
+
+
+if __name__ == '__main__':
+    main()
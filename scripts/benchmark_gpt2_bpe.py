@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure the encoding throughput of the GPT-2 BPE encoder on a text file,
+line by line and with encode_batch.
+"""
+
+import argparse
+import time
+
+from fairseq.data.encoders.gpt2_bpe_utils import get_encoder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--encoder-json', required=True, help='path to encoder.json')
+    parser.add_argument('--vocab-bpe', required=True, help='path to vocab.bpe')
+    parser.add_argument('--input', required=True, help='text file to encode')
+    parser.add_argument('--max-lines', type=int, default=100000)
+    parser.add_argument('--cache-size', type=int, default=2 ** 17,
+                        help='size of the token cache (0 to disable it)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of processes for encode_batch')
+    args = parser.parse_args()
+
+    with open(args.input, encoding='utf-8') as f:
+        lines = [line for _, line in zip(range(args.max_lines), f)]
+
+    def get_bpe():
+        return get_encoder(args.encoder_json, args.vocab_bpe, cache_size=args.cache_size)
+
+    bpe = get_bpe()
+    start = time.time()
+    ntok = sum(len(bpe.encode(line)) for line in lines)
+    elapsed = time.time() - start
+    print('encode: {:.0f} lines/sec, {:.0f} tokens/sec ({})'.format(
+        len(lines) / elapsed, ntok / elapsed, bpe.cache_info(),
+    ))
+
+    for num_workers in sorted({1, args.workers}):
+        bpe = get_bpe()
+        start = time.time()
+        ntok = sum(map(len, bpe.encode_batch(lines, num_workers=num_workers)))
+        elapsed = time.time() - start
+        print('encode_batch, {} worker(s): {:.0f} lines/sec, {:.0f} tokens/sec'.format(
+            num_workers, len(lines) / elapsed, ntok / elapsed,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure beam search latency of a randomly initialized transformer, with the
+cached keys and values of the decoder concatenated at every step or
+preallocated for the maximum output length, and with the encoder output
+repeated for every beam or shared by the beams of each sentence.
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models.transformer import TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks.fairseq_task import FairseqTask
+
+
+class _DummyTask(FairseqTask):
+
+    def __init__(self, args, dictionary):
+        super().__init__(args)
+        self.dictionary = dictionary
+
+    @property
+    def source_dictionary(self):
+        return self.dictionary
+
+    @property
+    def target_dictionary(self):
+        return self.dictionary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--beams', default='1,4,8')
+    parser.add_argument('--bsz', type=int, default=1)
+    parser.add_argument('--src-len', type=int, default=30)
+    parser.add_argument('--output-len', type=int, default=200,
+                        help='number of decoding steps (eos is blocked until the last one)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--arch-args', default='')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    dictionary = Dictionary()
+    for i in range(1000):
+        dictionary.add_symbol(str(i))
+
+    model_parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    TransformerModel.add_args(model_parser)
+    model_args = model_parser.parse_args(args.arch_args.split())
+    torch.manual_seed(0)
+    model = TransformerModel.build_model(model_args, _DummyTask(model_args, dictionary))
+    model = model.to(device).eval()
+
+    src_tokens = torch.randint(4, len(dictionary), (args.bsz, args.src_len), device=device)
+    src_tokens[:, -1] = dictionary.eos()
+    sample = {'net_input': {
+        'src_tokens': src_tokens,
+        'src_lengths': torch.full((args.bsz,), args.src_len, device=device),
+    }}
+
+    modes = {
+        'baseline': {},
+        'preallocated': {'preallocate_kv_cache': True},
+        'shared encoder': {'share_encoder_out': True},
+        'both': {'preallocate_kv_cache': True, 'share_encoder_out': True},
+    }
+    for beam in map(int, args.beams.split(',')):
+        reference = None
+        for mode, kwargs in modes.items():
+            generator = SequenceGenerator(
+                [model], dictionary, beam_size=beam,
+                max_len_b=args.output_len, min_len=args.output_len, **kwargs
+            )
+            hypos = generator.forward(sample)  # warmup
+            tokens = [[h['tokens'].tolist() for h in sent] for sent in hypos]
+            if reference is None:
+                reference = tokens
+            assert tokens == reference, '{} changed the output'.format(mode)
+            timings = []
+            for _ in range(args.repeat):
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                generator.forward(sample)
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                timings.append(time.time() - start)
+            print('beam {}, {}: {:.1f} ms/step'.format(
+                beam, mode, 1000 * min(timings) / (args.output_len + 1),
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure the cost of blocking repeated ngrams in beam search, comparing the
+tensor implementation of SequenceGenerator with the previous one, which built
+dicts of the ngrams of every hypothesis on the CPU, and the latency of beam
+search with a randomly initialized transformer with and without blocking.
+"""
+
+import argparse
+import math
+import time
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.models.transformer import TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks.fairseq_task import FairseqTask
+
+
+class _DummyTask(FairseqTask):
+
+    def __init__(self, args, dictionary):
+        super().__init__(args)
+        self.dictionary = dictionary
+
+    @property
+    def source_dictionary(self):
+        return self.dictionary
+
+    @property
+    def target_dictionary(self):
+        return self.dictionary
+
+
+def no_repeat_ngram_dicts(tokens, lprobs, n, step):
+    """The previous implementation of SequenceGenerator._no_repeat_ngram."""
+    gen_ngrams = [{} for _ in range(tokens.size(0))]
+    cpu_tokens = tokens.cpu()
+    for bbsz_idx in range(tokens.size(0)):
+        gen_tokens = cpu_tokens[bbsz_idx].tolist()
+        for ngram in zip(*[gen_tokens[i:] for i in range(n)]):
+            key = ','.join(str(x) for x in ngram[:-1])
+            gen_ngrams[bbsz_idx][key] = gen_ngrams[bbsz_idx].get(key, []) + [ngram[-1]]
+    for bbsz_idx in range(tokens.size(0)):
+        banned_tokens = []
+        if step + 2 - n >= 0:
+            key = ','.join(str(x) for x in tokens[bbsz_idx, step + 2 - n:step + 1].tolist())
+            banned_tokens = gen_ngrams[bbsz_idx].get(key, [])
+        lprobs[bbsz_idx][torch.tensor(banned_tokens).long()] = torch.tensor(-math.inf, dtype=torch.float)
+    return lprobs
+
+
+def timeit(fn, device, repeat):
+    timings = []
+    for _ in range(repeat):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-repeat-ngram-size', type=int, default=3)
+    parser.add_argument('--beam', type=int, default=4)
+    parser.add_argument('--bsz', type=int, default=32)
+    parser.add_argument('--steps', default='10,50,200',
+                        help='length of the prefixes for the per-call timings')
+    parser.add_argument('--vocab-size', type=int, default=50000)
+    parser.add_argument('--src-len', type=int, default=30)
+    parser.add_argument('--output-len', type=int, default=100,
+                        help='number of decoding steps (eos is blocked until the last one)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--arch-args', default='')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    n = args.no_repeat_ngram_size
+    rows = args.bsz * args.beam
+
+    torch.manual_seed(0)
+    model_parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    TransformerModel.add_args(model_parser)
+    model_args = model_parser.parse_args(args.arch_args.split())
+    model = TransformerModel.build_model(model_args, _DummyTask(model_args, dictionary))
+    model = model.to(device).eval()
+    generator = SequenceGenerator([model], dictionary, beam_size=args.beam, no_repeat_ngram_size=n)
+
+    for step in map(int, args.steps.split(',')):
+        # a small range of symbols makes the ngrams repeat
+        tokens = torch.randint(4, 50, (rows, step + 2), device=device)
+        tokens[:, 0] = dictionary.eos()
+        tokens[:, step + 1:] = dictionary.pad()
+        lprobs = torch.randn(rows, len(dictionary), device=device)
+        lprobs[:, dictionary.pad()] = -math.inf
+        expected = no_repeat_ngram_dicts(tokens, lprobs.clone(), n, step)
+        banned = generator._no_repeat_ngram(tokens, lprobs.clone(), args.bsz, args.beam, step)
+        assert torch.equal(banned, expected), 'the blocked tokens changed'
+        old = timeit(lambda: no_repeat_ngram_dicts(tokens, lprobs.clone(), n, step), device, args.repeat)
+        new = timeit(
+            lambda: generator._no_repeat_ngram(tokens, lprobs.clone(), args.bsz, args.beam, step),
+            device, args.repeat,
+        )
+        print('{} hypotheses, step {}: dicts {:.2f} ms, tensors {:.2f} ms'.format(
+            rows, step, 1000 * old, 1000 * new,
+        ))
+
+    src_tokens = torch.randint(4, len(dictionary), (args.bsz, args.src_len), device=device)
+    src_tokens[:, -1] = dictionary.eos()
+    sample = {'net_input': {
+        'src_tokens': src_tokens,
+        'src_lengths': torch.full((args.bsz,), args.src_len, device=device),
+    }}
+    for size in [0, n]:
+        generator = SequenceGenerator(
+            [model], dictionary, beam_size=args.beam,
+            max_len_b=args.output_len, min_len=args.output_len, no_repeat_ngram_size=size,
+        )
+        generator.forward(sample)  # warmup
+        elapsed = timeit(lambda: generator.forward(sample), device, args.repeat)
+        print('beam search, no_repeat_ngram_size={}: {:.1f} ms/step'.format(
+            size, 1000 * elapsed / (args.output_len + 1),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure training tokens/sec of a transformer on dummy translation data of
+short sentences, with regular (padded) and packed batches.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary, LanguagePairDataset
+from fairseq.models.transformer import TransformerModel
+from fairseq.tasks.fairseq_task import FairseqTask
+
+
+class _DummyTask(FairseqTask):
+
+    def __init__(self, args, dictionary):
+        super().__init__(args)
+        self.dictionary = dictionary
+
+    @property
+    def source_dictionary(self):
+        return self.dictionary
+
+    @property
+    def target_dictionary(self):
+        return self.dictionary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-sentences', type=int, default=20000)
+    parser.add_argument('--mean-len', type=float, default=12)
+    parser.add_argument('--max-len', type=int, default=128)
+    parser.add_argument('--max-tokens', type=int, default=4096)
+    parser.add_argument('--num-batches', type=int, default=30)
+    parser.add_argument('--arch-args', default='--encoder-layers 3 --decoder-layers 3')
+    parser.add_argument('--sort-by-length', action='store_true',
+                        help='batch sentences of similar lengths (default: random order)')
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    rng = np.random.RandomState(0)
+    dictionary = Dictionary()
+    for i in range(1000):
+        dictionary.add_symbol(str(i))
+
+    def sentences(lengths):
+        return [
+            torch.cat([torch.from_numpy(rng.randint(4, len(dictionary), size=n)), torch.LongTensor([2])])
+            for n in np.clip(lengths.astype(np.int64), 1, args.max_len - 1)
+        ]
+
+    src_lengths = rng.geometric(1 / args.mean_len, size=args.num_sentences)
+    src = sentences(src_lengths)
+    tgt = sentences(src_lengths * rng.uniform(0.8, 1.25, size=args.num_sentences))
+
+    model_parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    TransformerModel.add_args(model_parser)
+    model_args = model_parser.parse_args(args.arch_args.split())
+    model_args.max_source_positions = model_args.max_target_positions = args.max_len
+    torch.manual_seed(0)
+    model = TransformerModel.build_model(model_args, _DummyTask(model_args, dictionary)).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+
+    for packed in [False, True]:
+        dataset = LanguagePairDataset(
+            src, [len(s) for s in src], dictionary, tgt, [len(t) for t in tgt], dictionary,
+            packed=packed,
+        )
+        order = dataset.ordered_indices() if args.sort_by_length else rng.permutation(len(dataset))
+        batches = dataset.batch_by_size(order, max_tokens=args.max_tokens)
+        batches = [batches[i] for i in rng.permutation(len(batches))[:args.num_batches]]
+        samples = [dataset.collater([dataset[i] for i in b]) for b in batches]
+
+        ntokens, padded = 0, 0
+        for i, sample in enumerate(samples):
+            if i == 1:
+                # the first batch is a warmup
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            net_input = {k: v.to(device) for k, v in sample['net_input'].items()}
+            target = sample['target'].to(device)
+            lprobs = model.get_normalized_probs(model(**net_input), log_probs=True)
+            loss = torch.nn.functional.nll_loss(
+                lprobs.view(-1, lprobs.size(-1)), target.view(-1),
+                ignore_index=dictionary.pad(), reduction='sum',
+            )
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if i > 0:
+                ntokens += sample['ntokens']
+                padded += target.numel()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        print('{}: {:.0f} tokens/sec, {:.1%} of target tokens are padding'.format(
+            'packed' if packed else 'padded', ntokens / elapsed, 1 - ntokens / padded,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure DataLoader worker startup time and worker RSS for a large
+TokenBlockDataset, with its index arrays shared through SharedArray or
+pickled into every worker.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import TokenBlockDataset
+
+
+class _SizesDataset(torch.utils.data.Dataset):
+    """Returns dummy sentences of the given sizes."""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def __getitem__(self, index):
+        return torch.full((int(self.sizes[index]),), 5, dtype=torch.long)
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+class _RSSDataset(torch.utils.data.Dataset):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        self.dataset[index]
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def _first(samples):
+    return samples[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-sentences', type=int, default=20000000)
+    parser.add_argument('--tokens-per-sample', type=int, default=512)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--start-method', default='spawn', choices=['spawn', 'forkserver', 'fork'])
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    sizes = rng.randint(5, 60, size=args.num_sentences)
+    ds = TokenBlockDataset(
+        _SizesDataset(sizes), sizes, args.tokens_per_sample, pad=1, eos=2, break_mode='none',
+    )
+    nbytes = ds.slice_indices.nbytes + ds.sizes.nbytes + ds.block_to_dataset_index.nbytes
+    print('| {} blocks, {:.1f} MB of index arrays'.format(len(ds), nbytes / 2 ** 20))
+
+    for name, min_nbytes in [('shared', 0), ('pickled', float('inf'))]:
+        for arr in [ds._slice_indices, ds._sizes, ds._block_to_dataset_index]:
+            arr.min_nbytes = min_nbytes
+        loader = torch.utils.data.DataLoader(
+            _RSSDataset(ds),
+            batch_size=1,
+            num_workers=args.num_workers,
+            multiprocessing_context=args.start_method,
+            sampler=range(args.num_workers),
+            collate_fn=_first,
+        )
+        start = time.time()
+        rss = list(loader)
+        print('| {}: first batches after {:.1f}s, mean worker RSS {:.1f} MB'.format(
+            name, time.time() - start, np.mean(rss) / 2 ** 20,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Measure TokenBlockDataset samples/sec on top of an MMapIndexedDataset of
+short documents, reading blocks with MMapIndexedDataset.get_range or by
+concatenating the underlying items.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import indexed_dataset, TokenBlockDataset
+
+
+class _ItemsOnly(torch.utils.data.Dataset):
+    """Hides get_range, so that TokenBlockDataset concatenates items."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=200000)
+    parser.add_argument('--mean-doc-len', type=int, default=20)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--break-mode', default='none')
+    parser.add_argument('--include-targets', action='store_true')
+    parser.add_argument('--num-samples', type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    sizes = rng.poisson(args.mean_doc_len, size=args.num_docs) + 1
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefix = os.path.join(tmpdir, 'train')
+        builder = indexed_dataset.MMapIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(prefix), dtype=np.uint16,
+        )
+        builder.add_items(rng.randint(4, 30000, size=sizes.sum()), sizes)
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+        mmap_ds = indexed_dataset.MMapIndexedDataset(prefix)
+
+        for name, dataset in [('concat', _ItemsOnly(mmap_ds)), ('get_range', mmap_ds)]:
+            ds = TokenBlockDataset(
+                dataset, mmap_ds.sizes, args.block_size, pad=1, eos=2,
+                break_mode=args.break_mode, include_targets=args.include_targets,
+            )
+            indices = rng.randint(0, len(ds), size=args.num_samples)
+            start = time.time()
+            for i in indices:
+                ds[i]
+            elapsed = time.time() - start
+            print('{}: {:.0f} samples/sec'.format(name, len(indices) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
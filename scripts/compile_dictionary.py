@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Convert a text dictionary into the compiled format, which is memory-mapped
+when loaded, e.g.:
+
+    python scripts/compile_dictionary.py data-bin/dict.en.txt data-bin/dict.en.bin
+
+Dictionary.load detects compiled dictionaries, so the output can also
+replace the text dictionary in place.
+"""
+
+import argparse
+import os
+
+from fairseq.data import Dictionary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='text dictionary')
+    parser.add_argument('output', help='compiled dictionary to write')
+    args = parser.parse_args()
+
+    d = Dictionary.load(args.input)
+    tmp_output = args.output + '.tmp'
+    d.save_compiled(tmp_output)
+    os.replace(tmp_output, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Write a manifest that exposes several mmap .bin/.idx shards as a single
+dataset, e.g.:
+
+    python scripts/write_manifest.py data-bin/train.de-en.en shards/*.idx
+"""
+
+import argparse
+
+from fairseq.data import indexed_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_prefix', help='prefix of the dataset to create')
+    parser.add_argument('shards', nargs='+', help='shard prefixes (or .bin/.idx files)')
+    args = parser.parse_args()
+
+    shards = []
+    for shard in args.shards:
+        if shard.endswith('.bin') or shard.endswith('.idx'):
+            shard = shard[:-4]
+        assert indexed_dataset.MMapIndexedDataset.exists(shard), shard
+        shards.append(shard)
+    indexed_dataset.write_manifest(args.output_prefix, shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from fairseq.data import batch_plan_cache, LanguagePairDataset
+from fairseq.tasks.fairseq_task import FairseqTask
+from tests.utils import dummy_dictionary
+
+
+def make_dataset(rng, vocab, n=50):
+    src = [torch.LongTensor(rng.randint(4, len(vocab), size=rng.randint(1, 30))) for _ in range(n)]
+    tgt = [torch.LongTensor(rng.randint(4, len(vocab), size=rng.randint(1, 30))) for _ in range(n)]
+    return LanguagePairDataset(
+        src, [len(s) for s in src], vocab, tgt, [len(t) for t in tgt], vocab,
+    )
+
+
+class TestBatchPlanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.vocab = dummy_dictionary(20)
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _batches(self, dataset, cache_dir, **kwargs):
+        task = FairseqTask(argparse.Namespace(batch_plan_cache_dir=cache_dir))
+        epoch_iter = task.get_batch_iterator(
+            dataset, max_tokens=100, max_positions=(25, 25),
+            ignore_invalid_inputs=True, **kwargs
+        )
+        return [list(b) for b in epoch_iter.frozen_batches]
+
+    def test_cache_hit(self):
+        dataset = make_dataset(self.rng, self.vocab)
+        expected = self._batches(dataset, None)
+        self.assertEqual(self._batches(dataset, self.tmpdir.name), expected)
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 2)
+
+        # a cache hit must not recompute the batches
+        with mock.patch.object(LanguagePairDataset, 'batch_by_size') as batch_by_size:
+            self.assertEqual(self._batches(dataset, self.tmpdir.name), expected)
+            batch_by_size.assert_not_called()
+
+    def test_invalidation(self):
+        dataset = make_dataset(self.rng, self.vocab)
+        key = batch_plan_cache.batch_plan_key(dataset, max_tokens=100, seed=1)
+        self.assertEqual(key, batch_plan_cache.batch_plan_key(dataset, max_tokens=100, seed=1))
+        self.assertNotEqual(key, batch_plan_cache.batch_plan_key(dataset, max_tokens=100, seed=2))
+        self.assertNotEqual(key, batch_plan_cache.batch_plan_key(dataset, max_tokens=200, seed=1))
+        dataset.tgt_sizes[0] += 1
+        self.assertNotEqual(key, batch_plan_cache.batch_plan_key(dataset, max_tokens=100, seed=1))
+
+        self._batches(dataset, self.tmpdir.name)
+        self._batches(dataset, self.tmpdir.name, seed=2)
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 4)
+
+    def test_empty_plan(self):
+        batch_plan_cache.save_batch_plan(self.tmpdir.name, 'empty', [])
+        self.assertEqual(batch_plan_cache.load_batch_plan(self.tmpdir.name, 'empty'), [])
+        self.assertIsNone(batch_plan_cache.load_batch_plan(self.tmpdir.name, 'missing'))
+
+
+if __name__ == "__main__":
+    unittest.main()
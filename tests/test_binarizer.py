@@ -0,0 +1,126 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+from fairseq.binarizer import Binarizer
+from fairseq.data import Dictionary, indexed_dataset
+from fairseq.tokenizer import tokenize_line
+
+
+TEXT = (
+    "A B C D\n"
+    "B  C\tD E\r\n"
+    "\n"
+    "C D F\rD\n"
+    "</s> <unk> zz zz\n"
+    "é ñ 漢字 D"  # no trailing newline
+)
+
+
+class TestBinarizer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmpdir.name, "input.txt")
+        with open(self.input, "w", encoding="utf-8", newline="") as f:
+            f.write(TEXT * 50)
+        self.dict = Dictionary()
+        for sym in ["A", "B", "C", "D", "é", "漢字"]:
+            self.dict.add_symbol(sym)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _binarize(self, name, impl, blocks, num_chunks, **kwargs):
+        prefix = os.path.join(self.tmpdir.name, name)
+        builder = indexed_dataset.make_builder(
+            indexed_dataset.data_file_path(prefix), impl=impl, vocab_size=len(self.dict),
+        )
+        offsets = Binarizer.find_offsets(self.input, num_chunks)
+        results = []
+        for offset, end in zip(offsets[:-1], offsets[1:]):
+            if blocks:
+                res = Binarizer.binarize_blocks(
+                    self.input, self.dict, builder.add_items,
+                    offset=offset, end=end, block_size=7, **kwargs
+                )
+            else:
+                res = Binarizer.binarize(
+                    self.input, self.dict, builder.add_item,
+                    offset=offset, end=end, **kwargs
+                )
+            results.append(res)
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+        return prefix, results
+
+    def _assert_same_files(self, prefix1, prefix2):
+        for path_fn in [indexed_dataset.data_file_path, indexed_dataset.index_file_path]:
+            with open(path_fn(prefix1), "rb") as f1, open(path_fn(prefix2), "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_binarize_blocks_matches_binarize(self):
+        for impl in ["mmap", "lazy"]:
+            for num_chunks in [1, 3]:
+                for kwargs in [{}, {"append_eos": False, "reverse_order": True}]:
+                    ref, ref_res = self._binarize("ref", impl, False, 1, **kwargs)
+                    out, out_res = self._binarize("out", impl, True, num_chunks, **kwargs)
+                    self._assert_same_files(ref, out)
+                    for key in ["nseq", "ntok", "nunk"]:
+                        self.assertEqual(
+                            ref_res[0][key], sum(res[key] for res in out_res)
+                        )
+                    self.assertEqual(
+                        ref_res[0]["replaced"],
+                        sum((res["replaced"] for res in out_res), Counter()),
+                    )
+
+    def test_hash_tokens_matches_two_passes(self):
+        # add_file_to_dictionary stops at lines ending with a single "\r"
+        with open(self.input, "w", encoding="utf-8", newline="") as f:
+            f.write(TEXT.replace("F\rD", "F D") * 50)
+        ref_dict = Dictionary()
+        Dictionary.add_file_to_dictionary(self.input, ref_dict, tokenize_line, 1)
+        ref_dict.finalize(threshold=2, padding_factor=1)
+        self.dict = ref_dict
+        ref, ref_res = self._binarize("ref", "mmap", True, 1)
+
+        offsets = Binarizer.find_offsets(self.input, 3)
+        hashed = []
+        for i, (offset, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            prefix = os.path.join(self.tmpdir.name, "hash{}".format(i))
+            hashed.append((prefix, Binarizer.hash_tokens(
+                self.input, prefix, ref_dict.eos_word, offset=offset, end=end, block_size=7,
+            )))
+        d = Dictionary()
+        for _, res in hashed:
+            d.add_counts(zip(res["words"], res["counts"].tolist()))
+        d.finalize(threshold=2, padding_factor=1)
+        self.assertEqual(d.symbols, ref_dict.symbols)
+        self.assertEqual(d.count, ref_dict.count)
+
+        out = os.path.join(self.tmpdir.name, "out")
+        builder = indexed_dataset.make_builder(
+            indexed_dataset.data_file_path(out), impl="mmap", vocab_size=len(d),
+        )
+        out_res = [
+            Binarizer.remap_tokens(prefix, res["words"], res["counts"], d, builder.add_items, block_size=16)
+            for prefix, res in hashed
+        ]
+        builder.finalize(indexed_dataset.index_file_path(out))
+        self._assert_same_files(ref, out)
+        for key in ["nseq", "ntok", "nunk"]:
+            self.assertEqual(ref_res[0][key], sum(res[key] for res in out_res))
+        self.assertEqual(
+            ref_res[0]["replaced"], sum((res["replaced"] for res in out_res), Counter()),
+        )
+        self.assertFalse(any(name.startswith("hash") for name in os.listdir(self.tmpdir.name)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import torch
+from fairseq.continuous_sequence_generator import ContinuousSequenceGenerator
+from fairseq.models.transformer import TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+from tests.test_sequence_generator import get_dummy_task_and_parser
+
+
+class TestContinuousSequenceGenerator(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1)
+        self.task, parser = get_dummy_task_and_parser()
+        TransformerModel.add_args(parser)
+        args = parser.parse_args([])
+        args.encoder_layers = 2
+        args.decoder_layers = 2
+        self.model = TransformerModel.build_model(args, self.task).eval()
+        tgt_dict = self.task.tgt_dict
+        with torch.no_grad():
+            # make some hypotheses finish before the maximum length
+            self.model.decoder.output_projection.weight[tgt_dict.eos()] *= 6
+        self.src_tokens = [
+            torch.cat((torch.randint(4, len(tgt_dict), (src_len,)), torch.LongTensor([tgt_dict.eos()])))
+            for src_len in [3, 9, 5, 12, 2, 7, 4]
+        ]
+
+    def assertHyposEqual(self, hypos, src_tokens, generator):
+        for src, sent in zip(src_tokens, hypos):
+            sample = {"net_input": {
+                "src_tokens": src.unsqueeze(0), "src_lengths": torch.LongTensor([src.numel()]),
+            }}
+            expected = generator.forward(sample)[0]
+            self.assertEqual(len(sent), len(expected))
+            for hypo, expected_hypo in zip(sent, expected):
+                self.assertTrue(torch.equal(hypo["tokens"], expected_hypo["tokens"]))
+                self.assertLess(abs(hypo["score"] - expected_hypo["score"]), 1e-4)
+                self.assertLess(
+                    (hypo["positional_scores"] - expected_hypo["positional_scores"]).abs().max(), 1e-4
+                )
+
+    def test_generate(self):
+        for beam_size in [1, 3]:
+            kwargs = {"beam_size": beam_size, "max_len_a": 1, "max_len_b": 6}
+            # sentences are admitted while others are being decoded
+            generator = ContinuousSequenceGenerator(
+                [self.model], self.task.tgt_dict, max_sentences=3, **kwargs
+            )
+            hypos = generator.generate(self.src_tokens)
+            self.assertEqual(generator.num_active(), 0)
+            self.assertHyposEqual(
+                hypos, self.src_tokens, SequenceGenerator([self.model], self.task.tgt_dict, **kwargs)
+            )
+
+    def test_background_thread(self):
+        kwargs = {"beam_size": 2, "max_len_a": 1, "max_len_b": 6}
+        generator = ContinuousSequenceGenerator(
+            [self.model], self.task.tgt_dict, max_sentences=2, **kwargs
+        )
+        generator.start()
+        try:
+            futures = [generator.submit(src) for src in self.src_tokens]
+            hypos = [future.result(timeout=60) for future in futures]
+        finally:
+            generator.stop()
+        self.assertHyposEqual(
+            hypos, self.src_tokens, SequenceGenerator([self.model], self.task.tgt_dict, **kwargs)
+        )
+
+        # queued sentences are failed once the generator is stopped
+        future = generator.submit(self.src_tokens[0])
+        generator.stop()
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import (
+    data_utils,
+    ConcatDataset,
+    LanguagePairDataset,
+    ListDataset,
+    NestedDictionaryDataset,
+    PrependTokenDataset,
+    SubsampleDataset,
+)
+from fairseq.data.shorten_dataset import TruncateDataset
+from tests.utils import dummy_dictionary
+
+
+class TestFilterBySize(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.vocab = dummy_dictionary(10)
+
+    def _lang_pair_dataset(self, n, with_tgt=True):
+        src = [torch.LongTensor(self.rng.randint(4, 10, size=self.rng.randint(1, 30))) for _ in range(n)]
+        tgt = [torch.LongTensor(self.rng.randint(4, 10, size=self.rng.randint(1, 30))) for _ in range(n)]
+        return LanguagePairDataset(
+            src, [len(s) for s in src], self.vocab,
+            tgt if with_tgt else None, [len(t) for t in tgt] if with_tgt else None, self.vocab,
+        )
+
+    def _assert_same_as_dynamic(self, dataset, max_positions):
+        self.assertIsNotNone(dataset.sizes_array())
+        indices = self.rng.permutation(len(dataset))
+        expected, expected_ignored = data_utils._filter_by_size_dynamic(
+            indices, dataset.size, max_positions,
+        )
+        self.assertGreater(len(expected_ignored), 0)
+        filtered = data_utils.filter_by_size(indices, dataset, max_positions)
+        self.assertEqual(filtered.tolist(), expected.tolist())
+
+    def test_language_pair_dataset(self):
+        for with_tgt in [True, False]:
+            dataset = self._lang_pair_dataset(100, with_tgt)
+            self._assert_same_as_dynamic(dataset, (20, 15))
+            self._assert_same_as_dynamic(dataset, (None, 15) if with_tgt else (15, None))
+
+    def test_concat_dataset(self):
+        dataset = ConcatDataset(
+            [self._lang_pair_dataset(30), self._lang_pair_dataset(7)], sample_ratios=[1, 3],
+        )
+        self.assertEqual(len(dataset.sizes_array()), len(dataset))
+        self._assert_same_as_dynamic(dataset, (20, 15))
+
+    def test_wrapper_datasets(self):
+        sizes = self.rng.randint(1, 30, size=50)
+        dataset = ListDataset(list(range(50)), sizes)
+        self._assert_same_as_dynamic(PrependTokenDataset(dataset, 1), (20, 25))
+        subsample = SubsampleDataset(dataset, 0.5)
+        self._assert_same_as_dynamic(subsample, 20)
+
+    def test_truncate_dataset(self):
+        sizes = self.rng.randint(1, 30, size=50)
+        dataset = TruncateDataset(ListDataset(list(range(50)), sizes), 20)
+        self.assertEqual(dataset.sizes_array()[:, 0].tolist(), dataset.sizes.tolist())
+        # the examples are kept since they are truncated
+        indices = np.arange(len(dataset))
+        filtered = data_utils.filter_by_size(indices, dataset, 20)
+        self.assertEqual(filtered.tolist(), indices.tolist())
+
+    def test_nested_dictionary_dataset(self):
+        src_sizes = self.rng.randint(1, 30, size=50)
+        tgt_sizes = self.rng.randint(1, 30, size=50)
+        dataset = NestedDictionaryDataset(
+            {'id': ListDataset(list(range(50)))}, sizes=[src_sizes, tgt_sizes],
+        )
+        self._assert_same_as_dynamic(dataset, (20, 15))
+
+    def test_fallback(self):
+        dataset = self._lang_pair_dataset(20)
+        dataset.sizes_array = lambda: None
+        indices = np.arange(len(dataset))
+        expected, _ = data_utils._filter_by_size_dynamic(indices, dataset.size, (20, 15))
+        filtered = data_utils.filter_by_size(indices, dataset, (20, 15))
+        self.assertEqual(filtered.tolist(), expected.tolist())
+
+
+class TestBatchByPaddedCost(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.vocab = dummy_dictionary(10)
+        self.src_sizes = rng.randint(1, 100, size=1000)
+        self.tgt_sizes = rng.randint(1, 100, size=1000)
+        self.dataset = LanguagePairDataset(
+            [None] * 1000, self.src_sizes, self.vocab, [None] * 1000, self.tgt_sizes, self.vocab,
+        )
+
+    def _check(self, batches, indices, max_tokens, bsz_mult=1):
+        self.assertEqual(sorted(np.concatenate(batches).tolist()), sorted(indices.tolist()))
+        for i, b in enumerate(batches):
+            self.assertLessEqual(len(b) * self.src_sizes[b].max(), max_tokens)
+            self.assertLessEqual(len(b) * self.tgt_sizes[b].max(), max_tokens)
+            if i < len(batches) - 1 and len(b) >= bsz_mult:
+                self.assertEqual(len(b) % bsz_mult, 0)
+
+    def test_batch_by_size(self):
+        indices = self.dataset.ordered_indices()[:900]
+        greedy = self.dataset.batch_by_size(indices, max_tokens=1000, required_batch_size_multiple=4)
+        batches = self.dataset.batch_by_size(
+            indices, max_tokens=1000, required_batch_size_multiple=4, batch_planner='padded_cost',
+        )
+        self._check(batches, indices, 1000, bsz_mult=4)
+        self.assertLessEqual(len(batches), len(greedy))
+
+    def test_limits(self):
+        indices = np.arange(1000)
+        sizes = self.dataset.sizes_array()
+        batches = data_utils.batch_by_padded_cost(
+            indices, sizes, max_tokens=2000, max_sentences=30, max_attention_tokens=50000,
+        )
+        self._check(batches, indices, 2000)
+        for b in batches:
+            self.assertLessEqual(len(b), 30)
+            self.assertLessEqual(len(b) * sizes[b].max() ** 2, 50000)
+
+        def memory_fn(bsz, max_sizes):
+            return bsz * max_sizes.sum(axis=1)
+
+        batches = data_utils.batch_by_padded_cost(
+            indices, sizes, memory_fn=memory_fn, max_memory=1500,
+        )
+        for b in batches:
+            self.assertLessEqual(len(b) * (self.src_sizes[b].max() + self.tgt_sizes[b].max()), 1500)
+
+        with self.assertRaises(ValueError):
+            data_utils.batch_by_padded_cost(indices, sizes, max_tokens=50)
+        self.assertEqual(data_utils.batch_by_padded_cost(indices[:0], sizes, max_tokens=50), [])
+
+
+class TestCollateTokens(unittest.TestCase):
+
+    def _reference(self, values, pad_idx, eos_idx, left_pad, move_eos_to_beginning, pad_to_length):
+        size = max(max(len(v) for v in values), pad_to_length or 0)
+        rows = []
+        for v in values:
+            v = v.tolist()
+            if move_eos_to_beginning:
+                v = [v[-1] if eos_idx is None else eos_idx] + v[:-1]
+            padding = [pad_idx] * (size - len(v))
+            rows.append(padding + v if left_pad else v + padding)
+        return rows
+
+    def test_collate_tokens(self):
+        rng = np.random.RandomState(0)
+        values = [torch.from_numpy(rng.randint(4, 100, size=n)) for n in [3, 7, 1, 5]]
+        for left_pad in [False, True]:
+            for move_eos_to_beginning in [False, True]:
+                for eos_idx in [None, 2]:
+                    for pad_to_length in [None, 9]:
+                        expected = self._reference(
+                            values, 1, eos_idx, left_pad, move_eos_to_beginning, pad_to_length,
+                        )
+                        for vs in [values, [v.numpy() for v in values], [v.int() for v in values]]:
+                            res = data_utils.collate_tokens(
+                                vs, 1, eos_idx, left_pad, move_eos_to_beginning, pad_to_length,
+                            )
+                            self.assertEqual(res.tolist(), expected)
+
+    def test_collate_tokens_read_only(self):
+        # e.g., the views of memory-mapped datasets
+        data = np.arange(4, 16, dtype=np.int64).tobytes()
+        values = [np.frombuffer(data, dtype=np.int64, count=n) for n in [3, 7, 1]]
+        self.assertFalse(values[0].flags.writeable)
+        for move_eos_to_beginning in [False, True]:
+            res = data_utils.collate_tokens(
+                values, 1, left_pad=True, move_eos_to_beginning=move_eos_to_beginning,
+            )
+            expected = self._reference(values, 1, None, True, move_eos_to_beginning, None)
+            self.assertEqual(res.tolist(), expected)
+
+    def test_collate_tokens_out(self):
+        values = [torch.LongTensor([5, 6, 2]), torch.LongTensor([7, 2])]
+        out = torch.full((4, 8), 3, dtype=torch.long)
+        res = data_utils.collate_tokens(values, 1, out=out)
+        self.assertEqual(res.data_ptr(), out.data_ptr())
+        self.assertEqual(res.tolist(), [[5, 6, 2], [7, 2, 1]])
+        res = data_utils.collate_tokens(values[1:], 1, out=out, left_pad=True)
+        self.assertEqual(res.data_ptr(), out.data_ptr())
+        self.assertEqual(res.tolist(), [[7, 2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,12 +4,15 @@
 # LICENSE file in the root directory of this source tree.
 
 import io
+import os
+import pickle
 import tempfile
 import unittest
 
 import torch
 
 from fairseq.data import Dictionary
+from fairseq.tokenizer import tokenize_line
 
 
 class TestDictionary(unittest.TestCase):
@@ -85,6 +88,18 @@ class TestDictionary(unittest.TestCase):
         self.assertEqual(d.index(','), 7)
         self.assertEqual(d.index('▁de'), 8)
 
+    def test_finalize_overwrite(self):
+        dict_file = io.StringIO(
+            "a 5\n"
+            "b 3\n"
+            "a 7 #fairseq:overwrite\n"
+        )
+        d = Dictionary.load(dict_file)
+        d.finalize(padding_factor=1)
+        self.assertEqual(d.symbols[d.nspecial:], ['a', 'b'])
+        self.assertEqual(d.count[d.nspecial:], [7, 3])
+        self.assertEqual(d.index('a'), d.nspecial)
+
     def test_no_overwrite(self):
         # for example, Camembert overwrites <unk>, <s> and </s>
         dict_file = io.StringIO(
@@ -98,6 +113,26 @@ class TestDictionary(unittest.TestCase):
         with self.assertRaisesRegex(RuntimeError, 'Duplicate'):
             d.add_from_file(dict_file)
 
+    def test_add_file_to_dictionary(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'input.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                for i in range(200):
+                    f.write(' '.join(['c', 'b', 'a'][: i % 3 + 1] + ['w{}'.format(i % 7)]) + '\n')
+
+            dicts = []
+            for num_workers in [1, 3]:
+                d = Dictionary()
+                Dictionary.add_file_to_dictionary(path, d, tokenize_line, num_workers)
+                self.assertEqual(d.count[d.eos()], 201)
+                d.finalize(threshold=29, nwords=10, padding_factor=1)
+                dicts.append(d)
+            self.assertEqual(dicts[0], dicts[1])
+            # ties are broken alphabetically, then cut by nwords and threshold
+            self.assertEqual(
+                dicts[0].symbols[dicts[0].nspecial:], ['c', 'b', 'a', 'w0', 'w1', 'w2'],
+            )
+
     def test_space(self):
         # for example, character models treat space as a symbol
         dict_file = io.StringIO(
@@ -111,6 +146,72 @@ class TestDictionary(unittest.TestCase):
         self.assertEqual(d.index('a'), 5)
         self.assertEqual(d.index('b'), 6)
 
+    def test_compiled(self):
+        dict_file = io.StringIO(
+            "<unk> 999 #fairseq:overwrite\n"
+            "A 5\n"
+            "漢字 4\n"
+            "  3\n"
+            "é 2\n"
+        )
+        d = Dictionary()
+        d.add_from_file(dict_file)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dict.bin')
+            d.save_compiled(path)
+            c = Dictionary.load(path)
+            self.assertEqual(c, d)
+            self.assertEqual(len(c), len(d))
+            self.assertEqual(list(c.symbols), d.symbols)
+            self.assertEqual(list(c.count), d.count)
+            for sym in d.symbols + ['foo']:
+                self.assertEqual(c.index(sym), d.index(sym))
+            self.assertEqual(c.unk(), d.unk())
+
+            # pickling re-opens the memory-mapped file
+            c2 = pickle.loads(pickle.dumps(c))
+            self.assertEqual(c2.index('漢字'), d.index('漢字'))
+
+            # modifications are kept in memory
+            self.assertEqual(c.add_symbol('B'), len(d))
+            self.assertEqual(c.add_symbol('A', n=2), d.index('A'))
+            self.assertEqual(c.count[d.index('A')], 7)
+            self.assertEqual(c.index('B'), len(d))
+            self.assertEqual(c[len(d)], 'B')
+            self.assertEqual(c.string(torch.tensor([d.index('A'), len(d)])), 'A B')
+
+            # the text format can be written back
+            c = Dictionary.load(path)
+            c_file, d_file = io.StringIO(), io.StringIO()
+            c.save(c_file)
+            d.save(d_file)
+            self.assertEqual(c_file.getvalue(), d_file.getvalue())
+
+    def test_encode_lines_and_string_batch(self):
+        d = Dictionary()
+        for sym in ['A', 'B', 'C@@', 'D']:
+            d.add_symbol(sym)
+        lines = ['A B C@@ D', '', 'D  E A\n', 'C@@ C@@ D']
+        for kwargs in [{}, {'append_eos': False, 'reverse_order': True}]:
+            expected = [d.encode_line(line, add_if_not_exist=False, **kwargs) for line in lines]
+            encoded = d.encode_lines(lines, add_if_not_exist=False, **kwargs)
+            self.assertEqual([t.tolist() for t in encoded], [t.tolist() for t in expected])
+            self.assertEqual(encoded[0].dtype, expected[0].dtype)
+        self.assertEqual(d.encode_lines([], add_if_not_exist=False), [])
+
+        batch = torch.nn.utils.rnn.pad_sequence(
+            [t.long() for t in d.encode_lines(lines, add_if_not_exist=False)],
+            batch_first=True, padding_value=d.pad(),
+        )
+        for kwargs in [{}, {'bpe_symbol': '@@ ', 'escape_unk': True}, {'unk_string': 'UNK'},
+                       {'extra_symbols_to_ignore': [d.pad()]}]:
+            self.assertEqual(
+                d.string_batch(batch, **kwargs), [d.string(t, **kwargs) for t in batch],
+            )
+            self.assertEqual(
+                d.string_batch(list(batch), **kwargs), [d.string(t, **kwargs) for t in batch],
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
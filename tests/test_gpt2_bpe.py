@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pickle
+import unittest
+
+from fairseq.data.encoders.gpt2_bpe_utils import bytes_to_unicode, Encoder
+
+
+class TestGPT2BPE(unittest.TestCase):
+
+    def setUp(self):
+        # includes a duplicate merge and merges of symbols created later
+        merges = [
+            ('a', 'a'), ('aa', 'a'), ('a', 'aa'), ('a', 'a'), ('b', 'c'), ('a', 'bc'),
+            ('ab', 'c'), ('Ġ', 'a'), ('Ġa', 'b'),
+        ]
+        symbols = list(bytes_to_unicode().values()) + [a + b for a, b in merges]
+        encoder = {sym: i for i, sym in enumerate(dict.fromkeys(symbols))}
+        self.bpe = Encoder(encoder, merges, cache_size=4)
+
+    def _encode(self, text):
+        return [self.bpe.decoder[i] for i in self.bpe.encode(text)]
+
+    def test_encode(self):
+        self.assertEqual(self._encode('aaaaaaa'), ['aa', 'aa', 'aaa'])
+        self.assertEqual(self._encode('abcabc'), ['abc', 'abc'])
+        self.assertEqual(self._encode('aabcaabca'), ['aa', 'bc', 'aa', 'bc', 'a'])
+        self.assertEqual(self._encode(' abc aaa'), ['Ġ', 'abc', 'Ġ', 'aaa'])
+        self.assertEqual(self._encode('é'), ['Ã', '©'])
+        self.assertEqual(self.bpe.bpe('aaaaaaa'), 'aa aa aaa')
+        self.assertEqual(self.bpe.decode(self.bpe.encode(' abc é')), ' abc é')
+
+    def test_cache(self):
+        for text in ['a b c d e f', 'a e']:
+            self.bpe.encode(text)
+        info = self.bpe.cache_info()
+        self.assertEqual(info.currsize, 4)
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 7)
+
+    def test_encode_batch(self):
+        texts = ['aaaaaaa abc', 'aabcaabca', ' abc aaa é', '']
+        expected = [self.bpe.encode(text) for text in texts]
+        self.assertEqual(self.bpe.encode_batch(texts), expected)
+        bpe = pickle.loads(pickle.dumps(self.bpe))
+        self.assertEqual(bpe.encode_batch(texts, num_workers=2, chunksize=1), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary, indexed_dataset
+
+
+def build_mmap_dataset(prefix, items, dtype=np.uint16):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix), dtype=dtype,
+    )
+    for item in items:
+        builder.add_item(torch.IntTensor(item))
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+def random_items(rng, n, vocab_size=100, max_len=20):
+    return [rng.randint(0, vocab_size, size=rng.randint(1, max_len)).tolist() for _ in range(n)]
+
+
+class TestMMapIndexedDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def _read_files(self, prefix):
+        contents = []
+        for path_fn in [indexed_dataset.data_file_path, indexed_dataset.index_file_path]:
+            with open(path_fn(prefix), "rb") as f:
+                contents.append(f.read())
+        return contents
+
+    def test_merge_files(self):
+        shards = [random_items(self.rng, n) for n in [5, 0, 17, 3]]
+        for i, items in enumerate(shards):
+            build_mmap_dataset(self._path("shard{}".format(i)), items)
+        others = [self._path("shard{}".format(i)) for i in range(1, len(shards))]
+
+        ref = indexed_dataset.MMapIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(self._path("ref")), dtype=np.uint16,
+        )
+        out = indexed_dataset.MMapIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(self._path("out")), dtype=np.uint16,
+        )
+        for builder in [ref, out]:
+            for item in shards[0]:
+                builder.add_item(torch.IntTensor(item))
+        for other in others:
+            ref.merge_file_(other)
+        out.merge_files_(others, num_threads=2)
+        # the builder must still be usable after a merge
+        for builder in [ref, out]:
+            builder.add_item(torch.IntTensor([1, 2, 3]))
+        ref.finalize(indexed_dataset.index_file_path(self._path("ref")))
+        out.finalize(indexed_dataset.index_file_path(self._path("out")))
+
+        self.assertEqual(self._read_files(self._path("ref")), self._read_files(self._path("out")))
+        ds = indexed_dataset.MMapIndexedDataset(self._path("out"))
+        expected = sum(shards, []) + [[1, 2, 3]]
+        self.assertEqual(len(ds), len(expected))
+        for i, item in enumerate(expected):
+            self.assertEqual(ds[i].tolist(), item)
+
+
+class TestShardedMMapIndexedDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.shards = [random_items(rng, n) for n in [4, 0, 11, 1, 7]]
+        self.shard_paths = []
+        for i, items in enumerate(self.shards):
+            path = os.path.join(self.tmpdir.name, "shards", "train{}".format(i))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            build_mmap_dataset(path, items)
+            self.shard_paths.append(path)
+        self.prefix = os.path.join(self.tmpdir.name, "train")
+        indexed_dataset.write_manifest(self.prefix, self.shard_paths)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sharded_dataset(self):
+        expected = sum(self.shards, [])
+        self.assertEqual(indexed_dataset.infer_dataset_impl(self.prefix), "mmap")
+        ds = indexed_dataset.make_dataset(self.prefix, impl="mmap")
+        self.assertIsInstance(ds, indexed_dataset.ShardedMMapIndexedDataset)
+        self.assertEqual(len(ds), len(expected))
+        self.assertEqual(ds.sizes.tolist(), [len(item) for item in expected])
+        for i, item in enumerate(expected):
+            self.assertEqual(ds[i].tolist(), item)
+        with self.assertRaises(IndexError):
+            ds[len(expected)]
+
+    def test_max_open_shards(self):
+        expected = sum(self.shards, [])
+        ds = indexed_dataset.ShardedMMapIndexedDataset(self.prefix, max_open_shards=2)
+        for i in reversed(range(len(expected))):
+            self.assertEqual(ds[i].tolist(), expected[i])
+            self.assertLessEqual(len(ds._shards), 2)
+
+    def test_get_range(self):
+        flat = sum(sum(self.shards, []), [])
+        ds = indexed_dataset.ShardedMMapIndexedDataset(self.prefix)
+        for start_idx, start_offset, length in [(0, 0, len(flat)), (2, 1, 30), (5, 0, 3)]:
+            start = sum(len(item) for item in sum(self.shards, [])[:start_idx]) + start_offset
+            self.assertEqual(
+                ds.get_range(start_idx, start_offset, length).tolist(),
+                flat[start:start + length],
+            )
+
+    def test_pickle(self):
+        ds = indexed_dataset.ShardedMMapIndexedDataset(self.prefix)
+        ds[0]
+        ds2 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual(len(ds2._shards), 0)
+        self.assertEqual(ds2[len(ds2) - 1].tolist(), self.shards[-1][-1])
+
+
+class TestCompressedIndexedDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _build(self, name, shards, codec):
+        prefix = os.path.join(self.tmpdir.name, name)
+        builder = indexed_dataset.CompressedIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(prefix), dtype=np.uint16, block_size=4, codec=codec,
+        )
+        for item in shards[0]:
+            builder.add_item(torch.IntTensor(item))
+        flat = sum(shards[1], [])
+        builder.add_items(np.array(flat), np.array([len(item) for item in shards[1]]))
+        for i, items in enumerate(shards[2:]):
+            other = prefix + "_other{}".format(i)
+            other_builder = indexed_dataset.CompressedIndexedDatasetBuilder(
+                indexed_dataset.data_file_path(other), dtype=np.uint16, block_size=3,
+                codec=codec,
+            )
+            for item in items:
+                other_builder.add_item(torch.IntTensor(item))
+            other_builder.finalize(indexed_dataset.index_file_path(other))
+            builder.merge_file_(other)
+        builder.finalize(indexed_dataset.index_file_path(prefix))
+        return prefix
+
+    def _test_codec(self, codec):
+        shards = [random_items(self.rng, n) for n in [6, 13, 5, 2]]
+        expected = sum(shards, [])
+        prefix = self._build(codec, shards, codec)
+        self.assertEqual(indexed_dataset.infer_dataset_impl(prefix), "compressed")
+        ds = indexed_dataset.make_dataset(prefix, impl="compressed")
+        self.assertEqual(len(ds), len(expected))
+        self.assertEqual(ds.sizes.tolist(), [len(item) for item in expected])
+        for i in self.rng.permutation(len(expected)):
+            self.assertEqual(ds[i].tolist(), expected[i])
+        self.assertLessEqual(len(ds._cache), ds._cache_blocks)
+        ds2 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual(ds2[len(ds2) - 1].tolist(), expected[-1])
+
+    def test_zlib(self):
+        self._test_codec("zlib")
+
+    def test_zstd(self):
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            raise unittest.SkipTest("zstandard not installed")
+        self._test_codec("zstd")
+
+
+class TestIndexedRawTextDataset(unittest.TestCase):
+
+    TEXT = (
+        "A B C D\n"
+        "B  C\tD E\r\n"
+        "\n"
+        "C D F\rD\r\r\n"
+        "</s> <unk> zz zz\n"
+        "é ñ 漢字 D"  # no trailing newline
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "train.txt")
+        self.dict = Dictionary()
+        for sym in ["A", "B", "C", "D", "é", "漢字"]:
+            self.dict.add_symbol(sym)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, text):
+        with open(self.path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+
+    def _expected(self):
+        expected = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                tokens = self.dict.encode_line(line, add_if_not_exist=False)
+                expected.append((line.strip("\n"), tokens.tolist()))
+        return expected
+
+    def _assert_matches_text(self, ds):
+        expected = self._expected()
+        self.assertEqual(len(ds), len(expected))
+        self.assertEqual(ds.sizes.tolist(), [len(tokens) for _, tokens in expected])
+        for i, (line, tokens) in enumerate(expected):
+            self.assertEqual(ds.get_original_text(i), line)
+            self.assertEqual(ds[i].tolist(), tokens)
+
+    def test_raw_text_dataset(self):
+        self._write(self.TEXT * 3)
+        ds = indexed_dataset.make_dataset(self.path, impl="raw", dictionary=self.dict)
+        self._assert_matches_text(ds)
+        self.assertTrue(os.path.exists(indexed_dataset.raw_index_file_path(self.path)))
+
+        # the cached index is reused
+        ds = indexed_dataset.IndexedRawTextDataset(self.path, self.dict)
+        self.assertIsNotNone(ds._index_mmap)
+        self._assert_matches_text(ds)
+        ds2 = pickle.loads(pickle.dumps(ds))
+        self.assertEqual(ds2[len(ds2) - 1].tolist(), ds[len(ds) - 1].tolist())
+
+        # and rebuilt once the text changes
+        self._write(self.TEXT + "\nA A\n")
+        ds = indexed_dataset.IndexedRawTextDataset(self.path, self.dict)
+        self._assert_matches_text(ds)
+
+    def test_find_line_starts(self):
+        data = np.frombuffer((self.TEXT * 5).encode("utf-8"), dtype=np.uint8)
+        expected = indexed_dataset._find_line_starts(data)
+        for chunk_size in [1, 2, 7]:
+            starts = indexed_dataset._find_line_starts(data, chunk_size=chunk_size)
+            self.assertEqual(starts.tolist(), expected.tolist())
+        self.assertEqual(indexed_dataset._find_line_starts(data[:0]).tolist(), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
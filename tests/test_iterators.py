@@ -3,9 +3,14 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import unittest
+from unittest.mock import patch
 
-from fairseq.data import iterators
+import numpy as np
+import torch
+
+from fairseq.data import iterators, ListDataset
 
 
 class TestIterators(unittest.TestCase):
@@ -70,6 +75,112 @@ class TestIterators(unittest.TestCase):
         itr = iterators.ShardedIterator(x, num_shards=3, shard_id=0)
         self.test_counting_iterator(ref, itr)
 
+    def _prefetched(self, device, float_dtype=None):
+        samples = [
+            {'id': torch.LongTensor([i]), 'x': torch.full((2, 3), float(i))}
+            for i in range(10)
+        ]
+        itr = iterators.DevicePrefetchIterator(samples, device, float_dtype=float_dtype)
+        self.assertEqual(len(itr), 10)
+        self.test_counting_iterator(samples, iterators.CountingIterator(itr))
+        return samples, list(iterators.DevicePrefetchIterator(samples, device, float_dtype))
+
+    def test_device_prefetch_iterator_cpu(self):
+        samples, prefetched = self._prefetched('cpu', float_dtype=torch.half)
+        # batches are passed through unchanged without CUDA
+        for sample, p in zip(samples, prefetched):
+            self.assertIs(p, sample)
+
+    @unittest.skipIf(not torch.cuda.is_available(), 'test requires a GPU')
+    def test_device_prefetch_iterator_cuda(self):
+        samples, prefetched = self._prefetched('cuda', float_dtype=torch.half)
+        self.assertEqual(len(prefetched), len(samples))
+        for sample, p in zip(samples, prefetched):
+            self.assertTrue(p['x'].is_cuda)
+            self.assertEqual(p['x'].dtype, torch.half)
+            self.assertEqual(p['id'].dtype, torch.long)
+            self.assertTrue(torch.equal(p['x'].float().cpu(), sample['x']))
+
+
+def collate_with_pid(samples):
+    return samples, os.getpid()
+
+
+class TestEpochBatchIterator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.dataset = ListDataset(list(range(100)))
+        sizes = rng.randint(1, 6, size=23)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.batches = [list(range(offsets[i], offsets[i + 1])) for i in range(len(sizes))]
+
+    def _epoch_itr(self, **kwargs):
+        return iterators.EpochBatchIterator(
+            self.dataset, collate_with_pid, self.batches, seed=3, **kwargs
+        )
+
+    def test_batch_order(self):
+        for num_shards in [1, 2, 5]:
+            for shard_id in range(num_shards):
+                for shuffle in [True, False]:
+                    epoch_itr = self._epoch_itr(num_shards=num_shards, shard_id=shard_id)
+                    batches = [b for b, _ in epoch_itr.next_epoch_itr(shuffle=shuffle)]
+
+                    # reference: shuffle the batches, then shard them
+                    expected = list(self.batches)
+                    if shuffle:
+                        with iterators.data_utils.numpy_seed(3 + 1):
+                            np.random.shuffle(expected)
+                    expected = list(iterators.ShardedIterator(
+                        expected, num_shards, shard_id, fill_value=[],
+                    ))
+                    self.assertEqual(batches, expected)
+
+    def test_resume(self):
+        epoch_itr = self._epoch_itr(num_shards=2, shard_id=1)
+        itr = epoch_itr.next_epoch_itr()
+        expected = [b for b, _ in itr]
+        itr = epoch_itr.next_epoch_itr()
+        for _ in range(5):
+            next(itr)
+        state_dict = epoch_itr.state_dict()
+
+        epoch_itr = self._epoch_itr(num_shards=2, shard_id=1)
+        epoch_itr.load_state_dict(state_dict)
+        itr = epoch_itr.next_epoch_itr()
+        self.assertEqual(itr.n, 5)
+        self.assertEqual(epoch_itr.epoch, 2)
+        with iterators.data_utils.numpy_seed(3 + 2):
+            order = np.random.permutation(len(self.batches))[1::2]
+        # the shard is padded with an empty batch
+        self.assertEqual([b for b, _ in itr], [self.batches[i] for i in order[5:]] + [[]])
+        self.assertNotEqual(expected[5:], [self.batches[i] for i in order[5:]] + [[]])
+
+    def test_persistent_workers(self):
+        pids = {}
+        for persistent_workers in [True, False]:
+            epoch_itr = self._epoch_itr(num_workers=2, persistent_workers=persistent_workers)
+            pids[persistent_workers] = set()
+            for _ in range(3):
+                samples = []
+                for batch, pid in epoch_itr.next_epoch_itr():
+                    samples.extend(batch)
+                    pids[persistent_workers].add(pid)
+                self.assertEqual(sorted(samples), list(range(len(samples))))
+        self.assertEqual(len(pids[True]), 2)
+        self.assertEqual(len(pids[False]), 6)
+
+    def test_persistent_workers_old_torch(self):
+        # DataLoader only accepts persistent_workers from PyTorch 1.7
+        with patch.object(iterators, '_dataloader_supports_persistent_workers', return_value=False):
+            with self.assertRaises(ValueError):
+                self._epoch_itr(num_workers=2, persistent_workers=True)
+            with patch.object(torch.utils.data, 'DataLoader', wraps=torch.utils.data.DataLoader) as dl:
+                epoch_itr = self._epoch_itr(num_workers=0, persistent_workers=True)
+                list(epoch_itr.next_epoch_itr())
+            self.assertNotIn('persistent_workers', dl.call_args[1])
+
 
 if __name__ == '__main__':
     unittest.main()
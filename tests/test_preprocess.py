@@ -0,0 +1,72 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from fairseq import options
+from fairseq_cli import preprocess
+from tests.utils import create_dummy_data
+
+
+class TestPreprocess(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmpdir.name
+        create_dummy_data(self.data_dir)
+        for lang in ['in', 'out']:
+            with open(os.path.join(self.data_dir, 'all.' + lang), 'w') as out:
+                for split in ['train', 'valid']:
+                    with open(os.path.join(self.data_dir, '{}.{}'.format(split, lang))) as f:
+                        shutil.copyfileobj(f, out)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def _preprocess(self, destdir, trainpref, extra_flags=None):
+        preprocess.main(options.get_preprocessing_parser().parse_args([
+            '--source-lang', 'in',
+            '--target-lang', 'out',
+            '--trainpref', os.path.join(self.data_dir, trainpref),
+            '--destdir', destdir,
+        ] + (extra_flags or [])))
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_append(self):
+        dest = os.path.join(self.data_dir, 'append')
+        self._preprocess(dest, 'train')
+        # bytes left by an interrupted append are discarded
+        with open(os.path.join(dest, 'train.in-out.in.bin'), 'ab') as f:
+            f.write(b'\x00' * 10)
+        self._preprocess(dest, 'valid', ['--append', '--workers', '2'])
+
+        ref = os.path.join(self.data_dir, 'ref')
+        self._preprocess(ref, 'all', [
+            '--srcdict', os.path.join(dest, 'dict.in.txt'),
+            '--tgtdict', os.path.join(dest, 'dict.out.txt'),
+        ])
+        for name in os.listdir(ref):
+            if name != 'preprocess.log':
+                self.assertEqual(
+                    self._read(os.path.join(dest, name)), self._read(os.path.join(ref, name)), name,
+                )
+
+        with self.assertRaisesRegex(ValueError, 'does not match'):
+            self._preprocess(dest, 'valid', [
+                '--append', '--srcdict', os.path.join(dest, 'dict.out.txt'),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
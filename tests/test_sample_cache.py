@@ -0,0 +1,91 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import torch
+
+from fairseq.data import Dictionary, MaskTokensDataset
+from fairseq.data.sample_cache import InProcessSampleCache
+from fairseq.logging import metrics
+
+import tests.utils as test_utils
+
+
+class TestSampleCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = InProcessSampleCache(max_items=2, eviction='lru')
+        cache.put(0, 'a')
+        cache.put(1, 'b')
+        self.assertEqual(cache.get(0), 'a')
+        cache.put(2, 'c')  # evicts 1
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(0), 'a')
+        self.assertEqual(cache.get(2), 'c')
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 1, 1))
+
+        with metrics.aggregate() as agg:
+            cache.log_stats()
+            self.assertEqual(agg.get_smoothed_value('sample_cache_evict'), 1)
+
+    def test_lfu(self):
+        cache = InProcessSampleCache(max_items=2, eviction='lfu')
+        cache.put(0, 'a')
+        cache.put(1, 'b')
+        cache.get(0)
+        cache.get(0)
+        cache.get(1)
+        cache.put(2, 'c')  # evicts 1
+        cache.put(3, 'd')  # evicts 2
+        self.assertEqual(cache.get(0), 'a')
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), 'd')
+
+    def test_max_bytes(self):
+        cache = InProcessSampleCache(max_bytes=100)
+        for i in range(10):
+            cache.put(i, torch.zeros(10, dtype=torch.int32))  # 40 bytes
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 80)
+        cache.put(10, torch.zeros(100, dtype=torch.int32))  # too large
+        self.assertIsNone(cache.get(10))
+        self.assertEqual(cache.get(9).tolist(), [0] * 10)
+
+    def test_clear(self):
+        cache = InProcessSampleCache(max_items=2, max_bytes=100)
+        cache.put(0, torch.zeros(10, dtype=torch.int32))
+        cache.clear()
+        self.assertIsNone(cache.get(0))
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+        cache.put(1, 'b')
+        self.assertEqual(cache.get(1), 'b')
+
+    def test_masks_change_with_epoch(self):
+        vocab = Dictionary()
+        for i in range(20):
+            vocab.add_symbol(str(i))
+        mask_idx = vocab.add_symbol('<mask>')
+        data = [torch.arange(vocab.nspecial, len(vocab) - 1) for _ in range(4)]
+        src_dataset, tgt_dataset = MaskTokensDataset.apply_mask(
+            test_utils.TestDataset(data), vocab, pad_idx=vocab.pad(),
+            mask_idx=mask_idx, seed=1, mask_prob=0.5,
+        )
+        masks = []
+        for epoch in [1, 2, 1]:
+            src_dataset.set_epoch(epoch)
+            tgt_dataset.set_epoch(epoch)
+            masks.append([tgt_dataset[i].ne(vocab.pad()).tolist() for i in range(len(data))])
+            for i in range(len(data)):
+                # the inputs are masked where the targets are set
+                masked = tgt_dataset[i].ne(vocab.pad())
+                self.assertTrue(src_dataset[i][~masked].equal(data[i][~masked]))
+        self.assertNotEqual(masks[0], masks[1])
+        self.assertEqual(masks[0], masks[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
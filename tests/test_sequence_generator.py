@@ -4,12 +4,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import math
 import tempfile
 import unittest
 
 import tests.utils as test_utils
 import torch
 from fairseq import search
+from fairseq.data import data_utils
 from fairseq.data.dictionary import Dictionary
 
 from fairseq.models.transformer import TransformerModel
@@ -20,6 +22,22 @@ from fairseq.tasks.fairseq_task import FairseqTask
 DEFAULT_TEST_VOCAB_SIZE = 100
 
 
+def no_repeat_ngram_reference(tokens, lprobs, n: int, step: int):
+    """The original ngram blocking of SequenceGenerator, on CPU with dicts."""
+    gen_ngrams = [{} for _ in range(tokens.size(0))]
+    for bbsz_idx in range(tokens.size(0)):
+        gen_tokens = tokens[bbsz_idx].tolist()
+        for ngram in zip(*[gen_tokens[i:] for i in range(n)]):
+            key = ",".join(str(x) for x in ngram[:-1])
+            gen_ngrams[bbsz_idx].setdefault(key, []).append(ngram[-1])
+    if step + 2 - n >= 0:
+        for bbsz_idx in range(tokens.size(0)):
+            key = ",".join(str(x) for x in tokens[bbsz_idx, step + 2 - n : step + 1].tolist())
+            for banned in gen_ngrams[bbsz_idx].get(key, []):
+                lprobs[bbsz_idx, banned] = -math.inf
+    return lprobs
+
+
 class DummyTask(FairseqTask):
     def __init__(self, args):
         super().__init__(args)
@@ -128,6 +146,103 @@ class TestJitSequeneceGenerator(TestJitSequenceGeneratorBase):
         scripted_model = torch.jit.script(generator)
         self._test_save_and_load(scripted_model)
 
+    @unittest.skipIf(
+        torch.__version__ < "1.6.0", "Targeting OSS scriptability for the 1.6 release"
+    )
+    def test_preallocate_kv_cache(self):
+        model = self.transformer_model.eval()
+        generators = [
+            SequenceGenerator(
+                [model], self.task.tgt_dict, beam_size=3, max_len_b=8,
+                preallocate_kv_cache=preallocate,
+            )
+            for preallocate in [False, True]
+        ]
+        generators.append(torch.jit.script(generators[1]))
+        hypos = [generator.forward(self.sample) for generator in generators]
+        for other in hypos[1:]:
+            for sent, other_sent in zip(hypos[0], other):
+                for hypo, other_hypo in zip(sent, other_sent):
+                    self.assertHypoEqual(hypo, other_hypo)
+
+    @unittest.skipIf(
+        torch.__version__ < "1.6.0", "Targeting OSS scriptability for the 1.6 release"
+    )
+    def test_share_encoder_out(self):
+        model = self.transformer_model.eval()
+        # the sentences finish at different steps and leave the batch
+        src_lengths = torch.LongTensor([2, 10, 5, 7])
+        src_tokens = data_utils.collate_tokens([
+            torch.cat((torch.randint(4, 50, (src_len,)), torch.LongTensor([self.task.tgt_dict.eos()])))
+            for src_len in src_lengths.tolist()
+        ], pad_idx=self.task.tgt_dict.pad(), left_pad=True)
+        sample = {
+            "net_input": {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        }
+        generators = [
+            SequenceGenerator(
+                [model], self.task.tgt_dict, beam_size=2, max_len_b=10,
+                search_strategy=search.LengthConstrainedBeamSearch(
+                    self.task.tgt_dict, min_len_a=1, min_len_b=0, max_len_a=1, max_len_b=0,
+                ),
+                share_encoder_out=share,
+            )
+            for share in [False, True]
+        ]
+        generators.append(torch.jit.script(generators[1]))
+        hypos = [generator.forward(sample) for generator in generators]
+        for sent, src_len in zip(hypos[0], src_lengths.tolist()):
+            self.assertEqual(sent[0]["tokens"].numel(), src_len + 1)
+        for other in hypos[1:]:
+            for sent, other_sent in zip(hypos[0], other):
+                for hypo, other_hypo in zip(sent, other_sent):
+                    self.assertHypoEqual(hypo, other_hypo)
+
+    @unittest.skipIf(
+        torch.__version__ < "1.6.0", "Targeting OSS scriptability for the 1.6 release"
+    )
+    def test_finalize_batched(self):
+        model = self.transformer_model.eval()
+        tgt_dict = self.task.tgt_dict
+        srcs = [
+            torch.cat((torch.randint(4, 50, (src_len,)), torch.LongTensor([tgt_dict.eos()])))
+            for src_len in [3, 9, 5, 12, 2]
+        ]
+        # the sentences finish at different steps and leave the batch
+        generator = torch.jit.script(
+            SequenceGenerator(
+                [model], tgt_dict, beam_size=3, max_len_a=1, max_len_b=2,
+                search_strategy=search.LengthConstrainedBeamSearch(
+                    tgt_dict, min_len_a=1, min_len_b=0, max_len_a=1, max_len_b=0,
+                ),
+            )
+        )
+        hypos = generator.forward({
+            "net_input": {
+                "src_tokens": data_utils.collate_tokens(srcs, tgt_dict.pad(), left_pad=True),
+                "src_lengths": torch.LongTensor([src.numel() for src in srcs]),
+            }
+        })
+        for src, sent in zip(srcs, hypos):
+            expected = generator.forward({
+                "net_input": {
+                    "src_tokens": src.unsqueeze(0),
+                    "src_lengths": torch.LongTensor([src.numel()]),
+                }
+            })[0]
+            self.assertEqual(len(sent), len(expected))
+            # the attention differs in the padding of the source
+            for hypo, expected_hypo in zip(sent, expected):
+                self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                self.assertAlmostEqual(
+                    hypo["positional_scores"], expected_hypo["positional_scores"]
+                )
+                self.assertLess(abs(hypo["score"] - expected_hypo["score"]), 1e-4)
+                # the hypotheses do not share the buffers of the batch
+                for name in ["tokens", "score", "attention", "positional_scores"]:
+                    self.assertIsNone(hypo[name]._base, name)
+            self.assertEqual(sent[0]["tokens"].numel(), src.numel())
+
 
 class TestJitEnsemble(TestJitSequenceGeneratorBase):
 
@@ -315,6 +430,38 @@ class TestSequeneceGenerator(TestSequenceGeneratorBase):
         self.assertHypoTokens(hypos[0][0], [w1, eos])
         self.assertHypoScore(hypos[0][0], [0.9, 1.0])
 
+    def test_no_repeat_ngram(self):
+        pad = self.tgt_dict.pad()
+        torch.manual_seed(0)
+        for n in [1, 2, 3, 4]:
+            generator = SequenceGenerator(
+                [self.model], self.tgt_dict, beam_size=2, no_repeat_ngram_size=n
+            )
+            for step in range(8):
+                # the few symbols of the dictionary make the ngrams repeat
+                tokens = torch.randint(4, len(self.tgt_dict), (6, 10))
+                lprobs = torch.randn(6, len(self.tgt_dict))
+                # only the tokens up to step are read, the others are ignored
+                expected = no_repeat_ngram_reference(tokens[:, : step + 1], lprobs.clone(), n, step)
+                banned = generator._no_repeat_ngram(tokens, lprobs.clone(), 3, 2, step)
+                self.assertTensorEqual(banned[:, pad + 1:], expected[:, pad + 1:])
+                self.assertTensorEqual(banned[:, :pad], expected[:, :pad])
+
+                # the reference reads the whole row, which is still padded
+                # after step during generation: the ngrams reaching there
+                # have pad as last token or in their first n - 1 tokens,
+                # which never match the prefix, so they can only ban pad
+                tokens[:, step + 1:] = pad
+                full_row = no_repeat_ngram_reference(tokens, lprobs.clone(), n, step)
+                self.assertTensorEqual(full_row[:, pad + 1:], expected[:, pad + 1:])
+                self.assertTensorEqual(full_row[:, :pad], expected[:, :pad])
+
+                # pad is always banned by SequenceGenerator
+                lprobs[:, pad] = -math.inf
+                expected = no_repeat_ngram_reference(tokens, lprobs.clone(), n, step)
+                banned = generator._no_repeat_ngram(tokens, lprobs, 3, 2, step)
+                self.assertTensorEqual(banned, expected)
+
 
 class TestDiverseBeamSearch(TestSequenceGeneratorBase):
 
@@ -0,0 +1,154 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq import options, utils
+from fairseq.data import data_utils, LanguagePairDataset, MonolingualDataset
+from fairseq.models.transformer import TransformerModel
+from fairseq.models.transformer_lm import TransformerLanguageModel
+from fairseq.modules import LearnedPositionalEmbedding
+from fairseq.tasks.language_modeling import LanguageModelingTask
+from fairseq.tasks.translation import TranslationTask
+from tests.test_export import get_dummy_task_and_parser
+
+
+class TestSequencePacking(unittest.TestCase):
+
+    def setUp(self):
+        self.task, self.parser = get_dummy_task_and_parser()
+        self.dict = self.task.dictionary
+        self.rng = np.random.RandomState(0)
+
+    def _sentences(self, n):
+        return [
+            torch.LongTensor(
+                list(self.rng.randint(4, len(self.dict), size=self.rng.randint(1, 12)))
+                + [self.dict.eos()]
+            )
+            for _ in range(n)
+        ]
+
+    def _loss(self, model, batch):
+        net_output = model(**batch['net_input'])
+        lprobs = model.get_normalized_probs(net_output, log_probs=True)
+        target = batch['target']
+        nll = -lprobs.gather(-1, target.unsqueeze(-1)).squeeze(-1)
+        return nll[target.ne(self.dict.pad())].sum()
+
+    def test_pack_sequences(self):
+        lengths = [[5, 3], [2, 6], [4, 4], [1, 1], [3, 2]]
+        rows = data_utils.pack_sequences(lengths)
+        self.assertEqual(sorted(i for row in rows for i in row), list(range(5)))
+        for row in rows:
+            self.assertTrue((np.array(lengths)[row].sum(axis=0) <= [5, 6]).all())
+        self.assertLess(len(rows), 5)
+
+        values = [torch.LongTensor([10, 11, 2]), torch.LongTensor([12, 2])]
+        tokens, segments = data_utils.collate_packed_tokens(
+            values, [[0, 1]], pad_idx=1, eos_idx=2, move_eos_to_beginning=True, pad_to_length=6,
+        )
+        self.assertEqual(tokens.tolist(), [[2, 10, 11, 2, 12, 1]])
+        self.assertEqual(segments.tolist(), [[1, 1, 1, 2, 2, 0]])
+        self.assertEqual(
+            utils.make_segment_positions(segments, 1).tolist(), [[2, 3, 4, 2, 3, 1]],
+        )
+
+    def test_segment_positions(self):
+        segments = torch.LongTensor([
+            [1, 1, 1, 2, 2, 3, 0], [4, 4, 4, 4, 4, 4, 4], [1, 2, 3, 3, 0, 0, 0],
+        ])
+        positions = utils.make_segment_positions(segments, 1)
+        self.assertEqual(positions.tolist(), [
+            [2, 3, 4, 2, 3, 2, 1], [2, 3, 4, 5, 6, 7, 8], [2, 2, 2, 3, 1, 1, 1],
+        ])
+
+        embed_positions = LearnedPositionalEmbedding(10, 4, padding_idx=1)
+        tokens = torch.where(segments.ne(0), segments + 3, torch.ones_like(segments))
+        embed_positions(tokens, positions=positions)
+        # the positions must be offset by the padding index
+        with self.assertRaises(AssertionError):
+            embed_positions(tokens, positions=(positions - 2).clamp(min=0))
+
+    def test_translation(self):
+        TransformerModel.add_args(self.parser)
+        args = self.parser.parse_args([])
+        args.encoder_layers = args.decoder_layers = 2
+        src, tgt = self._sentences(20), self._sentences(20)
+        datasets = [
+            LanguagePairDataset(
+                src, [len(s) for s in src], self.dict, tgt, [len(t) for t in tgt], self.dict,
+                packed=packed,
+            )
+            for packed in [False, True]
+        ]
+        batches = [ds.collater([ds[i] for i in range(len(ds))]) for ds in datasets]
+        self.assertLess(batches[1]['target'].size(0), batches[0]['target'].size(0))
+        self.assertEqual(batches[1]['ntokens'], batches[0]['ntokens'])
+        self.assertEqual(sorted(batches[1]['id'].tolist()), list(range(20)))
+
+        for learned_pos in [False, True]:
+            args.encoder_learned_pos = args.decoder_learned_pos = learned_pos
+            model = TransformerModel.build_model(args, self.task).eval()
+            loss, packed_loss = [self._loss(model, batch) for batch in batches]
+            self.assertAlmostEqual(loss.item(), packed_loss.item(), places=3)
+
+    def test_language_model(self):
+        TransformerLanguageModel.add_args(self.parser)
+        args = self.parser.parse_args([])
+        args.decoder_layers = 2
+        model = TransformerLanguageModel.build_model(args, self.task).eval()
+
+        class TokenTargetDataset(torch.utils.data.Dataset):
+            def __init__(self, sentences):
+                self.sentences = sentences
+
+            def __getitem__(self, index):
+                s = self.sentences[index]
+                return torch.cat([s[-1:], s[:-1]]), s, None
+
+            def __len__(self):
+                return len(self.sentences)
+
+        sentences = self._sentences(20)
+        losses = []
+        for packed in [False, True]:
+            ds = MonolingualDataset(
+                TokenTargetDataset(sentences), [len(s) for s in sentences], self.dict, self.dict,
+                add_eos_for_other_targets=False, shuffle=False, targets=['future'],
+                packed=packed,
+            )
+            batch = ds.collater([ds[i] for i in range(len(ds))])
+            self.assertEqual(batch['nsentences'], 20)
+            losses.append(self._loss(model, batch).item())
+        self.assertAlmostEqual(losses[0], losses[1], places=3)
+
+
+    def test_unsupported_model(self):
+        for task, task_cls, supported, unsupported in [
+            ('translation', TranslationTask, 'transformer', 'lstm'),
+            ('language_modeling', LanguageModelingTask, 'transformer_lm', 'lstm_lm'),
+        ]:
+            for arch in [supported, unsupported]:
+                parser = options.get_training_parser()
+                args = options.parse_args_and_arch(
+                    parser, ['dummy', '--task', task, '--arch', arch, '--pack-sequences'],
+                )
+                if task == 'translation':
+                    task_obj = task_cls(args, self.dict, self.dict)
+                else:
+                    task_obj = task_cls(args, self.dict, targets=['future'])
+                if arch == supported:
+                    task_obj.build_model(args)
+                else:
+                    with self.assertRaisesRegex(ValueError, '--pack-sequences'):
+                        task_obj.build_model(args)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import gc
+import multiprocessing
+import os
+import pickle
+import unittest
+
+import numpy as np
+
+from fairseq.data.plasma_utils import SharedArray
+
+
+def _describe(shared_array, queue):
+    queue.put((
+        isinstance(shared_array.array, np.memmap),
+        int(shared_array.array.sum()),
+        shared_array.path,
+    ))
+
+
+class TestSharedArray(unittest.TestCase):
+
+    def _run_in_child(self, shared_array):
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        p = ctx.Process(target=_describe, args=(shared_array, queue))
+        p.start()
+        result = queue.get(timeout=60)
+        p.join()
+        return result
+
+    def test_shared_with_child_process(self):
+        array = np.arange(1 << 18, dtype=np.int64)  # 2MB
+        shared_array = SharedArray(array.copy())
+        is_memmap, total, path = self._run_in_child(shared_array)
+        self.assertTrue(is_memmap)
+        self.assertEqual(total, int(array.sum()))
+        self.assertEqual(path, shared_array.path)
+        self.assertTrue(os.path.exists(path))
+        # the parent continues with the shared copy
+        self.assertTrue(np.array_equal(shared_array.array, array))
+
+        del shared_array
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+    def test_small_arrays_are_pickled(self):
+        shared_array = SharedArray(np.arange(10))
+        is_memmap, total, path = self._run_in_child(shared_array)
+        self.assertFalse(is_memmap)
+        self.assertEqual(total, 45)
+        self.assertIsNone(path)
+
+    def test_pickle_outside_multiprocessing(self):
+        shared_array = SharedArray(np.arange(1 << 18), min_nbytes=0)
+        copy = pickle.loads(pickle.dumps(shared_array))
+        self.assertIsNone(copy.path)
+        self.assertTrue(np.array_equal(copy.array, shared_array.array))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,14 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
+import tempfile
 import unittest
 
+import numpy as np
 import torch
 
-from fairseq.data import TokenBlockDataset
+from fairseq.data import indexed_dataset, TokenBlockDataset
 
 import tests.utils as test_utils
 
@@ -73,6 +76,41 @@ class TestTokenBlockDataset(unittest.TestCase):
         self.assertEqual(ds[1].tolist(), [5, 1, 1])
         self.assertEqual(ds[2].tolist(), [6, 1])
 
+    def test_mmap_get_range(self):
+        rng = np.random.RandomState(0)
+        data = [
+            torch.tensor(rng.randint(2, 100, size=n).tolist() + [1], dtype=torch.long)
+            for n in rng.randint(0, 8, size=50)
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prefix = os.path.join(tmpdir, "train")
+            builder = indexed_dataset.MMapIndexedDatasetBuilder(
+                indexed_dataset.data_file_path(prefix), dtype=np.uint16,
+            )
+            for item in data:
+                builder.add_item(item)
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+            mmap_ds = indexed_dataset.MMapIndexedDataset(prefix)
+
+            self.assertEqual(
+                mmap_ds.get_range(3, 1, 20).tolist(), torch.cat(data[3:])[1:21].tolist(),
+            )
+            for break_mode, block_size in [("none", 1), ("none", 7), ("complete", 9), ("eos", None)]:
+                for include_targets in [False, True]:
+                    kwargs = dict(
+                        block_size=block_size, pad=0, eos=1, break_mode=break_mode,
+                        include_targets=include_targets,
+                    )
+                    ref = self._build_dataset(data, **kwargs)
+                    ds = TokenBlockDataset(mmap_ds, mmap_ds.sizes, **kwargs)
+                    self.assertEqual(len(ds), len(ref))
+                    for i in range(len(ds)):
+                        if include_targets:
+                            for a, b in zip(ds[i], ref[i]):
+                                self.assertEqual(a.tolist(), b.tolist())
+                        else:
+                            self.assertEqual(ds[i].tolist(), ref[i].tolist())
+
 
 if __name__ == "__main__":
     unittest.main()